@@ -1 +1,3 @@
-from .accuracy_calculator import *
\ No newline at end of file
+from .accuracy_calculator import *
+from .accuracy_cache import *
+from .eval_pool import *
\ No newline at end of file
@@ -0,0 +1,64 @@
+'''
+Architecture-keyed accuracy cache.
+Evaluated accuracies are persisted per supernet checkpoint (sha256 of the weights file),
+so architectures that reappear after mutation/crossover or in a later search are not evaluated again.
+'''
+
+import hashlib
+import json
+import os
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def arch_key(sample):
+    return '-'.join(str(int(d)) for d in sample['d'])
+
+
+class AccuracyCache():
+    def __init__(
+        self,
+        weights,
+        tag='',
+        cache_dir=None,
+    ):
+        # tag : evaluation setting (dataset, image size, finetune epochs, ...) sharing the entries
+        self.tag = tag
+        cache_dir = cache_dir or os.path.join(os.path.dirname(str(weights)), '.nas_cache')
+        self.path = os.path.join(cache_dir, '%s.json' % file_hash(weights))
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        try:
+            # merge entries written by another search on the same checkpoint
+            self.entries = {**self.load(), **self.entries}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print('AccuracyCache: failed to save %s (%s)' % (self.path, e))
+
+    def key(self, sample, mode):
+        return '%s|%s|%s' % (self.tag, mode, arch_key(sample))
+
+    def get(self, sample, mode='full'):
+        return self.entries.get(self.key(sample, mode))
+
+    def put(self, sample, acc, mode='full'):
+        self.entries[self.key(sample, mode)] = float(acc)
+        self.save()
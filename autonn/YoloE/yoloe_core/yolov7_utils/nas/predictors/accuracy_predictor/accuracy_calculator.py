@@ -19,6 +19,7 @@ from utils.datasets import create_dataloader
 from utils.general import colorstr, check_img_size
 from utils.torch_utils import select_device
 from models.experimental import attempt_load
+from .accuracy_cache import AccuracyCache
 
 class AccuracyCalculator():
     def __init__(
@@ -69,6 +70,29 @@ class AccuracyCalculator():
                                        hyp=self.hyp, cache=opt.cache_images and not opt.notest, rect=True, rank=-1,
                                        world_size=opt.world_size, workers=opt.workers,
                                        pad=0.5, prefix=colorstr('val: '))[0]
+
+        # architecture-keyed accuracy cache (per supernet checkpoint)
+        self.cache = None
+        if getattr(opt, 'accuracy_cache', True):
+            tag = '%s:%s:%s:%s' % (os.path.abspath(opt.data), imgsz_test, opt.fintune_epochs, opt.single_cls)
+            self.cache = AccuracyCache(opt.weights, tag=tag)
+
+        # proxy : fixed small validation subset to rank candidates before the full evaluation
+        self.proxy_size = int(getattr(opt, 'proxy_size', 0) or 0)
+        self.proxyloader = None
+        if self.proxy_size > 0:
+            # whole rect batches of the test dataset (the images of a rect batch are letterboxed to the
+            # same shape, images of different batches can not be stacked), spread over the dataset
+            dataset = self.testloader.dataset
+            batches = [[] for _ in range(int(dataset.batch[-1]) + 1)]
+            for i, bi in enumerate(dataset.batch):
+                batches[bi].append(i)
+            nb = min(max(-(-self.proxy_size // len(batches[0])), 1), len(batches))
+            proxy_batches = [batches[bi] for bi in sorted({b * len(batches) // nb for b in range(nb)})]
+            self.proxyloader = torch.utils.data.DataLoader(dataset,
+                                                           batch_sampler=proxy_batches,
+                                                           num_workers=self.testloader.num_workers,
+                                                           collate_fn=type(dataset).collate_fn)
         
     # TODO : add finetune function
     def finetune_subnet(self, subnet):
@@ -96,10 +120,21 @@ class AccuracyCalculator():
         # raise NotImplementedError
         
 
+    def get_cached_accuracy(self, sample, mode='full'):
+        return self.cache.get(sample, mode) if self.cache is not None else None
+
+    def put_cached_accuracy(self, sample, acc, mode='full'):
+        if self.cache is not None:
+            self.cache.put(sample, acc, mode)
+
     def predict_accuracy(self, sample_list):
         acc_list = []
         # sample_list: list of subnets
         for sample in sample_list:
+            cached = self.get_cached_accuracy(sample, 'test')
+            if cached is not None:
+                acc_list.append(cached)
+                continue
             self.supernet.set_active_subnet(sample['d'])
             
             # Calculate mAP
@@ -119,11 +154,45 @@ class AccuracyCalculator():
             
             # mp, mr, map50, map, avg_loss = results
             map= results[3]
+            self.put_cached_accuracy(sample, map, 'test')
             acc_list.append(map)
 
         return acc_list
     
-    def predict_accuracy_once(self, sample):
+    def predict_proxy_accuracy(self, sample_list):
+        # mAP of the supernet weights (no finetune) on the proxy subset
+        acc_list = []
+        for sample in sample_list:
+            cached = self.get_cached_accuracy(sample, 'proxyb%d' % self.proxy_size)
+            if cached is not None:
+                acc_list.append(cached)
+                continue
+            self.supernet.set_active_subnet(sample['d'])
+            results, _, _ = test.test(self.opt.data,
+                                      batch_size=self.opt.batch_size * 2,
+                                      imgsz=self.imgsz_test,
+                                      conf_thres=0.001,
+                                      iou_thres=0.7,
+                                      model=self.supernet,
+                                      single_cls=self.opt.single_cls,
+                                      dataloader=self.proxyloader,
+                                      save_json=False,
+                                      plots=False,
+                                      is_coco=False,
+                                      v5_metric=self.opt.v5_metric)
+            self.supernet.float()   # test() casts the model to fp16, subnets are finetuned in fp32
+            self.put_cached_accuracy(sample, results[3], 'proxyb%d' % self.proxy_size)
+            acc_list.append(results[3])
+
+        return acc_list
+
+    def predict_accuracy_once(self, sample, use_cache=True):
+        # cached architecture : the accuracy is known, the subnet is not rebuilt (returns None)
+        if use_cache:
+            cached = self.get_cached_accuracy(sample)
+            if cached is not None:
+                return None, cached
+
         # activate the subnet
         self.supernet.set_active_subnet(sample['d'])
         # TODO : check the speed and memory about two implementations 1) get_active_subnet() 2) set_active_subnet() and deepcopy
@@ -152,4 +221,5 @@ class AccuracyCalculator():
             
         # mp, mr, map50, map, avg_loss = results
         map = finetune_results[3]
+        self.put_cached_accuracy(sample, map)
         return subnet, map
\ No newline at end of file
@@ -0,0 +1,148 @@
+'''
+Concurrent subnet evaluation.
+The supernet weights are put into shared memory once and every worker process
+(one per gpu, or several on the cpu) activates its own depth setting on them.
+Results are sent back to the search loop through a queue.
+'''
+
+import os
+import queue
+from copy import deepcopy
+from pathlib import Path
+
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from .accuracy_cache import arch_key
+
+POLL_INTERVAL = 5.0  # sec, dead worker check interval while waiting for results
+
+
+def get_eval_devices(num_workers):
+    '''
+    num_workers < 0 : one worker per gpu
+    num_workers > 0 : workers spread over the gpus (or on the cpu)
+    '''
+    if torch.cuda.is_available():
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        gpus = visible.split(',') if visible else [str(i) for i in range(torch.cuda.device_count())]
+        n = len(gpus) if num_workers < 0 else num_workers
+        return [gpus[i % len(gpus)] for i in range(n)]
+    return ['cpu'] * max(num_workers, 1)
+
+
+def eval_worker(rank, device, supernet, opt, tasks, results):
+    from .accuracy_calculator import AccuracyCalculator
+
+    opt = deepcopy(opt)
+    opt.device = device
+    opt.accuracy_cache = False  # the cache is owned by the search process
+    opt.save_dir = str(Path(opt.save_dir) / ('eval_worker%d' % rank))
+    calculator = AccuracyCalculator(opt, supernet)
+    # cpu workers evaluate on the shared weights, gpu workers keep one copy on their device
+    calculator.supernet = supernet.to(calculator.device)
+
+    best = None  # (acc, depth tuple, subnet) of the best subnet finetuned by this worker
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        mode, i, sample = task
+        try:
+            if mode == 'full':
+                subnet, acc = calculator.predict_accuracy_once(sample, use_cache=False)
+                if best is None or acc > best[0]:
+                    best = (acc, tuple(sample['d']), subnet)
+                result = acc
+            elif mode == 'proxy':
+                result = calculator.predict_proxy_accuracy([sample])[0]
+            else:  # 'subnet'
+                result = best[2].cpu() if best is not None and best[1] == tuple(sample['d']) else None
+            results.put((rank, i, result, None))
+        except Exception as e:
+            results.put((rank, i, None, repr(e)))
+
+
+class SupernetEvalPool():
+    def __init__(
+        self,
+        opt,
+        supernet,
+        num_workers=-1,
+    ):
+        ctx = mp.get_context('spawn')
+        # loaded once, the workers map the same storage
+        self.supernet = deepcopy(supernet).cpu().share_memory()
+        self.devices = get_eval_devices(num_workers)
+        self.results = ctx.Queue()
+        self.tasks, self.workers = [], []
+        for rank, device in enumerate(self.devices):
+            tasks = ctx.Queue()
+            # not daemonic, the dataloaders of a worker start their own processes (close() joins them)
+            worker = ctx.Process(target=eval_worker,
+                                 args=(rank, device, self.supernet, opt, tasks, self.results))
+            worker.start()
+            self.tasks.append(tasks)
+            self.workers.append(worker)
+        self.owner = {}  # arch key : rank of the worker which finetuned it
+        print('SupernetEvalPool: %d workers on %s' % (len(self.workers), ', '.join(self.devices)))
+
+    def get_result(self):
+        while True:
+            try:
+                rank, i, result, error = self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                dead = [rank for rank, worker in enumerate(self.workers) if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError('SupernetEvalPool: worker %s exited' % dead)
+                continue
+            if error is not None:
+                raise RuntimeError('SupernetEvalPool: worker %d failed (%s)' % (rank, error))
+            return rank, i, result
+
+    def map(self, mode, samples, desc=None):
+        '''
+        Evaluate the samples concurrently, a sample is sent to the next idle worker
+        mode : 'full' (finetuned accuracy) or 'proxy' (supernet accuracy on the proxy subset)
+        '''
+        accs = [None] * len(samples)
+        pending = list(enumerate(samples))[::-1]
+        idle = list(range(len(self.workers)))
+        running = 0
+        pbar = tqdm(total=len(samples), desc=desc)
+        while pending or running:
+            while pending and idle:
+                i, sample = pending.pop()
+                self.tasks[idle.pop()].put((mode, i, sample))
+                running += 1
+            rank, i, acc = self.get_result()
+            running -= 1
+            idle.append(rank)
+            accs[i] = acc
+            if mode == 'full':
+                self.owner[arch_key(samples[i])] = rank
+            pbar.update(1)
+        pbar.close()
+        return accs
+
+    def get_subnet(self, sample):
+        # finetuned subnet of the sample, None if its worker does not keep it anymore
+        rank = self.owner.get(arch_key(sample))
+        if rank is None:
+            return None
+        self.tasks[rank].put(('subnet', -1, sample))
+        return self.get_result()[2]
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            # drop the results left over by a failed search, a worker exits only when its queue is flushed
+            while worker.is_alive():
+                try:
+                    self.results.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            worker.join()
+        self.tasks, self.workers = [], []
@@ -4,13 +4,18 @@ It will be replaced with code of a trained predictor network later.
 '''
 import json
 import os
+import itertools
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import copy
+
+NUM_BLOCKS = [4, 4]                         # backbone, head ELAN blocks
+DEPTHS = [[1, 2, 3], [1, 2, 3, 4, 5]]       # depth choices of backbone, head blocks
+PREDICT_BATCH_SIZE = 8192                   # archs per forward pass of the predictor nets
 
 class LatencyPredictor:
-    def __init__(self, target, target_acc, device):
+    def __init__(self, target, target_acc, device, precompute=True):
         path = os.path.dirname(os.path.realpath(__file__))
         bpred_path = os.path.join(path, "trained_lat_pred/{}_{}_backbone.pt".format(target, target_acc))
         hpred_path = os.path.join(path, "trained_lat_pred/{}_{}_head.pt".format(target, target_acc))
@@ -34,30 +39,55 @@ class LatencyPredictor:
         self.b_net.eval()
         self.h_net.eval()
 
+        # memo table : depth tuple -> latency
+        self.memo = {}
+        if precompute:
+            self.precompute()
+
+    def precompute(self):
+        # the whole depth space is small (3^4 * 5^4 = 50625), predict every point once
+        space = [DEPTHS[0]] * NUM_BLOCKS[0] + [DEPTHS[1]] * NUM_BLOCKS[1]
+        self.predict_efficiency_batch([{'d': list(d)} for d in itertools.product(*space)])
+
     def predict_efficiency(self, arch):
-        b_feat, h_feat = arch_to_feat(arch, self.device)
-        latency_b = self.b_net(b_feat)
-        latency_h = self.h_net(h_feat)
+        return float(self.predict_efficiency_batch([arch])[0])
+
+    def predict_efficiency_batch(self, archs):
+        keys = [tuple(int(d) for d in arch['d']) for arch in archs]
+        missing = list(dict.fromkeys(k for k in keys if k not in self.memo))
 
-        return latency_b + latency_h
+        with torch.no_grad():
+            for i in range(0, len(missing), PREDICT_BATCH_SIZE):
+                chunk = missing[i:i + PREDICT_BATCH_SIZE]
+                b_feat, h_feat = archs_to_feat([{'d': k} for k in chunk], self.device)
+                latency = (self.b_net(b_feat) + self.h_net(h_feat)).view(-1).cpu().numpy()
+                self.memo.update(zip(chunk, latency.tolist()))
+
+        return np.array([self.memo[k] for k in keys], dtype=np.float32)
     
 def arch_to_feat(arch, device):
     # This function converts a backbone arch_encoding to a feature vector (20-D).
-    d_list = copy.deepcopy(arch['d'])
+    b_feat, h_feat = archs_to_feat([arch], device)
+    return b_feat[0], h_feat[0]
+
+
+def archs_to_feat(archs, device):
+    # This function converts arch_encodings to feature matrices (N x 20, N x 28).
+    d_list = np.asarray([arch['d'] for arch in archs], dtype=np.int64).reshape(len(archs), -1)
+    rows = np.arange(len(archs))
 
     # convert to onehot, 5*4 = 20-D feature vector
-    b_onehot = [0 for _ in range(20)]
-    h_onehot = [0 for _ in range(28)]
+    b_onehot = np.zeros((len(archs), 20), dtype=np.float32)
+    h_onehot = np.zeros((len(archs), 28), dtype=np.float32)
 
+    # same encoding as the trained predictors : head depths are also written into b_onehot
     for i in range(4):
-        tidx = int(d_list[i]) - 1
-        b_onehot[i*5 + tidx] = 1
+        b_onehot[rows, i*5 + d_list[:, i] - 1] = 1
     
     for i in range(4):
-        tidx = int(d_list[i+4]) - 1
-        b_onehot[i*5 + tidx] = 1
+        b_onehot[rows, i*5 + d_list[:, i+4] - 1] = 1
 
-    return torch.Tensor(b_onehot).to(device).float(), torch.Tensor(h_onehot).to(device).float()
+    return torch.from_numpy(b_onehot).to(device), torch.from_numpy(h_onehot).to(device)
 
 
 class Net(nn.Module):
@@ -1,7 +1,9 @@
 import copy
+import os
 import random
-from tqdm import tqdm, trange
+from tqdm import tqdm
 import numpy as np
+import torch
 
 
 class ArchManager:
@@ -69,6 +71,17 @@ class EvolutionFinder:
         self.max_time_budget = kwargs.get("max_time_budget", 1)
         self.parent_ratio = kwargs.get("parent_ratio", 1.)
         self.mutation_ratio = kwargs.get("mutation_ratio", 0.5)
+        # > 0 : children are ranked by the proxy accuracy and only the top-k are fully evaluated
+        self.proxy_top_k = kwargs.get("proxy_top_k", 0)
+        # SupernetEvalPool : subnets of a generation are evaluated concurrently (None : in this process)
+        self.eval_pool = kwargs.get("eval_pool", None)
+        # snapshot of the search state, the search resumes from it after a restart (None : off)
+        self.snapshot_path = kwargs.get("snapshot_path", None)
+        self.snapshot_interval = kwargs.get("snapshot_interval", 1)
+        # settings outside the finder a snapshot belongs to (supernet weights, dataset, target)
+        self.snapshot_setting = kwargs.get("snapshot_setting", {})
+        self.evaluated = {}  # depth tuple : accuracy of every architecture of this search
+        self.best_subnet = None  # (acc, depth tuple, subnet) of the best finetuned subnet
         
     def invite_reset_constraint_type(self):
         print(
@@ -113,42 +126,175 @@ class EvolutionFinder:
     def set_efficiency_constraint(self, new_constraint):
         self.efficiency_constraint = new_constraint
 
-    def random_sample(self):
+    def filter_by_constraint(self, propose, n):
+        """Rejection sampling of n samples under the efficiency constraint.
+        Every round proposes one candidate per unfilled slot (propose(i)) and
+        checks all of them with a single batched predictor call."""
         constraint = self.efficiency_constraint
-        while True:
-            sample = self.arch_manager.random_sample()
-            efficiency = self.efficiency_predictor.predict_efficiency(sample)
-            if efficiency <= constraint:
-                return sample, efficiency
+        results = [None] * n
+        pending = list(range(n))
+        while pending:
+            candidates = [propose(i) for i in pending]
+            efficiencies = self.efficiency_predictor.predict_efficiency_batch(candidates)
+            rejected = []
+            for i, sample, efficiency in zip(pending, candidates, efficiencies):
+                if efficiency <= constraint:
+                    results[i] = (sample, float(efficiency))
+                else:
+                    rejected.append(i)
+            pending = rejected
+        return results
 
-    def mutate_sample(self, sample):
-        constraint = self.efficiency_constraint
-        while True:
-            new_sample = copy.deepcopy(sample)
+    def random_sample_batch(self, n):
+        return self.filter_by_constraint(lambda i: self.arch_manager.random_sample(), n)
+
+    def mutate_sample_batch(self, samples):
+        return self.filter_by_constraint(lambda i: self.mutate(samples[i]), len(samples))
 
-            for i in range(sum(self.num_blocks)):
-                if random.random() < self.mutate_prob:
-                    self.arch_manager.random_resample_depth(new_sample, i)
+    def crossover_sample_batch(self, samples1, samples2):
+        return self.filter_by_constraint(lambda i: self.crossover(samples1[i], samples2[i]), len(samples1))
 
-            efficiency = self.efficiency_predictor.predict_efficiency(new_sample)
-            if efficiency <= constraint:
-                return new_sample, efficiency
+    def random_sample(self):
+        return self.random_sample_batch(1)[0]
+
+    def mutate_sample(self, sample):
+        return self.mutate_sample_batch([sample])[0]
 
     def crossover_sample(self, sample1, sample2):
-        constraint = self.efficiency_constraint
-        while True:
-            new_sample = copy.deepcopy(sample1)
-            for key in new_sample.keys():
-                if not isinstance(new_sample[key], list):
-                    continue
-                for i in range(len(new_sample[key])):
-                    new_sample[key][i] = random.choice(
-                        [sample1[key][i], sample2[key][i]]
-                    )
-
-            efficiency = self.efficiency_predictor.predict_efficiency(new_sample)
-            if efficiency <= constraint:
-                return new_sample, efficiency
+        return self.crossover_sample_batch([sample1], [sample2])[0]
+
+    def mutate(self, sample):
+        new_sample = copy.deepcopy(sample)
+        for i in range(sum(self.num_blocks)):
+            if random.random() < self.mutate_prob:
+                self.arch_manager.random_resample_depth(new_sample, i)
+        return new_sample
+
+    def crossover(self, sample1, sample2):
+        new_sample = copy.deepcopy(sample1)
+        for key in new_sample.keys():
+            if not isinstance(new_sample[key], list):
+                continue
+            for i in range(len(new_sample[key])):
+                new_sample[key][i] = random.choice(
+                    [sample1[key][i], sample2[key][i]]
+                )
+        return new_sample
+
+    def evaluate(self, sample):
+        subnet, acc = self.accuracy_predictor.predict_accuracy_once(sample)
+        # keep only the best subnet, cached architectures are not rebuilt (subnet is None)
+        if subnet is not None and (self.best_subnet is None or acc > self.best_subnet[0]):
+            self.best_subnet = (acc, tuple(sample["d"]), subnet)
+        return acc
+
+    def pool_evaluate(self, mode, samples, desc=None):
+        # cached accuracies are looked up here, only the misses go to the workers
+        cache_mode = "full" if mode == "full" else "proxyb%d" % self.accuracy_predictor.proxy_size
+        accs = [self.accuracy_predictor.get_cached_accuracy(sample, cache_mode) for sample in samples]
+        misses = [i for i, acc in enumerate(accs) if acc is None]
+        results = self.eval_pool.map(mode, [samples[i] for i in misses], desc=desc)
+        for i, acc in zip(misses, results):
+            self.accuracy_predictor.put_cached_accuracy(samples[i], acc, cache_mode)
+            accs[i] = acc
+        return accs
+
+    def evaluate_batch(self, samples, desc=None):
+        # architectures already evaluated in this search (also before a resume) are not evaluated again
+        accs = [self.evaluated.get(tuple(sample["d"])) for sample in samples]
+        misses = [i for i, acc in enumerate(accs) if acc is None]
+        new_samples = [samples[i] for i in misses]
+        if self.eval_pool is None:
+            results = [self.evaluate(sample) for sample in tqdm(new_samples, desc=desc)]
+        else:
+            results = self.pool_evaluate("full", new_samples, desc=desc)
+        for i, acc in zip(misses, results):
+            self.evaluated[tuple(samples[i]["d"])] = acc
+            accs[i] = acc
+        return accs
+
+    def snapshot_key(self):
+        # a snapshot is only resumed by a search with the same setting (the time budget may differ)
+        return {
+            "constraint_type": self.constraint_type,
+            "efficiency_constraint": self.efficiency_constraint,
+            "population_size": self.population_size,
+            "parent_ratio": self.parent_ratio,
+            "mutation_ratio": self.mutation_ratio,
+            "mutate_prob": self.mutate_prob,
+            "proxy_top_k": self.proxy_top_k,
+            **self.snapshot_setting,
+        }
+
+    def save_snapshot(self, iter, population, best_valids, best_info):
+        if self.snapshot_path is None:
+            return
+        state = {
+            "key": self.snapshot_key(),
+            "iter": iter,
+            "population": population,
+            "best_valids": best_valids,
+            "best_info": best_info,
+            "evaluated": self.evaluated,
+            "rng": {
+                "random": random.getstate(),
+                "numpy": np.random.get_state(),
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (self.snapshot_path, os.getpid())
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            print("EvolutionFinder: failed to save the snapshot %s (%s)" % (self.snapshot_path, e))
+
+    def load_snapshot(self):
+        if self.snapshot_path is None or not os.path.isfile(self.snapshot_path):
+            return None
+        try:
+            state = torch.load(self.snapshot_path)
+        except Exception as e:
+            print("EvolutionFinder: failed to load the snapshot %s (%s)" % (self.snapshot_path, e))
+            return None
+        if state.get("key") != self.snapshot_key():
+            print("EvolutionFinder: the snapshot %s is from another search setting, start over" % self.snapshot_path)
+            return None
+
+        rng = state["rng"]
+        random.setstate(rng["random"])
+        np.random.set_state(rng["numpy"])
+        torch.set_rng_state(rng["torch"])
+        if rng["cuda"] is not None and torch.cuda.is_available() and len(rng["cuda"]) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all(rng["cuda"])
+        self.evaluated = state["evaluated"]
+        return state
+
+    def remove_snapshot(self):
+        if self.snapshot_path is not None and os.path.isfile(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
+    def select_by_proxy(self, candidates):
+        """Successive halving: (sample, efficiency) candidates are ranked by the proxy
+        accuracy and only the top-k go to the full evaluation. Candidates whose full
+        accuracy is already cached are always kept (they cost nothing)."""
+        known, unknown = [], []
+        for candidate in candidates:
+            if self.accuracy_predictor.get_cached_accuracy(candidate[0]) is not None:
+                known.append(candidate)
+            else:
+                unknown.append(candidate)
+        if len(unknown) <= self.proxy_top_k:
+            return candidates
+
+        if self.eval_pool is None:
+            proxy_accs = self.accuracy_predictor.predict_proxy_accuracy([c[0] for c in unknown])
+        else:
+            proxy_accs = self.pool_evaluate("proxy", [c[0] for c in unknown], desc="Proxy evaluation...")
+        top_k = np.argsort(proxy_accs)[::-1][:self.proxy_top_k]
+        return known + [unknown[i] for i in top_k]
 
     def run_evolution_search(self, verbose=False):
         """Run a single roll-out of regularized evolution to a fixed time budget."""
@@ -160,19 +306,31 @@ class EvolutionFinder:
 
         best_valids = [-100]
         population = []  # (validation, sample, latency) tuples
+        self.best_subnet = None
+        self.evaluated = {}
         child_pool = []
         best_info = None
 
-        for _ in trange(population_size, desc="Generate random population..."):
-            sample, efficiency = self.random_sample()
-            subnet, acc = self.accuracy_predictor.predict_accuracy_once(sample)
-            population.append((acc, sample, efficiency, subnet))
+        state = self.load_snapshot()
+        if state is not None:
+            start = state["iter"]
+            population, best_valids, best_info = state["population"], state["best_valids"], state["best_info"]
+            print("Resume the search from %s (%d/%d iterations, %d evaluated architectures)"
+                  % (self.snapshot_path, start, max_time_budget, len(self.evaluated)))
+        else:
+            start = 0
+            # constraint filtering of the whole population at once
+            samples = self.random_sample_batch(population_size)
+            accs = self.evaluate_batch([sample for sample, _ in samples], desc="Generate random population...")
+            for (sample, efficiency), acc in zip(samples, accs):
+                population.append((acc, sample, efficiency))
+            self.save_snapshot(start, population, best_valids, best_info)
 
         if verbose:
             print("Start Evolution...")
         # After the population is seeded, proceed with evolving the population.
         for iter in tqdm(
-            range(max_time_budget),
+            range(start, max_time_budget),
             desc="Searching with %s constraint (%s)"
             % (self.constraint_type, self.efficiency_constraint),
         ):
@@ -191,23 +349,50 @@ class EvolutionFinder:
             child_pool = []
             efficiency_pool = []
 
-            for i in range(mutation_numbers):
-                par_sample = population[np.random.randint(parents_size)][1]
-                # Mutate
-                new_sample, efficiency = self.mutate_sample(par_sample)
+            # Mutate
+            par_samples = [population[np.random.randint(parents_size)][1] for _ in range(mutation_numbers)]
+            for new_sample, efficiency in self.mutate_sample_batch(par_samples):
                 child_pool.append(new_sample)
                 efficiency_pool.append(efficiency)
 
+            # Crossover
+            par_samples1, par_samples2 = [], []
             for i in range(population_size - mutation_numbers):
-                par_sample1 = population[np.random.randint(parents_size)][1]
-                par_sample2 = population[np.random.randint(parents_size)][1]
-                # Crossover
-                new_sample, efficiency = self.crossover_sample(par_sample1, par_sample2)
+                par_samples1.append(population[np.random.randint(parents_size)][1])
+                par_samples2.append(population[np.random.randint(parents_size)][1])
+            for new_sample, efficiency in self.crossover_sample_batch(par_samples1, par_samples2):
                 child_pool.append(new_sample)
                 efficiency_pool.append(efficiency)
 
-            for i in trange(population_size, desc=f"[{iter+1}|{max_time_budget}] Mutate and Crossover..."):
-                _, acc = self.accuracy_predictor.predict_accuracy_once(child_pool[i])                
-                population.append((acc, child_pool[i], efficiency_pool[i]))
+            candidates = list(zip(child_pool, efficiency_pool))
+            if self.proxy_top_k > 0:
+                candidates = self.select_by_proxy(candidates)
+
+            accs = self.evaluate_batch([sample for sample, _ in candidates],
+                                       desc=f"[{iter+1}|{max_time_budget}] Mutate and Crossover...")
+            for (sample, efficiency), acc in zip(candidates, accs):
+                population.append((acc, sample, efficiency))
+
+            if (iter + 1) % self.snapshot_interval == 0 or iter + 1 == max_time_budget:
+                self.save_snapshot(iter + 1, population, best_valids, best_info)
+
+        # children of the last generation
+        best = max(population, key=lambda x: x[0])
+        if best[0] > best_valids[-1]:
+            best_valids.append(best[0])
+            best_info = best
+
+        # (validation, sample, latency, subnet)
+        acc, sample, efficiency = best_info
+        subnet = None
+        if self.best_subnet is not None and self.best_subnet[1] == tuple(sample["d"]):
+            subnet = self.best_subnet[2]
+        elif self.eval_pool is not None:
+            subnet = self.eval_pool.get_subnet(sample)
+        if subnet is None:
+            # the accuracy came from the cache, finetune the best architecture once
+            subnet, _ = self.accuracy_predictor.predict_accuracy_once(sample, use_cache=False)
+        best_info = (acc, sample, efficiency, subnet)
+        self.remove_snapshot()
 
         return best_valids, best_info
\ No newline at end of file
@@ -16,7 +16,8 @@ from utils.torch_utils import ModelEMA, select_device, is_parallel
 
 from nas.search_algorithm import EvolutionFinder
 from nas.predictors.efficiency_predictor import LatencyPredictor
-from nas.predictors.accuracy_predictor import AccuracyCalculator
+from nas.predictors.accuracy_predictor import AccuracyCalculator, SupernetEvalPool
+from nas.predictors.accuracy_predictor.accuracy_cache import file_hash
 # from nas.supernet.supernet_yolov7 import YOLOSuperNet
 
 def run_search(opt, target, target_acc):
@@ -42,24 +43,50 @@ def run_search(opt, target, target_acc):
     # opt parameters for fintuning
     accuracy_predictor = AccuracyCalculator(opt, supernet)
 
-    # build the evolution finder
-    finder = EvolutionFinder(
-        constraint_type=constraint_type, 
-        efficiency_constraint=efficiency_constraint, 
-        efficiency_predictor=efficiency_predictor, 
-        accuracy_predictor=accuracy_predictor
-    )
-
-    # start searching
-    result_list = []
-    for flops in [efficiency_constraint]:   # iterate 1
-        st = time.time()
-        finder.set_efficiency_constraint(flops)
-        best_valids, best_info = finder.run_evolution_search()
-        ed = time.time()
-        # print('Found best architecture at flops <= %.2f M in %.2f seconds! It achieves %.2f%s predicted accuracy with %.2f MFLOPs.' % (flops, ed-st, best_info[0] * 100, '%', best_info[-1]))
-        result_list.append(best_info)
-        
+    # search snapshot in the project directory (the dataset directory is shared by every project),
+    # only resumed by a search on the same supernet, dataset and target
+    snapshot_path, snapshot_setting = None, {}
+    if getattr(opt, 'search_snapshot', True):
+        snapshot_dir = getattr(opt, 'proj_path', None) or opt.save_dir
+        snapshot_path = str(Path(snapshot_dir) / 'nas_search_state.pt')
+        snapshot_setting = {
+            'weights': file_hash(opt.weights),
+            'data': os.path.abspath(opt.data),
+            'target': target,
+            'target_acc': target_acc,
+        }
+
+    # concurrent subnet evaluation on the shared supernet weights
+    eval_workers = int(getattr(opt, 'eval_workers', 0) or 0)
+    eval_pool = SupernetEvalPool(opt, supernet, num_workers=eval_workers) if eval_workers else None
+
+    try:
+        # build the evolution finder
+        finder = EvolutionFinder(
+            constraint_type=constraint_type, 
+            efficiency_constraint=efficiency_constraint, 
+            efficiency_predictor=efficiency_predictor, 
+            accuracy_predictor=accuracy_predictor,
+            proxy_top_k=opt.proxy_top_k if getattr(opt, 'proxy_size', 0) else 0,
+            eval_pool=eval_pool,
+            snapshot_path=snapshot_path,
+            snapshot_setting=snapshot_setting,
+            snapshot_interval=getattr(opt, 'snapshot_interval', 1)
+        )
+
+        # start searching
+        result_list = []
+        for flops in [efficiency_constraint]:   # iterate 1
+            st = time.time()
+            finder.set_efficiency_constraint(flops)
+            best_valids, best_info = finder.run_evolution_search()
+            ed = time.time()
+            # print('Found best architecture at flops <= %.2f M in %.2f seconds! It achieves %.2f%s predicted accuracy with %.2f MFLOPs.' % (flops, ed-st, best_info[0] * 100, '%', best_info[-1]))
+            result_list.append(best_info)
+    finally:
+        if eval_pool is not None:
+            eval_pool.close()
+
     # save model into yaml
     # for i, result in enumerate(result_list):
     #     best_depth = result[1]['d']
@@ -5,7 +5,6 @@ import os
 import gc
 import random
 import time
-from copy import deepcopy
 from pathlib import Path
 from threading import Thread
 
@@ -27,7 +26,9 @@ from .models.experimental import attempt_load
 from .models.yolo import Model
 from .utils.autoanchor import check_anchors
 from .utils.autobatch import get_batch_size_for_gpu
+from .utils.ckpt_writer import CheckpointWriter
 from .utils.datasets import create_dataloader
+from .utils.gpu_augment import GPUAugment
 from .utils.general import labels_to_class_weights, increment_path, labels_to_image_weights, init_seeds, \
     fitness, strip_optimizer, get_latest_run, check_dataset, check_file, check_git_status, check_img_size, \
     check_requirements, print_mutation, set_logging, one_cycle, colorstr
@@ -263,6 +264,7 @@ def train(hyp, opt, device, tb_writer=None, target=None):
                                             image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '))
     mlc = np.concatenate(dataset.labels, 0)[:, 0].max()  # max label class
     nb = len(dataloader)  # number of batches
+    gpu_augment = GPUAugment(hyp, imgsz) if dataset.gpu_augment else None  # mosaic, perspective, hsv, flips on device
     assert mlc < nc, 'Label class %g exceeds nc=%g in %s. Possible class labels are 0-%g' % (mlc, nc, opt.data, nc - 1)
 
     # Process 0
@@ -318,7 +320,8 @@ def train(hyp, opt, device, tb_writer=None, target=None):
                 f'Using {dataloader.num_workers} dataloader workers\n'
                 f'Logging results to {save_dir}\n'
                 f'Starting training for {epochs} epochs...')
-    torch.save(model, wdir / 'init.pt')
+    ckpt_writer = CheckpointWriter()  # checkpoints are written on a background thread
+    ckpt_writer.save(model, wdir / 'init.pt')
     for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
         model.train()
 
@@ -351,6 +354,8 @@ def train(hyp, opt, device, tb_writer=None, target=None):
         for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
             ni = i + nb * epoch  # number integrated batches (since train start)
             imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            if gpu_augment is not None:
+                imgs, targets = gpu_augment(imgs, targets)
 
             # Warmup
             if ni <= nw:
@@ -469,33 +474,37 @@ def train(hyp, opt, device, tb_writer=None, target=None):
                 ckpt = {'epoch': epoch,
                         'best_fitness': best_fitness,
                         'training_results': results_file.read_text(),
-                        'model': deepcopy(model.module if is_parallel(model) else model).half(),
-                        'ema': deepcopy(ema.ema).half(),
+                        'model': model.module if is_parallel(model) else model,
+                        'ema': ema.ema,
                         'updates': ema.updates,
                         'optimizer': optimizer.state_dict(),
                         'wandb_id': wandb_logger.wandb_run.id if wandb_logger.wandb else None}
 
-                # Save last, best and delete
-                torch.save(ckpt, last)
+                # Save last, best and delete (models are saved in fp16)
+                paths = [last]
                 if best_fitness == fi:
-                    torch.save(ckpt, best)
+                    paths.append(best)
                 if (best_fitness == fi) and (epoch >= 200):
-                    torch.save(ckpt, wdir / 'best_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'best_{:03d}.pt'.format(epoch))
                 if epoch == 0:
-                    torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'epoch_{:03d}.pt'.format(epoch))
                 elif ((epoch+1) % 25) == 0:
-                    torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'epoch_{:03d}.pt'.format(epoch))
                 elif epoch >= (epochs-5):
-                    torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    paths.append(wdir / 'epoch_{:03d}.pt'.format(epoch))
+                ckpt_writer.save(ckpt, *paths, half=True)
                 if wandb_logger.wandb:
                     if ((epoch + 1) % opt.save_period == 0 and not final_epoch) and opt.save_period != -1:
+                        ckpt_writer.flush()
                         wandb_logger.log_model(
                             last.parent, opt, epoch, fi, best_model=best_fitness == fi)
                 del ckpt
 
         # end epoch ----------------------------------------------------------------------------------------------------
     # end training
+    ckpt_writer.close()
     if rank in [-1, 0]:
+        logger.info(ckpt_writer.summary())
         # Plots
         if plots:
             plot_results(save_dir=save_dir)  # save as results.png
@@ -561,6 +570,7 @@ def run_yolo(proj_path, dataset_yaml_path, data=None, target=None, train_mode='s
     print(proj_info)
 
     opt.data = str(dataset_yaml_path)
+    opt.proj_path = str(proj_path)
     if target == 'Galaxy_S22':
         # autonn/YoloE/yoloe_core/yolov7_utils/cfg/supernet/yolov7_supernet.yml
         opt.cfg = str('yolov7_utils/cfg/supernet/yolov7_supernet.yml')
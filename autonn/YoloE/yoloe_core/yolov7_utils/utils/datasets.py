@@ -1,16 +1,19 @@
 # Dataset utils and dataloaders
 
+import fcntl
 import glob
+import hashlib
 import logging
 import math
 import os
 import random
 import shutil
 import time
+from collections import deque
 from itertools import repeat
-from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Event, Lock, Thread
 
 import cv2
 import numpy as np
@@ -36,6 +39,8 @@ from torch_utils import torch_distributed_zero_first
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo']  # acceptable image suffixes
 vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv']  # acceptable video suffixes
+NUM_THREADS = min(8, max(1, os.cpu_count() - 1))  # number of label scan processes
+CACHE_VERSION = 0.2  # dataset labels *.cache version
 logger = logging.getLogger(__name__)
 
 # Get orientation exif tag
@@ -44,9 +49,21 @@ for orientation in ExifTags.TAGS.keys():
         break
 
 
+def get_file_stat(f):
+    # Returns (size, mtime) of a file or None if it does not exist
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
 def get_hash(files):
-    # Returns a single hash value of a list of files
-    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+    # Returns a single hash value of a list of files (paths, sizes and modification times)
+    h = hashlib.md5()
+    for f in files:
+        h.update(f'{f}:{get_file_stat(f)}'.encode())
+    return h.hexdigest()
 
 
 def exif_size(img):
@@ -77,7 +94,8 @@ def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=Fa
                                       stride=int(stride),
                                       pad=pad,
                                       image_weights=image_weights,
-                                      prefix=prefix)
+                                      prefix=prefix,
+                                      gpu_augment=getattr(opt, 'gpu_augment', False))
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
@@ -354,13 +372,14 @@ def img2label_paths(img_paths):
 
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', gpu_augment=False):
         self.img_size = img_size
         self.augment = augment
+        self.gpu_augment = augment and gpu_augment and not rect  # workers only decode and letterbox, see utils/gpu_augment.py
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
-        self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
+        self.mosaic = self.augment and not self.rect and not self.gpu_augment  # load 4 images at a time into a mosaic (only during training)
         self.mosaic_border = [-img_size // 2, -img_size // 2]
         self.stride = stride
         self.path = path        
@@ -393,8 +412,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         print(cache_path)
         if cache_path.is_file():
             cache, exists = torch.load(cache_path), True  # load
-            #if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-            #    cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
+            if cache.get('version') != CACHE_VERSION or cache.get('hash') != get_hash(self.label_files + self.img_files):  # changed
+                cache, exists = self.cache_labels(cache_path, prefix, cache), False  # re-cache (unchanged files are reused)
         else:
             cache, exists = self.cache_labels(cache_path, prefix), False  # cache
 
@@ -408,6 +427,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Read cache
         cache.pop('hash')  # remove hash
         cache.pop('version')  # remove version
+        cache.pop('stats')  # remove file stats
         labels, shapes, self.segments = zip(*cache.values())
         self.labels = list(labels)
         self.shapes = np.array(shapes, dtype=np.float64)
@@ -450,7 +470,12 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
         self.imgs = [None] * n
-        if cache_images:
+        self.img_shard, self.img_index, self.img_mmap = None, None, None  # packed mmap cache
+        self.paste_in_pool = None  # instance crops for paste_in, created in each dataloader worker
+        self.use_paste_in_pool = True  # False: crops are cut from new mosaics in __getitem__ (see benchmark_paste_in)
+        if cache_images == 'mmap':
+            self.cache_images_mmap(cache_path, prefix)
+        elif cache_images:
             if cache_images == 'disk':
                 self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
                 self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
@@ -470,61 +495,95 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
             pbar.close()
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', old_cache=None):
         # Cache dataset labels, check images and read shapes
+        # files whose (size, mtime) did not change since old_cache are not verified again
         x = {}  # dict
+        stats = {}  # im_file: ((image stat, label stat), (nm, nf, ne))
         nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
-            try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == 5, 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
-                    else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
-                else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-        pbar.close()
+        old_stats = old_cache.get('stats', {}) if old_cache and old_cache.get('version') == CACHE_VERSION else {}
+
+        todo = []
+        for im_file, lb_file in zip(self.img_files, self.label_files):
+            stat = (get_file_stat(im_file), get_file_stat(lb_file))
+            old = old_stats.get(im_file)
+            if old is not None and old[0] == stat and im_file in old_cache:
+                x[im_file] = old_cache[im_file]
+                stats[im_file] = old
+                nm, nf, ne = nm + old[1][0], nf + old[1][1], ne + old[1][2]
+            else:
+                todo.append((im_file, lb_file, stat))
+
+        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+        if todo:
+            with Pool(NUM_THREADS) as pool:
+                pbar = tqdm(pool.imap(verify_image_label, todo, chunksize=64), desc=desc, total=len(todo))
+                for im_file, l, shape, segments, stat, nm_f, nf_f, ne_f, nc_f, msg in pbar:
+                    nm += nm_f
+                    nf += nf_f
+                    ne += ne_f
+                    nc += nc_f
+                    if im_file:
+                        x[im_file] = [l, shape, segments]
+                        stats[im_file] = (stat, (nm_f, nf_f, ne_f))
+                    if msg:
+                        print(prefix + msg)
+                    pbar.desc = f"{desc} {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
+                pbar.close()
+        x = {f: x[f] for f in self.img_files if f in x}  # keep the order of the image files
 
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
 
         x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
+        x['results'] = nf, nm, ne, nc, len(self.img_files)
+        x['version'] = CACHE_VERSION  # cache version
+        x['stats'] = stats
         torch.save(x, path)  # save for next time
-        logging.info(f'{prefix}New cache created: {path}')
+        logging.info(f'{prefix}New cache created: {path} ({len(todo)} of {len(self.img_files)} files scanned)')
         return x
 
+    def cache_images_mmap(self, cache_path, prefix=''):
+        # Cache resized images into one packed uint8 shard file + offsets index. The shard is memory-mapped
+        # read-only, so every dataloader worker and every training on the same dataset shares one copy (page cache)
+        shard = cache_path.with_name(f"{cache_path.stem}_{self.img_size}{'_aug' if self.augment else ''}.shard")
+        index_path = shard.with_suffix('.shard.index')
+        files = sorted(self.img_files)
+        key = get_hash(files)
+
+        with open(str(shard) + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # one process builds the shard, the others wait and reuse it
+            index = torch.load(index_path) if index_path.is_file() and shard.is_file() else None
+            if index is None or index['hash'] != key:
+                rows = {f: i for i, f in enumerate(self.img_files)}
+                table = np.zeros((len(files), 6), dtype=np.int64)  # offset, h0, w0, h, w, c
+                offset = 0
+                tmp_path = shard.with_suffix(f'.shard.{os.getpid()}.tmp')
+                with open(tmp_path, 'wb') as f:
+                    results = ThreadPool(8).imap(lambda x: load_image(self, rows[x]), files)
+                    pbar = tqdm(enumerate(results), total=len(files))
+                    for i, (img, (h0, w0), (h, w)) in pbar:
+                        img = np.ascontiguousarray(img)
+                        f.write(img.tobytes())
+                        table[i] = offset, h0, w0, h, w, img.shape[2]
+                        offset += img.nbytes
+                        pbar.desc = f'{prefix}Caching images into {shard.name} ({offset / 1E9:.1f}GB)'
+                    pbar.close()
+                os.replace(tmp_path, shard)
+                index = {'hash': key, 'files': files, 'index': table}
+                torch.save(index, index_path)
+                logging.info(f'{prefix}New image shard created: {shard}')
+
+        rows = {f: i for i, f in enumerate(index['files'])}
+        self.img_index = index['index'][[rows[f] for f in self.img_files]]
+        self.img_shard = str(shard)
+
+    def get_paste_in_pool(self):
+        # the pool thread does not survive the fork of the dataloader workers, one pool per process
+        if self.paste_in_pool is None or self.paste_in_pool.pid != os.getpid():
+            self.paste_in_pool = PasteInPool(self)
+        return self.paste_in_pool
+
     def __len__(self):
         return len(self.img_files)
 
@@ -570,7 +629,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
-        if self.augment:
+        if self.augment and not self.gpu_augment:
             # Augment imagespace
             if not mosaic:
                 img, labels = random_perspective(img, labels,
@@ -591,15 +650,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             #     labels = cutout(img, labels)
             
             if random.random() < hyp['paste_in']:
-                sample_labels, sample_images, sample_masks = [], [], [] 
-                while len(sample_labels) < 30:
-                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
-                    sample_labels += sample_labels_
-                    sample_images += sample_images_
-                    sample_masks += sample_masks_
-                    #print(len(sample_labels))
-                    if len(sample_labels) == 0:
-                        break
+                if self.use_paste_in_pool:
+                    sample_labels, sample_images, sample_masks = self.get_paste_in_pool().draw(30)
+                else:
+                    sample_labels, sample_images, sample_masks = draw_paste_in_samples(self, 30)
                 labels = pastein(img, labels, sample_labels, sample_images, sample_masks)
 
         nL = len(labels)  # number of labels
@@ -608,7 +662,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [2, 4]] /= img.shape[0]  # normalized height 0-1
             labels[:, [1, 3]] /= img.shape[1]  # normalized width 0-1
 
-        if self.augment:
+        if self.augment and not self.gpu_augment:
             # flip up-down
             if random.random() < hyp['flipud']:
                 img = np.flipud(img)
@@ -665,9 +719,54 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         return torch.stack(img4, 0), torch.cat(label4, 0), path4, shapes4
 
 
+def verify_image_label(args):
+    # Verify one image-label pair, returns (im_file, labels, shape, segments, stat, nm, nf, ne, nc, msg)
+    im_file, lb_file, stat = args
+    nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupt
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if os.path.isfile(lb_file):
+            nf = 1  # label found
+            with open(lb_file, 'r') as f:
+                l = [x.split() for x in f.read().strip().splitlines()]
+                if any([len(x) > 8 for x in l]):  # is segment
+                    classes = np.array([x[0] for x in l], dtype=np.float32)
+                    segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+                    l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+                l = np.array(l, dtype=np.float32)
+            if len(l):
+                assert l.shape[1] == 5, 'labels require 5 columns each'
+                assert (l >= 0).all(), 'negative labels'
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+                assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            else:
+                ne = 1  # label empty
+                l = np.zeros((0, 5), dtype=np.float32)
+        else:
+            nm = 1  # label missing
+            l = np.zeros((0, 5), dtype=np.float32)
+        return im_file, l, shape, segments, stat, nm, nf, ne, nc, ''
+    except Exception as e:
+        nc = 1
+        return None, None, None, None, stat, nm, nf, ne, nc, f'WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+
+
 # Ancillary functions --------------------------------------------------------------------------------------------------
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
+    if getattr(self, 'img_shard', None) is not None:  # packed mmap cache, zero-copy read-only view
+        if self.img_mmap is None:
+            self.img_mmap = np.memmap(self.img_shard, dtype=np.uint8, mode='r')  # opened once per process
+        o, h0, w0, h, w, c = self.img_index[index]
+        return self.img_mmap[o:o + h * w * c].reshape(h, w, c), (h0, w0), (h, w)
     img = self.imgs[index]
     if img is None:  # not cached
         path = self.img_files[index]
@@ -894,6 +993,78 @@ def load_samples(self, index):
     return sample_labels, sample_images, sample_masks
 
 
+def draw_paste_in_samples(self, k):
+    # crops for paste_in without the pool: mosaics are built until k crops are collected
+    sample_labels, sample_images, sample_masks = [], [], []
+    while len(sample_labels) < k:
+        sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
+        sample_labels += sample_labels_
+        sample_images += sample_images_
+        sample_masks += sample_masks_
+        if len(sample_labels) == 0:
+            break
+    return sample_labels, sample_images, sample_masks
+
+
+class PasteInPool:
+    # Bounded pool of pre-extracted instance crops (label, image, mask) for paste_in augmentation.
+    # A background thread fills the pool with load_samples() and refreshes it at `refresh` mosaics per draw,
+    # so __getitem__ draws crops instead of building mosaics until 30 samples are collected
+    def __init__(self, dataset, size=600, refresh=0.25, min_samples=30, max_empty=20):
+        self.dataset = dataset
+        self.pid = os.getpid()
+        self.samples = deque(maxlen=size)  # oldest crops are dropped first
+        self.refresh = refresh
+        self.min_samples = min_samples
+        self.max_empty = max_empty  # consecutive mosaics without segments -> dataset has no segments
+        self.credit = 0.0
+        self.lock = Lock()
+        self.ready = Event()  # min_samples in the pool, or no segments in the dataset
+        self.wakeup = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        empty = 0
+        while True:
+            with self.lock:
+                full = len(self.samples) == self.samples.maxlen
+                if full and self.credit < 1:
+                    self.wakeup.clear()
+            if full and self.credit < 1:
+                self.wakeup.wait()
+                continue
+
+            try:
+                labels, images, masks = load_samples(self.dataset, random.randint(0, len(self.dataset.labels) - 1))
+            except Exception as e:
+                logger.warning(f'PasteInPool: failed to load samples ({e})')
+                labels, images, masks = [], [], []
+            with self.lock:
+                self.samples.extend(zip(labels, images, masks))
+                self.credit = max(self.credit - 1, 0)
+                n = len(self.samples)
+
+            empty = empty + 1 if n == 0 else 0
+            if n >= self.min_samples or empty >= self.max_empty:
+                self.ready.set()
+            if n == 0 and empty >= self.max_empty:
+                return  # no segments in this dataset, paste_in is a no-op
+
+    def draw(self, k):
+        # returns sample_labels, sample_images, sample_masks with up to k crops
+        self.ready.wait()
+        with self.lock:
+            samples = random.sample(list(self.samples), min(k, len(self.samples)))
+            self.credit += self.refresh
+        if self.credit >= 1:
+            self.wakeup.set()
+        if not samples:
+            return [], [], []
+        sample_labels, sample_images, sample_masks = map(list, zip(*samples))
+        return sample_labels, sample_images, sample_masks
+
+
 def copy_paste(img, labels, segments, probability=0.5):
     # Implement Copy-Paste augmentation https://arxiv.org/abs/2012.07177, labels as nx5 np.array(cls, xyxy)
     n = len(segments)
@@ -953,16 +1124,18 @@ def sample_segments(img, labels, segments, probability=0.5):
             
             sample_labels.append(l[0])
             
-            mask = np.zeros(img.shape, np.uint8)
+            # draw the mask of the box region only (offset), not of the whole mosaic
+            mask = np.zeros((box[3] - box[1], box[2] - box[0], c), np.uint8)
             
-            cv2.drawContours(mask, [segments[j].astype(np.int32)], -1, (255, 255, 255), cv2.FILLED)
-            sample_masks.append(mask[box[1]:box[3],box[0]:box[2],:])
+            cv2.drawContours(mask, [segments[j].astype(np.int32)], -1, (255, 255, 255), cv2.FILLED,
+                             offset=(-int(box[0]), -int(box[1])))
+            sample_masks.append(mask)
             
-            result = cv2.bitwise_and(src1=img, src2=mask)
+            result = cv2.bitwise_and(src1=np.ascontiguousarray(img[box[1]:box[3],box[0]:box[2],:]), src2=mask)
             i = result > 0  # pixels to replace
             mask[i] = result[i]  # cv2.imwrite('debug.jpg', img)  # debug
             #print(box)
-            sample_images.append(mask[box[1]:box[3],box[0]:box[2],:])
+            sample_images.append(mask)
 
     return sample_labels, sample_images, sample_masks
 
@@ -1321,3 +1494,46 @@ def load_segmentations(self, index):
     #print(key)
     # /work/handsomejw66/coco17/
     return self.segs[key]
+
+
+def benchmark_paste_in(path, hyp='data/hyp.scratch.p5.yaml', img_size=640, n=200, seed=0):
+    """ Time LoadImagesAndLabels.__getitem__ at paste_in=1 with and without the PasteInPool
+    (one process, as in one dataloader worker)
+    Usage: python utils/datasets.py --data ../coco/train2017.txt
+    Arguments
+        path:     Images (dir, file or txt list with segments labels)
+        hyp:      Hyperparameters yaml, paste_in is set to 1
+        n:        Number of images loaded per setting
+    """
+    import yaml
+    with open(hyp) as f:
+        hyp = yaml.load(f, Loader=yaml.SafeLoader)
+    hyp['paste_in'] = 1.0
+    dataset = LoadImagesAndLabels(path, img_size, augment=True, hyp=hyp)
+
+    print(f'{"paste_in":>12}{"images":>10}{"img/s":>10}{"ms/img":>10}')
+    for use_pool in (False, True):
+        dataset.use_paste_in_pool = use_pool
+        if use_pool:
+            t = time.time()
+            pool = dataset.get_paste_in_pool()
+            pool.ready.wait()
+            print(f'PasteInPool ready in {time.time() - t:.2f}s ({len(pool.samples)} crops)')
+        random.seed(seed)
+        np.random.seed(seed)
+        t = time.time()
+        for i in range(n):
+            dataset[i % len(dataset)]
+        dt = time.time() - t
+        print(f'{"pool" if use_pool else "mosaics":>12}{n:>10}{n / dt:>10.1f}{dt / n * 1E3:>10.1f}')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, required=True, help='images with segments labels')
+    parser.add_argument('--hyp', type=str, default='data/hyp.scratch.p5.yaml', help='hyperparameters path')
+    parser.add_argument('--img-size', type=int, default=640, help='image size')
+    parser.add_argument('--n', type=int, default=200, help='images loaded per setting')
+    opt = parser.parse_args()
+    benchmark_paste_in(opt.data, opt.hyp, opt.img_size, opt.n)
@@ -608,12 +608,14 @@ def box_diou(box1, box2, eps: float = 1e-7):
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
+                        labels=(), batched=False):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
+    if batched:
+        return non_max_suppression_batched(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels)
 
     nc = prediction.shape[2] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
@@ -702,6 +704,85 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def topk_per_image(bi, scores, k, bs):
+    # indices of the k highest scores of every image, sorted by image and then by descending score
+    order = scores.argsort(descending=True)
+    order = order[bi[order].sort(stable=True)[1]]
+    b = bi[order]
+    n = torch.bincount(b, minlength=bs)
+    rank = torch.arange(b.shape[0], device=b.device) - (n.cumsum(0) - n)[b]  # rank within the image
+    return order[rank < k]
+
+
+def non_max_suppression_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, labels=()):
+    """Runs Non-Maximum Suppression (NMS) on the whole batch with a single NMS call
+    Boxes are offset by image index and class, so they only suppress boxes of the same image (and class)
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+
+    # Settings
+    max_det = 300  # maximum number of detections per image
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    multi_label &= nc > 1  # multiple labels per box
+
+    output = [torch.zeros((0, 6), device=prediction.device)] * bs
+    bi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image, anchor indices of candidates
+    x = prediction[bi, ai]  # confidence
+
+    # Cat apriori labels if autolabelling
+    if labels and sum(len(l) for l in labels):
+        l = torch.cat([l for l in labels if len(l)], 0)
+        v = torch.zeros((len(l), nc + 5), device=x.device, dtype=x.dtype)
+        v[:, :4] = l[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+        li = torch.cat([torch.full((len(l),), i, device=x.device, dtype=bi.dtype) for i, l in enumerate(labels)])
+        x, bi = torch.cat((x, v), 0), torch.cat((bi, li), 0)
+
+    # Compute conf
+    if nc == 1:
+        x[:, 5:] = x[:, 4:5]  # for models with one class, cls_conf is always 0.5
+    else:
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, bi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), bi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, bi = torch.cat((box, conf, j.float()), 1)[i], bi[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, bi = x[i], bi[i]
+
+    if not x.shape[0]:  # no boxes
+        return output
+    i = topk_per_image(bi, x[:, 4], max_nms, bs)  # excess boxes
+    x, bi = x[i], bi[i]
+
+    # Batched NMS, boxes offset by (image, class) group (float64 keeps the offset boxes exact)
+    group = bi if agnostic else bi * max(nc, 1) + x[:, 5].long()
+    boxes, scores = x[:, :4].double(), x[:, 4].double()
+    boxes = boxes + (group * (boxes.max() + 1))[:, None]
+    i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+    i = i[topk_per_image(bi[i], scores[i], max_det, bs)]  # limit detections per image
+
+    n = torch.bincount(bi[i], minlength=bs).tolist()
+    return list(x[i].split(n))
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, nc=None, nkpt=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
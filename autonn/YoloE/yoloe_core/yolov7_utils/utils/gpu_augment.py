@@ -0,0 +1,237 @@
+# GPU batched augmentation
+# Mosaic, random perspective, mixup, HSV and flips applied as batched tensor ops on the training device.
+# Used with gpu_augment: True, the dataloader workers then only decode and letterbox (LoadImagesAndLabels)
+
+import math
+import random
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+from general import xywhn2xyxy, xyxy2xywh
+
+FILL = 114 / 255.0  # border value of mosaic / perspective (same as cv2 borderValue=(114, 114, 114))
+
+
+def rgb_to_hsv(img, eps=1e-8):
+    # img (b,3,h,w) RGB 0-1 -> HSV 0-1
+    r, g, b = img.unbind(1)
+    maxc, _ = img.max(1)
+    minc, _ = img.min(1)
+    delta = maxc - minc
+    s = delta / maxc.clamp(min=eps)
+    deltac = delta.clamp(min=eps)
+    rc, gc, bc = (maxc - r) / deltac, (maxc - g) / deltac, (maxc - b) / deltac
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta > 0, (h / 6.0) % 1.0, torch.zeros_like(h))
+    return torch.stack((h, s, maxc), 1)
+
+
+def hsv_to_rgb(hsv):
+    # hsv (b,3,h,w) 0-1 -> RGB 0-1
+    h, s, v = hsv.unbind(1)
+    out = []
+    for n in (5, 3, 1):  # r, g, b
+        k = (n + h * 6) % 6
+        out.append(v - v * s * torch.clamp(torch.minimum(k, 4 - k), 0, 1))
+    return torch.stack(out, 1)
+
+
+def random_perspective_matrix(size, out_size, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0):
+    # Same random transform as datasets.random_perspective, input image size -> output image size (pixels)
+    C = np.eye(3)
+    C[0, 2] = -size / 2  # x translation (pixels)
+    C[1, 2] = -size / 2  # y translation (pixels)
+
+    P = np.eye(3)
+    P[2, 0] = random.uniform(-perspective, perspective)  # x perspective (about y)
+    P[2, 1] = random.uniform(-perspective, perspective)  # y perspective (about x)
+
+    R = np.eye(3)
+    a = random.uniform(-degrees, degrees)
+    s = random.uniform(1 - scale, 1.1 + scale)
+    a_rad = math.radians(a)
+    R[0, :2] = s * math.cos(a_rad), s * math.sin(a_rad)  # cv2.getRotationMatrix2D(angle=a, center=(0, 0), scale=s)
+    R[1, :2] = -s * math.sin(a_rad), s * math.cos(a_rad)
+
+    S = np.eye(3)
+    S[0, 1] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # x shear (deg)
+    S[1, 0] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # y shear (deg)
+
+    T = np.eye(3)
+    T[0, 2] = random.uniform(0.5 - translate, 0.5 + translate) * out_size  # x translation (pixels)
+    T[1, 2] = random.uniform(0.5 - translate, 0.5 + translate) * out_size  # y translation (pixels)
+
+    return T @ S @ R @ P @ C, s  # order of operations (right to left) is IMPORTANT
+
+
+def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  # box1(n,4), box2(n,4)
+    # Same as datasets.box_candidates for (n,4) tensors
+    w1, h1 = box1[:, 2] - box1[:, 0], box1[:, 3] - box1[:, 1]
+    w2, h2 = box2[:, 2] - box2[:, 0], box2[:, 3] - box2[:, 1]
+    ar = torch.maximum(w2 / (h2 + eps), h2 / (w2 + eps))  # aspect ratio
+    return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)  # candidates
+
+
+class GPUAugment:
+    # Batched version of the LoadImagesAndLabels augmentation pipeline
+    # imgs (b,3,s,s) float 0-1 RGB letterboxed, targets (n,6) [image, class, x, y, w, h] normalized
+    def __init__(self, hyp, img_size, chunk=16):
+        self.hyp = hyp
+        self.img_size = img_size
+        self.chunk = chunk  # images per mosaic canvas / warp (canvas memory is 4x the image batch)
+
+    def __call__(self, imgs, targets):
+        hyp = self.hyp
+        b, s = imgs.shape[0], imgs.shape[2]
+        assert imgs.shape[2] == imgs.shape[3], 'gpu augmentation requires square letterboxed images'
+        targets = targets.to(imgs.device)
+
+        # Per image labels (cls, xyxy pixels of the letterboxed image)
+        labels = []
+        for i in range(b):
+            l = targets[targets[:, 0] == i, 1:].clone()
+            l[:, 1:] = xywhn2xyxy(l[:, 1:], s, s)
+            labels.append(l)
+
+        # Mosaic + random perspective
+        mosaic = [random.random() < hyp['mosaic'] for _ in range(b)]
+        out, out_labels = [], []
+        for i0 in range(0, b, self.chunk):
+            idx = range(i0, min(i0 + self.chunk, b))
+            canvas = imgs.new_full((len(idx), imgs.shape[1], 2 * s, 2 * s), FILL)
+            ms, scales, canvas_labels = [], [], []
+            for j, i in enumerate(idx):
+                if mosaic[i]:
+                    canvas_labels.append(self.place_mosaic(canvas[j], imgs, labels, i, s))
+                    M, sc = self.random_matrix(2 * s, s)  # border = -s / 2
+                else:
+                    canvas[j, :, :s, :s] = imgs[i]
+                    canvas_labels.append(labels[i])
+                    M, sc = self.random_matrix(s, s)
+                ms.append(M)
+                scales.append(sc)
+            M = torch.tensor(np.stack(ms), dtype=imgs.dtype, device=imgs.device)
+            out.append(self.warp(canvas, M, s))
+            out_labels += self.warp_labels(canvas_labels, M, scales, s)
+        imgs = torch.cat(out, 0)
+        labels = out_labels
+
+        # MixUp https://arxiv.org/pdf/1710.09412.pdf (partner mosaic from the same batch)
+        mosaic_idx = [i for i in range(b) if mosaic[i]]
+        if len(mosaic_idx) > 1 and hyp['mixup'] > 0:
+            mixed = imgs.clone()
+            base = list(labels)  # labels of the unmixed images
+            for i in mosaic_idx:
+                if random.random() < hyp['mixup']:
+                    k = random.choice([x for x in mosaic_idx if x != i])
+                    r = np.random.beta(8.0, 8.0)  # mixup ratio, alpha=beta=8.0
+                    mixed[i] = imgs[i] * r + imgs[k] * (1 - r)
+                    labels[i] = torch.cat((labels[i], base[k]), 0)
+            imgs = mixed
+
+        # HSV
+        gains = torch.empty((b, 3), device=imgs.device).uniform_(-1, 1) * \
+                torch.tensor([hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']], device=imgs.device) + 1  # random gains
+        hsv = rgb_to_hsv(imgs)
+        hsv = torch.stack(((hsv[:, 0] * gains[:, 0, None, None]) % 1.0,
+                           (hsv[:, 1] * gains[:, 1, None, None]).clamp(0, 1),
+                           (hsv[:, 2] * gains[:, 2, None, None]).clamp(0, 1)), 1)
+        imgs = hsv_to_rgb(hsv)
+
+        # Labels to normalized xywh
+        rows = []
+        for i, l in enumerate(labels):
+            if len(l):
+                xywh = xyxy2xywh(l[:, 1:5]) / s
+                rows.append(torch.cat((torch.full_like(l[:, :1], i), l[:, :1], xywh), 1))
+        targets = torch.cat(rows, 0) if rows else targets.new_zeros((0, 6))
+
+        # Flips
+        for key, dim, col in (('flipud', 2, 3), ('fliplr', 3, 2)):
+            if hyp[key] > 0:
+                flip = torch.rand(b, device=imgs.device) < hyp[key]
+                imgs = torch.where(flip[:, None, None, None], imgs.flip(dim), imgs)
+                if len(targets):
+                    t_flip = flip[targets[:, 0].long()]
+                    targets[t_flip, col] = 1 - targets[t_flip, col]
+
+        return imgs.contiguous(), targets
+
+    def random_matrix(self, size, out_size):
+        hyp = self.hyp
+        return random_perspective_matrix(size, out_size,
+                                         degrees=hyp['degrees'],
+                                         translate=hyp['translate'],
+                                         scale=hyp['scale'],
+                                         shear=hyp['shear'],
+                                         perspective=hyp['perspective'])
+
+    @staticmethod
+    def place_mosaic(img4, imgs, labels, index, s):
+        # Same placement as datasets.load_mosaic, images of the batch are s x s letterboxed
+        yc, xc = [int(random.uniform(s // 2, 2 * s - s // 2)) for _ in range(2)]  # mosaic center x, y
+        indices = [index] + random.choices(range(imgs.shape[0]), k=3)  # 3 additional images of the batch
+        labels4 = []
+        w = h = s
+        for i, k in enumerate(indices):
+            if i == 0:  # top left
+                x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc
+                x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h
+            elif i == 1:  # top right
+                x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
+                x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+            elif i == 2:  # bottom left
+                x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
+                x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+            else:  # bottom right
+                x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
+                x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+
+            img4[:, y1a:y2a, x1a:x2a] = imgs[k, :, y1b:y2b, x1b:x2b]
+            l = labels[k].clone()
+            l[:, [1, 3]] += x1a - x1b  # padw
+            l[:, [2, 4]] += y1a - y1b  # padh
+            labels4.append(l)
+
+        labels4 = torch.cat(labels4, 0)
+        labels4[:, 1:].clamp_(0, 2 * s)  # clip when using random_perspective()
+        return labels4
+
+    @staticmethod
+    def warp(canvas, M, s):
+        # cv2.warpPerspective(canvas, M, dsize=(s, s), borderValue=114) for a batch of matrices
+        n, _, hc, wc = canvas.shape
+        y, x = torch.meshgrid(torch.arange(s, device=canvas.device, dtype=canvas.dtype),
+                              torch.arange(s, device=canvas.device, dtype=canvas.dtype))
+        xy = torch.stack((x, y, torch.ones_like(x)), -1).view(1, -1, 3)  # output pixels
+        src = xy @ torch.inverse(M).transpose(1, 2)  # output -> canvas
+        src = src[..., :2] / src[..., 2:3]
+        grid = torch.stack(((2 * src[..., 0] + 1) / wc - 1, (2 * src[..., 1] + 1) / hc - 1), -1).view(n, s, s, 2)
+        return F.grid_sample(canvas - FILL, grid, mode='bilinear', padding_mode='zeros', align_corners=False) + FILL
+
+    @staticmethod
+    def warp_labels(labels, M, scales, s):
+        # Same box transform, clip and candidate filter as datasets.random_perspective (boxes, no segments)
+        out = []
+        for l, m, sc in zip(labels, M, scales):
+            n = len(l)
+            if not n:
+                out.append(l)
+                continue
+            xy = torch.ones((n * 4, 3), dtype=m.dtype, device=m.device)
+            xy[:, :2] = l[:, [1, 2, 3, 4, 1, 4, 3, 2]].reshape(n * 4, 2).to(m.dtype)  # x1y1, x2y2, x1y2, x2y1
+            xy = xy @ m.T  # transform
+            xy = (xy[:, :2] / xy[:, 2:3]).reshape(n, 8)  # perspective rescale or affine
+            x, y = xy[:, [0, 2, 4, 6]], xy[:, [1, 3, 5, 7]]
+            new = torch.stack((x.min(1)[0], y.min(1)[0], x.max(1)[0], y.max(1)[0]), 1).clamp(0, s)  # clip
+            i = box_candidates(box1=l[:, 1:5] * sc, box2=new, area_thr=0.10)
+            l = l[i]
+            l[:, 1:5] = new[i].to(l.dtype)
+            out.append(l)
+        return out
+
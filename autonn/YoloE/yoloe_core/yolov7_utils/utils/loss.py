@@ -556,6 +556,143 @@ class ComputeLoss:
         return tcls, tbox, indices, anch
 
 
+def decode_candidates(fg_pred, gi, gj, anch, stride):
+    # Candidate boxes (xyxy pixels), objectness and class logits of (x, y, w, h, obj, cls...) predictions
+    grid = torch.stack([gi, gj], dim=1)
+    pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * stride
+    pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch * stride
+    pxyxy = xywh2xyxy(torch.cat([pxy, pwh], dim=-1))
+    return pxyxy, fg_pred[:, 4:5], fg_pred[:, 5:]
+
+
+def build_targets_simota(p, targets, imgs, indices, anch, decode, nc, n_candidates=10):
+    # Batched SimOTA assignment (ComputeLossOTA, ComputeLossBinOTA, ComputeLossAuxOTA)
+    # Targets and candidate predictions are padded per image, so the iou/cost/dynamic-k matching of the whole
+    # batch is a few tensor ops instead of a loop over images. Same assignment as the per-image loop:
+    # candidates are ordered by image, then layer, then candidate index
+    device = targets.device
+    nl, bs = len(p), p[0].shape[0]
+
+    with torch.no_grad():
+        # candidates of all layers
+        cand_b, cand_a, cand_gj, cand_gi, cand_anch, cand_layer, pxyxys, p_obj, p_cls = [], [], [], [], [], [], [], [], []
+        for i, pi in enumerate(p):
+            b, a, gj, gi = indices[i]
+            pxyxy, obj, cls = decode(i, pi[b, a, gj, gi], gi, gj, anch[i])
+            cand_b.append(b)
+            cand_a.append(a)
+            cand_gj.append(gj)
+            cand_gi.append(gi)
+            cand_anch.append(anch[i])
+            cand_layer.append(torch.full_like(b, i))
+            pxyxys.append(pxyxy)
+            p_obj.append(obj)
+            p_cls.append(cls)
+        cand_b, cand_a, cand_gj, cand_gi = torch.cat(cand_b), torch.cat(cand_a), torch.cat(cand_gj), torch.cat(cand_gi)
+        cand_anch, cand_layer = torch.cat(cand_anch), torch.cat(cand_layer)
+        pxyxys, p_obj, p_cls = torch.cat(pxyxys), torch.cat(p_obj), torch.cat(p_cls)
+
+        matched = None
+        if len(targets) and len(cand_b):
+            # pad candidates per image -> (bs, P)
+            c_order, c_pos, P = pad_index(cand_b, bs)
+            c_b = cand_b[c_order]
+            cand_idx = torch.full((bs, P), -1, dtype=torch.long, device=device)
+            cand_idx[c_b, c_pos] = c_order
+            c_valid = cand_idx >= 0
+            boxes = torch.zeros((bs, P, 4), device=device)
+            boxes[c_b, c_pos] = pxyxys[c_order].float()
+
+            # pad targets per image -> (bs, G)
+            t_b = targets[:, 0].long()
+            t_order, t_pos, G = pad_index(t_b, bs)
+            t_b = t_b[t_order]
+            gt_idx = torch.full((bs, G), -1, dtype=torch.long, device=device)
+            gt_idx[t_b, t_pos] = t_order
+            t_valid = gt_idx >= 0
+            gt_boxes = torch.zeros((bs, G, 4), device=device)
+            gt_boxes[t_b, t_pos] = xywh2xyxy(targets[t_order, 2:6] * imgs.shape[2]).float()
+            gt_cls = torch.zeros((bs, G), dtype=torch.long, device=device)
+            gt_cls[t_b, t_pos] = targets[t_order, 1].long()
+
+            valid = t_valid[:, :, None] & c_valid[:, None, :]  # (bs, G, P)
+            pair_wise_iou = box_iou_batch(gt_boxes, boxes).masked_fill(~valid, 0.)
+            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+
+            top_k, _ = torch.topk(pair_wise_iou, min(n_candidates, P), dim=2)
+            dynamic_ks = torch.clamp(top_k.sum(2).int(), min=1)
+
+            # class cost: BCE(logit(y), one_hot(gt_cls)).sum(-1) = sum_c bce(y_c, 0) - bce(y_k, 0) + bce(y_k, 1)
+            y = (p_cls.float().sigmoid() * p_obj.float().sigmoid()).sqrt()
+            logit = torch.log(y / (1 - y))
+            bce0 = F.binary_cross_entropy_with_logits(logit, torch.zeros_like(logit), reduction='none')
+            bce1 = F.binary_cross_entropy_with_logits(logit, torch.ones_like(logit), reduction='none')
+            bce0_sum = torch.zeros((bs, P), device=device)
+            bce0_sum[c_b, c_pos] = bce0.sum(1)[c_order]
+            bce_diff = torch.zeros((bs, P, nc), device=device)
+            bce_diff[c_b, c_pos] = (bce1 - bce0)[c_order]
+            pair_wise_cls_loss = bce0_sum[:, None, :] + \
+                torch.gather(bce_diff.transpose(1, 2), 1, gt_cls[:, :, None].expand(-1, -1, P))
+
+            cost = (pair_wise_cls_loss + 3.0 * pair_wise_iou_loss).masked_fill(~valid, float('inf'))
+
+            # dynamic k lowest costs per target
+            k_max = int(dynamic_ks.max())
+            _, pos_idx = torch.topk(cost, k=min(k_max, P), dim=2, largest=False)
+            selected = (torch.arange(pos_idx.shape[2], device=device) < dynamic_ks[:, :, None]).float()
+            matching_matrix = torch.zeros_like(cost).scatter_(2, pos_idx, selected)
+            matching_matrix *= valid
+
+            # candidates matched to several targets keep the lowest cost target
+            anchor_matching_gt = matching_matrix.sum(1)
+            multiple = anchor_matching_gt > 1
+            if multiple.any():
+                cost_argmin = cost.argmin(1)
+                one_hot = F.one_hot(cost_argmin, G).transpose(1, 2).float()
+                matching_matrix = torch.where(multiple[:, None, :], one_hot, matching_matrix)
+            fg_mask_inboxes = matching_matrix.sum(1) > 0.0
+            matched_gt_inds = matching_matrix.argmax(1)
+
+            # (image, padded position) order = image, layer, candidate index
+            fg_b, fg_pos = fg_mask_inboxes.nonzero(as_tuple=True)
+            matched = cand_idx[fg_b, fg_pos], gt_idx[fg_b, matched_gt_inds[fg_b, fg_pos]]
+
+    matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs = [], [], [], [], [], []
+    for i in range(nl):
+        if matched is not None:
+            c, t = matched
+            layer_idx = cand_layer[c] == i
+            c, t = c[layer_idx], t[layer_idx]
+        else:
+            c = t = torch.zeros(0, dtype=torch.long, device=device)
+        matching_bs.append(cand_b[c])
+        matching_as.append(cand_a[c])
+        matching_gjs.append(cand_gj[c])
+        matching_gis.append(cand_gi[c])
+        matching_targets.append(targets[t])
+        matching_anchs.append(cand_anch[c])
+
+    return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs
+
+
+def pad_index(b, bs):
+    # stable order by image, position within the image and max count, to scatter rows into (bs, n_max)
+    order = torch.argsort(b * len(b) + torch.arange(len(b), device=b.device))
+    counts = torch.bincount(b, minlength=bs)
+    starts = torch.cumsum(counts, 0) - counts
+    pos = torch.arange(len(b), device=b.device) - starts[b[order]]
+    return order, pos, max(int(counts.max()), 1)
+
+
+def box_iou_batch(box1, box2):
+    # box_iou() for padded batches, box1 (b,n,4), box2 (b,m,4) xyxy -> iou (b,n,m)
+    area1 = (box1[..., 2] - box1[..., 0]) * (box1[..., 3] - box1[..., 1])
+    area2 = (box2[..., 2] - box2[..., 0]) * (box2[..., 3] - box2[..., 1])
+    inter = (torch.min(box1[:, :, None, 2:], box2[:, None, :, 2:]) -
+             torch.max(box1[:, :, None, :2], box2[:, None, :, :2])).clamp(0).prod(3)
+    return inter / (area1[:, :, None] + area2[:, None, :] - inter)
+
+
 class ComputeLossOTA:
     # Compute losses
     def __init__(self, model, autobalance=False):
@@ -645,155 +782,10 @@ class ComputeLossOTA:
         #indices, anch = self.find_4_positive(p, targets)
         #indices, anch = self.find_5_positive(p, targets)
         #indices, anch = self.find_9_positive(p, targets)
-        device = torch.device(targets.device)
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append((torch.ones(size=(len(b),)) * i).to(device))
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, 4:5])
-                p_cls.append(fg_pred[:, 5:])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device=device)
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = (matching_matrix.sum(0) > 0.0).to(device)
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
+        return build_targets_simota(p, targets, imgs, indices, anch, self.decode_candidates, self.nc)
 
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs           
+    def decode_candidates(self, i, fg_pred, gi, gj, anch):
+        return decode_candidates(fg_pred, gi, gj, anch, self.stride[i])
 
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
@@ -968,159 +960,17 @@ class ComputeLossBinOTA:
         #indices, anch = self.find_4_positive(p, targets)
         #indices, anch = self.find_5_positive(p, targets)
         #indices, anch = self.find_9_positive(p, targets)
-
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                obj_idx = self.wh_bin_sigmoid.get_length()*2 + 2
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, obj_idx:(obj_idx+1)])
-                p_cls.append(fg_pred[:, (obj_idx+1):])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pw = self.wh_bin_sigmoid.forward(fg_pred[..., 2:(3+self.bin_count)].sigmoid()) * anch[i][idx][:, 0] * self.stride[i]
-                ph = self.wh_bin_sigmoid.forward(fg_pred[..., (3+self.bin_count):obj_idx].sigmoid()) * anch[i][idx][:, 1] * self.stride[i]
-                
-                pxywh = torch.cat([pxy, pw.unsqueeze(1), ph.unsqueeze(1)], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]            
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost)
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = matching_matrix.sum(0) > 0.0
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs       
+        return build_targets_simota(p, targets, imgs, indices, anch, self.decode_candidates, self.nc)
+
+    def decode_candidates(self, i, fg_pred, gi, gj, anch):
+        # x, y, w-bins, h-bins, obj, cls
+        obj_idx = self.wh_bin_sigmoid.get_length()*2 + 2
+        grid = torch.stack([gi, gj], dim=1)
+        pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
+        pw = self.wh_bin_sigmoid.forward(fg_pred[..., 2:(3+self.bin_count)].sigmoid()) * anch[:, 0] * self.stride[i]
+        ph = self.wh_bin_sigmoid.forward(fg_pred[..., (3+self.bin_count):obj_idx].sigmoid()) * anch[:, 1] * self.stride[i]
+        pxyxy = xywh2xyxy(torch.cat([pxy, pw.unsqueeze(1), ph.unsqueeze(1)], dim=-1))
+        return pxyxy, fg_pred[:, obj_idx:(obj_idx+1)], fg_pred[:, (obj_idx+1):]
 
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
@@ -1290,308 +1140,15 @@ class ComputeLossAuxOTA:
     def build_targets(self, p, targets, imgs):
         
         indices, anch = self.find_3_positive(p, targets)
+        return build_targets_simota(p, targets, imgs, indices, anch, self.decode_candidates, self.nc, n_candidates=20)
 
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, 4:5])
-                p_cls.append(fg_pred[:, 5:])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(20, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device='cpu')
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = matching_matrix.sum(0) > 0.0
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs
+    def decode_candidates(self, i, fg_pred, gi, gj, anch):
+        return decode_candidates(fg_pred, gi, gj, anch, self.stride[i])
 
     def build_targets2(self, p, targets, imgs):
         
         indices, anch = self.find_5_positive(p, targets)
-
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, 4:5])
-                p_cls.append(fg_pred[:, 5:])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(20, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device='cpu')
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = matching_matrix.sum(0) > 0.0
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs              
+        return build_targets_simota(p, targets, imgs, indices, anch, self.decode_candidates, self.nc, n_candidates=20)
 
     def find_5_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
@@ -1698,3 +1255,135 @@ class ComputeLossAuxOTA:
             anch.append(anchors[a])  # anchors
 
         return indices, anch
+
+
+def build_targets_simota_per_image(p, targets, imgs, indices, anch, decode, nc, n_candidates=10):
+    # Reference SimOTA assignment with a loop over the images (the assignment build_targets_simota replaces),
+    # kept for check_build_targets_simota
+    device = targets.device
+    nl = len(p)
+    matching_bs = [[] for pp in p]
+    matching_as = [[] for pp in p]
+    matching_gjs = [[] for pp in p]
+    matching_gis = [[] for pp in p]
+    matching_targets = [[] for pp in p]
+    matching_anchs = [[] for pp in p]
+
+    for batch_idx in range(p[0].shape[0]):
+        b_idx = targets[:, 0] == batch_idx
+        this_target = targets[b_idx]
+        if this_target.shape[0] == 0:
+            continue
+        txyxy = xywh2xyxy(this_target[:, 2:6] * imgs[batch_idx].shape[1])
+
+        pxyxys, p_cls, p_obj, from_which_layer = [], [], [], []
+        all_b, all_a, all_gj, all_gi, all_anch = [], [], [], [], []
+        for i, pi in enumerate(p):
+            b, a, gj, gi = indices[i]
+            idx = (b == batch_idx)
+            b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]
+            all_b.append(b)
+            all_a.append(a)
+            all_gj.append(gj)
+            all_gi.append(gi)
+            all_anch.append(anch[i][idx])
+            from_which_layer.append(torch.full_like(b, i))
+            pxyxy, obj, cls = decode(i, pi[b, a, gj, gi], gi, gj, anch[i][idx])
+            pxyxys.append(pxyxy)
+            p_obj.append(obj)
+            p_cls.append(cls)
+
+        pxyxys = torch.cat(pxyxys, dim=0)
+        if pxyxys.shape[0] == 0:
+            continue
+        p_obj, p_cls = torch.cat(p_obj, dim=0), torch.cat(p_cls, dim=0)
+        from_which_layer = torch.cat(from_which_layer, dim=0)
+        all_b, all_a, all_gj, all_gi = torch.cat(all_b), torch.cat(all_a), torch.cat(all_gj), torch.cat(all_gi)
+        all_anch = torch.cat(all_anch, dim=0)
+
+        pair_wise_iou = box_iou(txyxy, pxyxys)
+        pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+
+        top_k, _ = torch.topk(pair_wise_iou, min(n_candidates, pair_wise_iou.shape[1]), dim=1)
+        dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
+
+        num_gt = this_target.shape[0]
+        gt_cls_per_image = F.one_hot(this_target[:, 1].to(torch.int64), nc).float() \
+            .unsqueeze(1).repeat(1, pxyxys.shape[0], 1)
+        cls_preds_ = p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_() * \
+            p_obj.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
+        y = cls_preds_.sqrt_()
+        pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
+            torch.log(y / (1 - y)), gt_cls_per_image, reduction="none").sum(-1)
+
+        cost = pair_wise_cls_loss + 3.0 * pair_wise_iou_loss
+
+        matching_matrix = torch.zeros_like(cost, device=device)
+        for gt_idx in range(num_gt):
+            _, pos_idx = torch.topk(cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False)
+            matching_matrix[gt_idx][pos_idx] = 1.0
+
+        anchor_matching_gt = matching_matrix.sum(0)
+        if (anchor_matching_gt > 1).sum() > 0:
+            _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
+            matching_matrix[:, anchor_matching_gt > 1] *= 0.0
+            matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
+        fg_mask_inboxes = matching_matrix.sum(0) > 0.0
+        matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
+
+        from_which_layer = from_which_layer[fg_mask_inboxes]
+        this_target = this_target[matched_gt_inds]
+        for i in range(nl):
+            layer_idx = from_which_layer == i
+            matching_bs[i].append(all_b[fg_mask_inboxes][layer_idx])
+            matching_as[i].append(all_a[fg_mask_inboxes][layer_idx])
+            matching_gjs[i].append(all_gj[fg_mask_inboxes][layer_idx])
+            matching_gis[i].append(all_gi[fg_mask_inboxes][layer_idx])
+            matching_targets[i].append(this_target[layer_idx])
+            matching_anchs[i].append(all_anch[fg_mask_inboxes][layer_idx])
+
+    empty = torch.zeros(0, dtype=torch.long, device=device)
+    cat = lambda x, e=empty: torch.cat(x, dim=0) if x else e
+    return [cat(x) for x in matching_bs], [cat(x) for x in matching_as], [cat(x) for x in matching_gjs], \
+        [cat(x) for x in matching_gis], [cat(x, targets[:0]) for x in matching_targets], \
+        [cat(x, anch[i][:0]) for i, x in enumerate(matching_anchs)]
+
+
+def check_build_targets_simota(trials=50, bs=6, nc=5, na=3, img_size=128, strides=(8, 16, 32), seed=0):
+    """ Compare build_targets_simota with the per-image loop on random predictions and targets
+    Every batch has an image without targets and an image whose targets have no candidates
+    Usage: python utils/loss.py
+    """
+    torch.manual_seed(seed)
+    for trial in range(trials):
+        p, indices, anch = [], [], []
+        for s in strides:
+            ny = nx = img_size // s
+            p.append(torch.randn(bs, na, ny, nx, 5 + nc) * 2)
+            m = int(torch.randint(0, 40, (1,)))  # candidates of the layer (0: none)
+            b = torch.randint(0, bs - 2, (m,)) + 1  # image 0 has no targets, image bs - 1 no candidates
+            indices.append((b, torch.randint(0, na, (m,)), torch.randint(0, ny, (m,)), torch.randint(0, nx, (m,))))
+            anch.append(torch.rand(m, 2) * 4 + 0.5)
+
+        nt = torch.randint(0, 6, (bs,))
+        nt[0] = 0
+        nt[-1] = max(int(nt[-1]), 1)
+        t_b = torch.repeat_interleave(torch.arange(bs), nt).float()
+        targets = torch.cat([t_b[:, None], torch.randint(0, nc, (len(t_b), 1)).float(),
+                             torch.rand(len(t_b), 2) * 0.8 + 0.1, torch.rand(len(t_b), 2) * 0.4 + 0.05], 1)
+        targets = targets[torch.randperm(len(targets))]  # targets are not ordered by image
+        imgs = torch.zeros(bs, 3, img_size, img_size)
+        decode = lambda i, fg_pred, gi, gj, a: decode_candidates(fg_pred, gi, gj, a, strides[i])
+
+        batched = build_targets_simota(p, targets, imgs, indices, anch, decode, nc)
+        per_image = build_targets_simota_per_image(p, targets, imgs, indices, anch, decode, nc)
+        names = 'b', 'a', 'gj', 'gi', 'targets', 'anch'
+        for name, x, y in zip(names, batched, per_image):
+            for i in range(len(strides)):
+                assert x[i].shape == y[i].shape and torch.equal(x[i], y[i].to(x[i].dtype)), \
+                    f'trial {trial}: layer {i} {name} differs\n{x[i]}\n{y[i]}'
+    print(f'build_targets_simota: {trials}/{trials} random batches match the per-image assignment')
+
+
+if __name__ == '__main__':
+    check_build_targets_simota()
@@ -109,6 +109,63 @@ def compute_ap(recall, precision, v5_metric=False):
     return ap, mpre, mrec
 
 
+def match_predictions(detections, labels, iouv):
+    """
+    Return correct prediction matrix, every target is matched to at most one prediction.
+    Each prediction is assigned to its best-IoU target of the same class and
+    each target goes to its most confident prediction above iouv[0].
+    Arguments:
+        detections (Array[N, 6]), x1, y1, x2, y2, conf, class (sorted by descending conf)
+        labels (Array[M, 5]), class, x1, y1, x2, y2
+        iouv (Array[10]), IoU thresholds
+    Returns:
+        correct (Array[N, 10]), for 10 IoU levels
+    """
+    n = detections.shape[0]
+    correct = torch.zeros(n, iouv.numel(), dtype=torch.bool, device=iouv.device)
+    if not n or not labels.shape[0]:
+        return correct
+
+    from . import general
+    iou = general.box_iou(detections[:, :4], labels[:, 1:])  # (N, M)
+    iou *= detections[:, 5:6] == labels[:, 0]  # class mask
+    ious, t = iou.max(1)  # best target of every prediction
+    p = (ious > iouv[0]).nonzero(as_tuple=False).view(-1)  # candidate predictions, in confidence order
+    if p.shape[0]:
+        first = torch.full((labels.shape[0],), n, dtype=p.dtype, device=p.device)
+        first = first.scatter_reduce(0, t[p], p, reduce='amin')  # most confident prediction of every target
+        p = p[first[t[p]] == p]
+        correct[p] = ious[p, None] > iouv
+    return correct
+
+
+class APStats:
+    """
+    Streaming accumulator of the ap_per_class inputs (correct, conf, pred_cls, target_cls).
+    Per-image results stay on the device and are concatenated once per batch,
+    they are copied to the host only once at the end of the evaluation.
+    """
+    def __init__(self):
+        self.pending = ([], [], [], [])
+        self.chunks = ([], [], [], [])
+
+    def update(self, correct, conf, pred_cls, target_cls):
+        for x, pending in zip((correct, conf.float(), pred_cls.float(), target_cls.float()), self.pending):
+            pending.append(x)
+
+    def flush(self):
+        for pending, chunks in zip(self.pending, self.chunks):
+            if pending:
+                chunks.append(torch.cat(pending, 0))
+                pending.clear()
+
+    def numpy(self):
+        self.flush()
+        if not self.chunks[0]:
+            return []
+        return [torch.cat(chunks, 0).cpu().numpy() for chunks in self.chunks]
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -9,6 +9,7 @@ import os
 import sys
 from pathlib import Path
 
+import numpy as np
 import yaml
 from ofa.utils import download_url
 
@@ -36,9 +37,131 @@ def count_conv_flop(out_size, in_channels, out_channels, kernel_size, groups):
     return delta_ops
 
 
+LAYER_TYPES = ("Conv", "expanded_conv", "Conv_1", "AvgPool2D", "Conv_2", "Logits")
+KEY_FIELDS = ("type", "in_h", "in_w", "in_c", "out_h", "out_w", "out_c",
+              "expand", "kernel", "stride", "idskip", "se", "hs")
+LUT_DTYPE = np.dtype([
+    ("key", np.int32, (len(KEY_FIELDS),)),
+    ("mean", np.float64),
+    ("std", np.float64),
+    ("count", np.int32),
+])
+# fields a missing entry has to share with the entries it is interpolated
+# from, tried in order: same op at the same resolution (other widths),
+# same op at another resolution, same layer type
+INTERP_GROUPS = [
+    [KEY_FIELDS.index(f) for f in fields] for fields in (
+        ("type", "in_h", "in_w", "out_h", "out_w",
+         "kernel", "stride", "idskip", "se", "hs"),
+        ("type", "kernel", "stride", "se", "hs"),
+        ("type",),
+    )
+]
+
+
+def parse_shape(shape):
+    '''
+    shape (list or "HxWxC" string) as (h, w, c), vectors as (1, 1, c)
+    '''
+    if isinstance(shape, str):
+        shape = shape.split("x")
+    shape = [int(_) for _ in shape]
+    return [1] * (3 - len(shape)) + shape
+
+
+def encode_layer(l_type, input_shape, output_shape, mid=0, ks=0, stride=0,
+                 id_skip=0, se=0, h_swish=0):
+    '''
+    integer-encoded lut key of a layer
+    '''
+    return (LAYER_TYPES.index(l_type), *parse_shape(input_shape),
+            *parse_shape(output_shape), mid, ks, stride, id_skip, se, h_swish)
+
+
+def encode_key(key):
+    '''
+    integer-encoded lut key of a yaml key
+    (e.g. expanded_conv-input:112x112x24-output:56x56x32-expand:144-...)
+    '''
+    l_type, *infos = key.split("-")
+    infos = dict(info.split(":") for info in infos)
+    return encode_layer(
+        l_type, infos["input"], infos["output"],
+        *[int(infos.get(f, 0))
+          for f in ("expand", "kernel", "stride", "idskip", "se", "hs")])
+
+
+def layer_flops(keys):
+    '''
+    flops of integer-encoded layers (N, len(KEY_FIELDS)),
+    only used to interpolate between layers of the same type
+    '''
+    keys = keys.astype(np.float64)
+    l_type, in_h, in_w, in_c, out_h, _, out_c, mid, ks = keys[:, :9].T
+    flops = count_conv_flop(out_h, in_c, out_c, 1, 1)
+    # mobile inverted bottleneck: expand (if any), depthwise, project
+    expanded = l_type == LAYER_TYPES.index("expanded_conv")
+    mb_flops = (
+        np.where(mid != in_c, count_conv_flop(in_h, in_c, mid, 1, 1), 0)
+        + count_conv_flop(out_h, mid, mid, ks, np.maximum(mid, 1))
+        + count_conv_flop(out_h, mid, out_c, 1, 1)
+    )
+    flops = np.where(expanded, mb_flops, flops)
+    pooled = l_type == LAYER_TYPES.index("AvgPool2D")
+    flops = np.where(pooled, in_h * in_w * in_c, flops)
+    return flops
+
+
+def to_void(keys):
+    '''
+    rows of integer keys as single sortable items
+    (byte order, only used for exact matching)
+    '''
+    keys = np.ascontiguousarray(keys, dtype=np.int32)
+    return keys.view(np.dtype((np.void, keys.shape[1] * 4))).ravel()
+
+
+def build_index(fname):
+    '''
+    compile the yaml lut into a structured array sorted by key
+    '''
+    with open(fname, "r") as fp:
+        lut = yaml.load(fp, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    index = np.zeros(len(lut), dtype=LUT_DTYPE)
+    for i, (key, value) in enumerate(lut.items()):
+        index[i] = (encode_key(key), value["mean"],
+                    value.get("std", 0.), value.get("count", 0))
+    return index[np.argsort(to_void(index["key"]))]
+
+
+def load_index(fname):
+    '''
+    load the compiled lut (cached next to the yaml as .npy),
+    compile it again if the yaml is newer
+    '''
+    cache = Path(fname).with_suffix(".npy")
+    try:
+        if os.path.getmtime(cache) >= os.path.getmtime(fname):
+            index = np.load(cache, allow_pickle=False)
+            if index.dtype == LUT_DTYPE:
+                return index
+    except (OSError, ValueError):
+        pass
+    index = build_index(fname)
+    try:
+        tmp = cache.with_suffix(".%d.tmp" % os.getpid())
+        with open(tmp, "wb") as fp:
+            np.save(fp, index)
+        os.replace(tmp, cache)
+    except OSError as e:
+        print("LatencyEstimator: failed to cache %s (%s)" % (cache, e))
+    return index
+
+
 class LatencyEstimator:
     '''
-    get Latency (it will be modified)
+    get Latency from the lut, compiled once into a sorted index of
+    integer-encoded keys. Layers missing from the lut are interpolated.
     '''
 
     def __init__(self,
@@ -52,8 +175,10 @@ class LatencyEstimator:
         #     fname = ROOT / url
         fname = ROOT / 'mobile_lut.yaml'
 
-        with open(fname, "r") as fp:
-            self.lut = yaml.load(fp, Loader=yaml.FullLoader)
+        self.index = load_index(fname)
+        self.sorted_keys = to_void(self.index["key"])
+        self.flops = layer_flops(self.index["key"])
+        self.interpolated = {}  # key bytes : interpolated latency
 
     @staticmethod
     def repr_shape(shape):
@@ -66,6 +191,48 @@ class LatencyEstimator:
             return shape
         return TypeError
 
+    def lookup(self, keys):
+        '''
+        latency of integer-encoded layers (N, len(KEY_FIELDS))
+        '''
+        keys = np.asarray(keys, dtype=np.int32).reshape(-1, len(KEY_FIELDS))
+        pos = np.searchsorted(self.sorted_keys, to_void(keys))
+        pos = np.minimum(pos, len(self.sorted_keys) - 1)
+        found = np.all(self.index["key"][pos] == keys, axis=1)
+        latency = np.where(found, self.index["mean"][pos], 0.)
+        for i in np.flatnonzero(~found):
+            latency[i] = self.interpolate(keys[i])
+        return latency
+
+    def interpolate(self, key):
+        '''
+        latency of a layer missing from the lut, interpolated over the flops
+        of the most similar entries (scaled by flops outside their range)
+        '''
+        item = key.tobytes()
+        if item in self.interpolated:
+            return self.interpolated[item]
+        for fields in INTERP_GROUPS:
+            same = np.all(self.index["key"][:, fields] == key[fields], axis=1)
+            if same.any():
+                break
+        else:
+            raise KeyError("no latency entry of type %s"
+                           % LAYER_TYPES[key[0]])
+        flops = layer_flops(key[None])[0]
+        order = np.argsort(self.flops[same], kind="stable")
+        ref_flops = self.flops[same][order]
+        ref_latency = self.index["mean"][same][order]
+        if ref_flops[0] <= flops <= ref_flops[-1]:
+            latency = float(np.interp(flops, ref_flops, ref_latency))
+        else:
+            j = 0 if flops < ref_flops[0] else -1
+            latency = float(ref_latency[j] * flops / max(ref_flops[j], 1.))
+        self.interpolated[item] = latency
+        print("LatencyEstimator: interpolated %s: %.4f" % (
+            "-".join("%s:%d" % kv for kv in zip(KEY_FIELDS, key)), latency))
+        return latency
+
     def query(self,
               l_type: str,
               input_shape,
@@ -80,38 +247,37 @@ class LatencyEstimator:
         '''
         get latency
         '''
-        infos = [
-            l_type,
-            "input:%s" % self.repr_shape(input_shape),
-            "output:%s" % self.repr_shape(output_shape),
-        ]
-
         if l_type in ("expanded_conv",):
             assert None not in (mid, ks, stride,
                                 id_skip, se, h_swish)
-            infos += [
-                "expand:%d" % mid,
-                "kernel:%d" % ks,
-                "stride:%d" % stride,
-                "idskip:%d" % id_skip,
-                "se:%d" % se,
-                "hs:%d" % h_swish,
-            ]
-        key = "-".join(infos)
-        return self.lut[key]["mean"]
+            key = encode_layer(l_type, input_shape, output_shape,
+                               mid, ks, stride, id_skip, se, h_swish)
+        else:
+            key = encode_layer(l_type, input_shape, output_shape)
+        return float(self.lookup([key])[0])
 
-    def predict_network_latency(self, net, image_size=224):
+    def predict_latencies(self, layers):
         '''
-        get lut
+        total latency of every network given as a list of encoded layers
         '''
-        predicted_latency = 0
+        segments = np.repeat(np.arange(len(layers)),
+                             [len(_) for _ in layers])
+        latency = self.lookup([key for keys in layers for key in keys])
+        return np.bincount(segments, weights=latency, minlength=len(layers))
+
+    @staticmethod
+    def network_layers(net, image_size=224):
+        '''
+        encoded layers of a network
+        '''
+        layers = []
         # first conv
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "Conv",
             [image_size, image_size, 3],
             [(image_size + 1) // 2, (image_size + 1) //
              2, net.first_conv.out_channels],
-        )
+        ))
         # blocks
         fsize = (image_size + 1) // 2
         for block in net.blocks:
@@ -125,7 +291,7 @@ class LatencyEstimator:
             else:
                 idskip = 1
             out_fz = int((fsize - 1) / mb_conv.stride + 1)
-            block_latency = self.query(
+            layers.append(encode_layer(
                 "expanded_conv",
                 [fsize, fsize, mb_conv.in_channels],
                 [out_fz, out_fz, mb_conv.out_channels],
@@ -135,50 +301,50 @@ class LatencyEstimator:
                 id_skip=idskip,
                 se=1 if mb_conv.use_se else 0,
                 h_swish=1 if mb_conv.act_func == "h_swish" else 0,
-            )
-            predicted_latency += block_latency
+            ))
             fsize = out_fz
         # final expand layer
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "Conv_1",
             [fsize, fsize, net.final_expand_layer.in_channels],
             [fsize, fsize, net.final_expand_layer.out_channels],
-        )
+        ))
         # global average pooling
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "AvgPool2D",
             [fsize, fsize, net.final_expand_layer.out_channels],
             [1, 1, net.final_expand_layer.out_channels],
-        )
+        ))
         # feature mix layer
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "Conv_2",
             [1, 1, net.feature_mix_layer.in_channels],
             [1, 1, net.feature_mix_layer.out_channels],
-        )
+        ))
         # classifier
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "Logits", [1, 1, net.classifier.in_features], [
                 net.classifier.out_features]
-        )
-        return predicted_latency
+        ))
+        return layers
 
-    def predict_network_latency_given_spec(self, spec):
+    @staticmethod
+    def spec_layers(spec):
         '''
-        predict latency
+        encoded layers of an architecture spec
         '''
         imgsz = spec["r"][0]
-        predicted_latency = 0
+        layers = []
         # first conv
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "Conv",
             [imgsz, imgsz, 3],
             [(imgsz + 1) // 2, (imgsz + 1) // 2, 24],
-        )
+        ))
         # blocks
         fsize = (imgsz + 1) // 2
         # first block
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "expanded_conv",
             [fsize, fsize, 24],
             [fsize, fsize, 24],
@@ -188,7 +354,7 @@ class LatencyEstimator:
             id_skip = 1,
             se = 0,
             h_swish = 0,
-        )
+        ))
         in_channel = 24
         stride_stages = [2, 2, 2, 1, 2]
         width_stages = [32, 48, 96, 136, 192]
@@ -210,7 +376,7 @@ class LatencyEstimator:
             out_fz = int((fsize - 1) / stride + 1)
 
             mid_channel = round(in_channel * _e)
-            block_latency = self.query(
+            layers.append(encode_layer(
                 "expanded_conv",
                 [fsize, fsize, in_channel],
                 [out_fz, out_fz, out_channel],
@@ -220,27 +386,48 @@ class LatencyEstimator:
                 id_skip=idskip,
                 se=1 if se_stages[stage] else 0,
                 h_swish=1 if act_stages[stage] == "h_swish" else 0,
-            )
-            predicted_latency += block_latency
+            ))
             fsize = out_fz
             in_channel = out_channel
         # final expand layer
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "Conv_1",
             [fsize, fsize, 192],
             [fsize, fsize, 1152],
-        )
+        ))
         # global average pooling
-        predicted_latency += self.query(
+        layers.append(encode_layer(
             "AvgPool2D",
             [fsize, fsize, 1152],
             [1, 1, 1152],
-        )
+        ))
         # feature mix layer
-        predicted_latency += self.query("Conv_2", [1, 1, 1152], [1, 1, 1536])
+        layers.append(encode_layer("Conv_2", [1, 1, 1152], [1, 1, 1536]))
         # classifier
-        predicted_latency += self.query("Logits", [1, 1, 1536], [1000])
-        return predicted_latency
+        layers.append(encode_layer("Logits", [1, 1, 1536], [1000]))
+        return layers
+
+    def predict_network_latency(self, net, image_size=224):
+        '''
+        get lut, net can be a list of networks (latency of each)
+        '''
+        if isinstance(net, (list, tuple)):
+            return self.predict_latencies(
+                [self.network_layers(_, image_size) for _ in net])
+        return float(self.predict_latencies(
+            [self.network_layers(net, image_size)])[0])
+
+    def predict_network_latency_given_spec(self, spec):
+        '''
+        predict latency
+        '''
+        return float(self.predict_latencies([self.spec_layers(spec)])[0])
+
+    def predict_network_latency_given_specs(self, specs):
+        '''
+        predict latency of every spec at once
+        '''
+        return self.predict_latencies([self.spec_layers(_) for _ in specs])
 
 
 class LatencyTable:
@@ -277,3 +464,16 @@ class LatencyTable:
         '''
         return self.latency_tables[
             spec["r"][0]].predict_network_latency_given_spec(spec)
+
+    def predict_efficiency_batch(self, specs):
+        '''
+        get latency of every spec at once
+        '''
+        latency = np.zeros(len(specs))
+        resolutions = np.array([spec["r"][0] for spec in specs])
+        for image_size in np.unique(resolutions):
+            idx = np.flatnonzero(resolutions == image_size)
+            latency[idx] = self.latency_tables[
+                int(image_size)].predict_network_latency_given_specs(
+                    [specs[i] for i in idx])
+        return latency
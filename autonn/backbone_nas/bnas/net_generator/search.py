@@ -4,6 +4,7 @@ nas search
 
 import os
 import sys
+from pathlib import Path
 
 import numpy as np
 
@@ -35,7 +36,8 @@ def arch_search(
             max_latency,
             pop_size,
             niter,
-            device):
+            device,
+            resume=True):
     '''arch_search'''
     data_dict = None
     with torch_distributed_zero_first(LOCAL_RANK):
@@ -110,7 +112,9 @@ def arch_search(
         max_latency,
         pop_size,
         niter,
-        device)
+        device,
+        # search snapshot next to the dataset yaml, a restarted search resumes from it
+        snapshot_path=str(Path(data_path).parent / 'bnas_search_state.pt') if resume else None)
 
     # amp = False
     # model = fine_tune(val_loader, model, amp)
@@ -2,20 +2,22 @@
 Evolutionary Algorithm-based NAS
 '''
 
+import os
 import random
 from copy import deepcopy
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Variable
 from tqdm import tqdm
 
 # from trainers.search_config import config
-from .nas_utils import sortNondominated, CrowdingDist
+from .nas_utils import nsga2_sort
 from ..latency_lookup_table import LatencyTable
 from ..models.common import Conv, C3
-from .eval import cal_metrics
+from .eval import cal_metrics_population
 from ..utils.pytorch_visual import Pytorch_Visual
 
 class ArchManager:
@@ -77,6 +79,28 @@ class ArchManager:
         sample["r"][0] = random.choice(self.resolutions)
 
 
+def arch_key(sample):
+    '''
+    hashable key of an architecture
+    '''
+    return tuple((k, tuple(v)) for k, v in sorted(sample.items()))
+
+
+def replicate(module, device):
+    '''
+    copy of a module on another device, the detection grids and strides
+    (plain attributes, not moved by .to()) included
+    '''
+    module = deepcopy(module).to(device)
+    for m in module.modules():
+        if hasattr(m, "grid") and hasattr(m, "anchor_grid"):
+            m.grid = [torch.empty(0) for _ in m.grid]
+            m.anchor_grid = [torch.empty(0) for _ in m.anchor_grid]
+            if isinstance(m.stride, torch.Tensor):
+                m.stride = m.stride.to(device)
+    return module
+
+
 class ENAS:
     valid_constraint_range = {
         "flops": [150, 600],
@@ -130,6 +154,13 @@ class ENAS:
         self.parent_ratio = kwargs.get("parent_ratio", 0.25)
         self.mutation_ratio = kwargs.get("mutation_ratio", 0.5)
         self.tournament_size = max(2, int(self.population_size * 0.5)) # max(2, 20*0.5)
+        # snapshot of the search state, the search resumes from it after a restart (None : off)
+        self.snapshot_path = kwargs.get("snapshot_path", None)
+        self.snapshot_interval = kwargs.get("snapshot_interval", 1)
+        self.evaluated = {}  # arch key : mAP of every architecture of this search
+        # devices the population is evaluated on (None : every visible gpu)
+        self.eval_devices = kwargs.get("eval_devices", None)
+        self.replicas = None
 
     def invite_reset_constraint_type(self):
         print(
@@ -231,8 +262,7 @@ class ENAS:
         child_pool = []
         efficiency_pool = []
         best_info = None
-
-        
+        self.evaluated = {}
 
         # log 출력 형식
         #formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
@@ -247,17 +277,26 @@ class ENAS:
         #file_handler.setFormatter(formatter)
         #logger.addHandler(file_handler)
 
-        if verbose:
-            print("Generate random population...")
-        for _ in range(population_size):
-            sample, efficiency = self.random_sample()
-            child_pool.append(sample)
-            efficiency_pool.append(efficiency)
+        state = self._load_snapshot()
+        if state is not None:
+            start = state["iter"]
+            population, best_valids, best_info = state["population"], state["best_valids"], state["best_info"]
+            print("Resume the search from %s (%d/%d iterations, %d evaluated architectures)"
+                  % (self.snapshot_path, start, max_time_budget, len(self.evaluated)))
+        else:
+            start = 0
+            if verbose:
+                print("Generate random population...")
+            for _ in range(population_size):
+                sample, efficiency = self.random_sample()
+                child_pool.append(sample)
+                efficiency_pool.append(efficiency)
 
-        # accs = self.accuracy_predictor.predict_accuracy(child_pool)
-        accs = self._evaluate(child_pool)
-        for i in range(population_size):
-            population.append((accs[i], child_pool[i], efficiency_pool[i]))
+            # accs = self.accuracy_predictor.predict_accuracy(child_pool)
+            accs = self._evaluate(child_pool)
+            for i in range(population_size):
+                population.append((accs[i], child_pool[i], efficiency_pool[i]))
+            self._save_snapshot(start, population, best_valids, best_info)
 
         if verbose:
             print("Start Evolution...")
@@ -265,7 +304,7 @@ class ENAS:
             #logger.setLevel(logging.INFO)
         # After the population is seeded, proceed with evolving the population.
         for iter in tqdm(
-            range(max_time_budget),
+            range(start, max_time_budget),
             desc="Searching with %s constraint (%s)"
             % (self.constraint_type, self.efficiency_constraint),
         ):
@@ -323,10 +362,75 @@ class ENAS:
             for i in range(population_size):
                 population.append((accs[i], child_pool[i], efficiency_pool[i]))
 
+            if (iter + 1) % self.snapshot_interval == 0 or iter + 1 == max_time_budget:
+                self._save_snapshot(iter + 1, population, best_valids, best_info)
+
         _, net_config, latency = best_info
         b_net = SampledModel(self.head, self.supernet, net_config)
+        self._remove_snapshot()
         return best_valids, b_net
 
+    def _snapshot_key(self):
+        # a snapshot is only resumed by a search with the same setting (the time budget may differ)
+        return {
+            "constraint_type": self.constraint_type,
+            "efficiency_constraint": self.efficiency_constraint,
+            "population_size": self.population_size,
+            "parent_ratio": self.parent_ratio,
+            "mutation_ratio": self.mutation_ratio,
+            "mutate_prob": self.mutate_prob,
+        }
+
+    def _save_snapshot(self, iter, population, best_valids, best_info):
+        if self.snapshot_path is None:
+            return
+        state = {
+            "key": self._snapshot_key(),
+            "iter": iter,
+            "population": population,
+            "best_valids": best_valids,
+            "best_info": best_info,
+            "evaluated": self.evaluated,
+            "rng": {
+                "random": random.getstate(),
+                "numpy": np.random.get_state(),
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (self.snapshot_path, os.getpid())
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            print("ENAS: failed to save the snapshot %s (%s)" % (self.snapshot_path, e))
+
+    def _load_snapshot(self):
+        if self.snapshot_path is None or not os.path.isfile(self.snapshot_path):
+            return None
+        try:
+            state = torch.load(self.snapshot_path)
+        except Exception as e:
+            print("ENAS: failed to load the snapshot %s (%s)" % (self.snapshot_path, e))
+            return None
+        if state.get("key") != self._snapshot_key():
+            print("ENAS: the snapshot %s is from another search setting, start over" % self.snapshot_path)
+            return None
+
+        rng = state["rng"]
+        random.setstate(rng["random"])
+        np.random.set_state(rng["numpy"])
+        torch.set_rng_state(rng["torch"])
+        if rng["cuda"] is not None and torch.cuda.is_available() and len(rng["cuda"]) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all(rng["cuda"])
+        self.evaluated = state["evaluated"]
+        return state
+
+    def _remove_snapshot(self):
+        if self.snapshot_path is not None and os.path.isfile(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
     def _tournament_selection(self):
         indices = np.random.choice(self.population_size, self.tournament_size)
         indices = np.sort(indices)
@@ -334,41 +438,51 @@ class ENAS:
 
 
     def _sorting(self, eval_vec):
-        fronts = sortNondominated(eval_vec)
-
-        idx_list = []
+        # (accuracy, latency) of the population, Pareto front rank then crowding distance
+        idx_list = nsga2_sort(np.array(eval_vec, dtype=np.float64), k=self.population_size)
+        return idx_list.tolist()
 
-        for i in range(len(fronts)):
-            if len(fronts[i]) == 1:
-                idx_list.append(fronts[i][0])
-            elif len(fronts[i]) == 2:
-                idx_list.append(fronts[i][0])
-                idx_list.append(fronts[i][1])
-            else:
-                vec = [eval_vec[idx] for idx in fronts[i]]
-                distances = CrowdingDist(vec)
-                eval_indices = list(np.argsort(np.array(distances))[::-1])
-                for j in range(len(fronts[i])):
-                    idx_list.append(fronts[i][eval_indices[j]])
-
-            if len(idx_list) >= self.population_size:
-                idx_list = idx_list[0:self.population_size]
-                break
-
-        return idx_list
 
+    def _replicas(self):
+        """
+        (device, head, supernet) of every evaluation device, the first one is the search model
+        """
+        if self.replicas is None:
+            device = next(self.supernet.parameters()).device
+            devices = self.eval_devices
+            if devices is None:
+                devices = [torch.device("cuda", i) for i in range(torch.cuda.device_count())] \
+                    if device.type == "cuda" else [device]
+            self.replicas = [(device, self.head, self.supernet)]
+            for d in map(torch.device, devices):
+                if d != device:
+                    self.replicas.append((d, replicate(self.head, d), replicate(self.supernet, d)))
+        return self.replicas
 
     def _evaluate(self, population):
         """
         _evaluate
         """
-        accs = []
+        # architectures already evaluated in this search (also before a resume) are not evaluated again
+        new = {}
         for sample in population:
-            net = SampledModel(self.head, self.supernet, sample)
-            mAP = cal_metrics(self.val_loader, net, self.nc, self.names)
-            accs.append(mAP)
-
-        return accs
+            key = arch_key(sample)
+            if key not in self.evaluated:
+                new[key] = sample
+
+        if new:
+            # one pass over the validation set for all the new architectures,
+            # spread over the devices (each device has its own copy of the supernet)
+            replicas = self._replicas()
+            keys, device_models = [], []
+            for k, (device, head, supernet) in enumerate(replicas):
+                samples = list(new.items())[k::len(replicas)]
+                keys += [key for key, _ in samples]
+                device_models.append((device, [SampledModel(head, supernet, sample) for _, sample in samples]))
+            accs = cal_metrics_population(self.val_loader, device_models, self.nc, self.names)
+            self.evaluated.update(zip(keys, accs))
+
+        return [self.evaluated[arch_key(sample)] for sample in population]
 
 class SampledModel(nn.Module):
     '''
@@ -382,8 +496,38 @@ class SampledModel(nn.Module):
         self.stride = self.head.stride
         self.supernet = supernet
         # arch format {'ks':[], 'e':[], 'd':[]}
-        self.supernet.set_active_subnet(**arch)
+        self.activate()
         self.supernet.set_backbone_fpn(returned_layers=[1, 2, 3])
+        # head routing, derived once from m.f
+        self.routes = [self.route(m) for m in self.head]
+
+    def activate(self):
+        '''
+        set the arch on the supernet (shared by the sampled models)
+        '''
+        self.supernet.set_active_subnet(**self.arch)
+
+    @staticmethod
+    def route(m):
+        '''
+        inputs of a head layer (None: previous output, -1: previous output,
+        i: multiScaleFs[i]) and the channels its input is zero-padded to
+        '''
+        src = None
+        if m.f != -1:
+            if m.f[1]>7:
+                src = [j if j == -1 else j-7 for j in m.f]
+            elif m.f[1]==6:
+                src = [-1, 1]
+            elif m.f[1]==4:
+                src = [-1, 0]
+
+        in_C = None
+        if isinstance(m, Conv):
+            in_C = m.conv.in_channels
+        elif isinstance(m, C3):
+            in_C = m.cv1.conv.in_channels
+        return src, in_C
 
     def forward(self, im):
         # return outputs, outputs.keys()
@@ -391,25 +535,11 @@ class SampledModel(nn.Module):
         multiScaleFs = [o[k[0]], o[k[1]], o[k[2]]]
         x = o[k[2]]
 
-        for m in self.head:
-            if m.f != -1:
-                if m.f[1]>7:
-                    x = [x if j == -1 else multiScaleFs[j-7] for j in m.f]
-                elif m.f[1]==6:
-                    x = [x, multiScaleFs[1]]
-                elif m.f[1]==4:
-                    x = [x, multiScaleFs[0]]
-
-            if isinstance(m, Conv):
-                in_C = m.conv.in_channels
-                pad = torch.zeros(x.shape[0], in_C, x.shape[-2], x.shape[-1]).cuda()
-                pad[:, :x.shape[1], ...] = x
-                x = pad
-            elif isinstance(m, C3):
-                in_C = m.cv1.conv.in_channels
-                pad = torch.zeros(x.shape[0], in_C, x.shape[-2], x.shape[-1]).cuda()
-                pad[:, :x.shape[1], ...] = x
-                x = pad
+        for m, (src, in_C) in zip(self.head, self.routes):
+            if src is not None:
+                x = [x if j == -1 else multiScaleFs[j] for j in src]
+            if in_C is not None and x.shape[1] < in_C:
+                x = F.pad(x, (0, 0, 0, 0, 0, in_C - x.shape[1]))
             x = m(x)
             multiScaleFs.append(x)
         return x
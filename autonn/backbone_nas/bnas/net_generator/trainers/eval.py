@@ -4,6 +4,7 @@ eval model
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -29,71 +30,40 @@ LOCAL_RANK = int(os.environ.get('LOCAL_RANK', -1))
 RANK = int(os.environ.get('RANK', -1))
 
 
-def cal_metrics(val_loader, model, nc, names):
+class MetricStats:
     '''
-    get metrics
+    mAP statistics of one model, accumulated batch by batch
     '''
 
-    #amp = check_amp(model)  # check AMP
-    # amp = False
-    # model = fine_tune(val_loader, model, amp)
-
-    model.eval()
-    # get model device, PyTorch model
-    device = next(model.parameters()).device
-    # half = False
-    # half &= device.type != 'cpu'  # half precision only supported on CUDA
-    # model.half() if half else
-    model.float()
-    # base_model.half() if half else base_model.float()
-    # supernet.half() if half else supernet.float()
-
-    cuda = device.type != 'cpu'
-    # iou vector for mAP@0.5:0.95
-    iouv = torch.linspace(0.5, 0.95, 10, device=device)
-    niou = iouv.numel()
-
-    seen = 0
-    # confusion_matrix = ConfusionMatrix(nc=nc)
-    s = ('%20s' + '%11s' * 6) % ('Class', 'Images',
-                                  'Labels', 'P', 'R', 'mAP@.5', 'mAP@.5:.95')
-    p, r, mp, mr, map50, m_ap = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
-    stats, ap = [], []
-
-    pbar = tqdm(val_loader, desc=s,
-                bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
-    for _, (img, targets, paths, shapes) in enumerate(pbar):
-        if cuda:
-            img = img.to(device, non_blocking=True)
-            targets = targets.to(device)
-        # img = img.half() if half else img.float()  # uint8 to fp16/32
-        img = img.float()
-        img /= 255  # 0 - 255 to 0.0 - 1.0
-        _, _, height, width = img.shape  # batch size, channels, height, width
-
-        # Inference
-        with torch.no_grad():
-            out = model(img)[0]  # inference
-        # to pixels
-        targets[:, 2:] *= torch.tensor((width,
-                                        height, width, height), device=device)
-        out = non_max_suppression(
-            out, 0.001, 0.6, labels=[], multi_label=True, agnostic=False)
-
-        # Metrics
+    def __init__(self, nc, names, device):
+        self.nc = nc
+        self.names = names
+        self.device = device
+        # iou vector for mAP@0.5:0.95
+        self.iouv = torch.linspace(0.5, 0.95, 10, device=device)
+        self.niou = self.iouv.numel()
+        self.seen = 0
+        self.stats = []
+
+    def update(self, out, img, targets, paths, shapes):
+        '''
+        add the nms output of a batch (targets in pixels);
+        the batch statistics are moved to the host in one copy
+        '''
+        batch_stats = []
         for si, pred in enumerate(out):
             labels = targets[targets[:, 0] == si, 1:]
             # number of labels, predictions
             nl, npr = labels.shape[0], pred.shape[0]
             _, shape = Path(paths[si]), shapes[si][0]
             correct = torch.zeros(
-                npr, niou, dtype=torch.bool, device=device)  # init
-            seen += 1
+                npr, self.niou, dtype=torch.bool, device=self.device)  # init
+            self.seen += 1
 
             if npr == 0:
                 if nl:
-                    stats.append(
-                        (correct, *torch.zeros((3, 0), device=device)))
+                    batch_stats.append(
+                        (correct, *torch.zeros((3, 0), device=self.device)))
                 continue
 
             # Predictions
@@ -108,29 +78,137 @@ def cal_metrics(val_loader, model, nc, names):
                              shapes[si][1])  # native-space labels
                 # native-space labels
                 labelsn = torch.cat((labels[:, 0:1], tbox), 1)
-                correct = process_batch(predn, labelsn, iouv)
+                correct = process_batch(predn, labelsn, self.iouv)
                 # if plots:
                 #    confusion_matrix.process_batch(predn, labelsn)
             # (correct, conf, pcls, tcls)
-            stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))
-
-    # Compute metrics
-    stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
-    if stats and stats[0].any():
-        # tp, fp, p, r, f1, ap, ap_class
-        _, _, p, r, _, ap, _ = ap_per_class(
-            *stats, plot=False, save_dir=ROOT / 'save', names=names)
-        ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
-        mp, mr, map50, m_ap = p.mean(), r.mean(), ap50.mean(), ap.mean()
-        # number of targets per class
-        nt = np.bincount(stats[3].astype(int), minlength=nc)
-    else:
-        nt = torch.zeros(1)
-
-    # Print results
-    pf = '%20s' + '%11i' * 2 + '%11.3g' * 4  # print format
-    print(pf % ('all', seen, nt.sum(), mp, mr, map50, m_ap))
-    return m_ap
+            batch_stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))
+        if batch_stats:
+            self.stats.append(
+                tuple(torch.cat(x, 0).cpu() for x in zip(*batch_stats)))
+
+    def compute(self):
+        '''
+        get mAP@.5:.95
+        '''
+        p, r, mp, mr, map50, m_ap = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
+        # to numpy
+        stats = [torch.cat(x, 0).numpy() for x in zip(*self.stats)]
+        if stats and stats[0].any():
+            # tp, fp, p, r, f1, ap, ap_class
+            _, _, p, r, _, ap, _ = ap_per_class(
+                *stats, plot=False, save_dir=ROOT / 'save', names=self.names)
+            ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
+            mp, mr, map50, m_ap = p.mean(), r.mean(), ap50.mean(), ap.mean()
+            # number of targets per class
+            nt = np.bincount(stats[3].astype(int), minlength=self.nc)
+        else:
+            nt = torch.zeros(1)
+
+        # Print results
+        pf = '%20s' + '%11i' * 2 + '%11.3g' * 4  # print format
+        print(pf % ('all', self.seen, nt.sum(), mp, mr, map50, m_ap))
+        return m_ap
+
+
+def load_batch(img, targets, device):
+    '''
+    batch on the device, image 0.0 - 1.0, targets in pixels
+    '''
+    if device.type != 'cpu':
+        img = img.to(device, non_blocking=True)
+        targets = targets.to(device)
+    # img = img.half() if half else img.float()  # uint8 to fp16/32
+    img = img.float()
+    img /= 255  # 0 - 255 to 0.0 - 1.0
+    _, _, height, width = img.shape  # batch size, channels, height, width
+    # to pixels
+    targets = targets.clone()
+    targets[:, 2:] *= torch.tensor((width,
+                                    height, width, height), device=device)
+    return img, targets
+
+
+@torch.no_grad()
+def predict(model, img):
+    '''
+    inference and nms
+    '''
+    out = model(img)[0]  # inference
+    return non_max_suppression(
+        out, 0.001, 0.6, labels=[], multi_label=True, agnostic=False)
+
+
+def cal_metrics(val_loader, model, nc, names):
+    '''
+    get metrics
+    '''
+
+    #amp = check_amp(model)  # check AMP
+    # amp = False
+    # model = fine_tune(val_loader, model, amp)
+
+    model.eval()
+    # get model device, PyTorch model
+    device = next(model.parameters()).device
+    # half = False
+    # half &= device.type != 'cpu'  # half precision only supported on CUDA
+    # model.half() if half else
+    model.float()
+    # base_model.half() if half else base_model.float()
+    # supernet.half() if half else supernet.float()
+
+    # confusion_matrix = ConfusionMatrix(nc=nc)
+    s = ('%20s' + '%11s' * 6) % ('Class', 'Images',
+                                  'Labels', 'P', 'R', 'mAP@.5', 'mAP@.5:.95')
+    metrics = MetricStats(nc, names, device)
+
+    pbar = tqdm(val_loader, desc=s,
+                bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
+    for _, (img, targets, paths, shapes) in enumerate(pbar):
+        img, targets = load_batch(img, targets, device)
+        metrics.update(predict(model, img), img, targets, paths, shapes)
+
+    return metrics.compute()
+
+
+def cal_metrics_population(val_loader, device_models, nc, names):
+    '''
+    get metrics of many models in a single pass over the validation set
+    device_models : list of (device, models), every batch is decoded once,
+    copied once to each device and run by all the models of that device.
+    The devices run concurrently, the models of a device one after another
+    (models with an activate() method share the weights of a supernet).
+    Returns the mAP@.5:.95 of every model (in device_models order).
+    '''
+    metrics = []
+    for device, models in device_models:
+        for model in models:
+            model.eval()
+            model.float()
+        metrics.append([MetricStats(nc, names, device) for _ in models])
+
+    def run(k, img, targets, paths, shapes):
+        device, models = device_models[k]
+        img, targets = load_batch(img, targets, device)
+        for model, stats in zip(models, metrics[k]):
+            if hasattr(model, 'activate'):
+                model.activate()
+            stats.update(predict(model, img), img, targets, paths, shapes)
+
+    s = 'Evaluating %d models on %d devices' % (
+        sum(len(models) for _, models in device_models), len(device_models))
+    with ThreadPoolExecutor(len(device_models)) as executor:
+        pbar = tqdm(val_loader, desc=s,
+                    bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')
+        for _, (img, targets, paths, shapes) in enumerate(pbar):
+            jobs = [executor.submit(run, k, img, targets, paths, shapes)
+                    for k in range(len(device_models))]
+            for job in jobs:
+                job.result()
+
+    return [stats.compute() for device_metrics in metrics
+            for stats in device_metrics]
 
 
 # change train_loader
@@ -2,8 +2,11 @@
 NAS utils
 '''
 
+import time
 from collections import defaultdict
 
+import numpy as np
+
 def CrowdingDist(fitness=None):
     """
     :param fitness: A list of fitness values
@@ -131,3 +134,116 @@ def sortNondominated(fitness, k=None, first_front_only=False):
             next_front = []
 
     return fronts
+
+
+def dominance_matrix(objs, sign=(+1, -1), chunk=1024):
+    """Boolean matrix D, D[i, j] is True if individual i dominates individual j
+    :param objs: (N, M) array of objective values
+    :param sign: target types. positive means maximize and otherwise minimize.
+    :param chunk: rows compared at once, bounds the (chunk, N, M) temporaries
+    """
+    fit = np.asarray(objs, dtype=np.float64) * np.asarray(sign, dtype=np.float64)  # all maximized
+    n = len(fit)
+    dom = np.empty((n, n), dtype=bool)
+    for s in range(0, n, chunk):
+        a = fit[s:s + chunk, None, :]
+        dom[s:s + chunk] = np.all(a >= fit[None], axis=2) & np.any(a > fit[None], axis=2)
+    return dom
+
+def fast_nondominated_sort(objs, sign=(+1, -1), k=None):
+    """NumPy version of sortNondominated (Deb et al. [Deb2002]_), O(MN^2) operations on arrays.
+    :param objs: (N, M) array of objective values
+    :param sign: target types. positive means maximize and otherwise minimize.
+    :param k: stop when at least *k* individuals are ranked
+    :returns: (N,) front rank of every individual, 0 is the Pareto front,
+              individuals left unranked (because of *k*) get rank N
+    """
+    dom = dominance_matrix(objs, sign)
+    n = len(dom)
+    k = n if k is None else min(k, n)
+    count = dom.sum(0)  # n (The number of people dominate you)
+    rank = np.full(n, n)
+    front = np.flatnonzero(count == 0)
+    r, ranked = 0, 0
+    while front.size and ranked < k:
+        rank[front] = r
+        ranked += front.size
+        count -= dom[front].sum(0)  # Sp of the current front -> n - 1
+        count[front] = -1
+        front = np.flatnonzero(count == 0)
+        r += 1
+    return rank
+
+def crowding_distance(objs, rank):
+    """NumPy version of CrowdingDist, computed for every front at once
+    :param objs: (N, M) array of objective values
+    :param rank: (N,) front rank of every individual
+    :returns: (N,) crowding distance of every individual within its front
+    """
+    objs = np.asarray(objs, dtype=np.float64)
+    rank = np.asarray(rank)
+    n, n_obj = objs.shape
+    pos = np.arange(n)
+    distances = np.zeros(n)
+    for i in range(n_obj):
+        # sorted by front, then by the ith objective
+        order = np.lexsort((objs[:, i], rank))
+        value, r = objs[order, i], rank[order]
+        first = np.r_[True, r[1:] != r[:-1]]
+        last = np.r_[r[1:] != r[:-1], True]
+        # boundary positions of the front of every individual
+        start = np.maximum.accumulate(np.where(first, pos, 0))
+        end = np.minimum.accumulate(np.where(last, pos, n)[::-1])[::-1]
+        norm = value[end] - value[start]
+        inner = np.flatnonzero(~first & ~last & (norm > 0))
+        dist = np.zeros(n)
+        dist[inner] = (value[inner + 1] - value[inner - 1]) / norm[inner]
+        dist[first | last] = np.inf  # boundary solutions
+        distances[order] += dist
+    return distances
+
+def nsga2_sort(objs, sign=(+1, -1), k=None):
+    """Indices of the individuals in NSGA-II order: by front rank,
+    then by crowding distance (largest first) within a front
+    :param objs: (N, M) array of objective values
+    :param k: number of indices returned
+    """
+    objs = np.asarray(objs, dtype=np.float64)
+    if not len(objs):
+        return np.zeros(0, dtype=int)
+    rank = fast_nondominated_sort(objs, sign, k)
+    distances = crowding_distance(objs, rank)
+    return np.lexsort((-distances, rank))[:k]
+
+def benchmark(sizes=(100, 1000, 2000, 5000, 10000), max_reference=2000, seed=0):
+    """Time the list and the NumPy sorting on random (accuracy, latency) populations
+    The list version (sortNondominated + CrowdingDist) is only run up to *max_reference*
+    individuals, the front ranks of both versions are checked against each other.
+    """
+    rng = np.random.default_rng(seed)
+    print('%10s %14s %14s' % ('N', 'list (s)', 'numpy (s)'))
+    for n in sizes:
+        # discrete values, so that equal fitnesses occur as well
+        objs = np.stack([rng.integers(0, 1000, n) / 1000, rng.integers(15, 60, n)], 1)
+
+        t = time.time()
+        rank = fast_nondominated_sort(objs)
+        crowding_distance(objs, rank)
+        t_numpy = time.time() - t
+
+        t_list = float('nan')
+        if n <= max_reference:
+            fitness = [tuple(f) for f in objs.tolist()]
+            t = time.time()
+            fronts = sortNondominated(fitness)
+            for front in fronts:
+                CrowdingDist([fitness[i] for i in front])
+            t_list = time.time() - t
+            for r, front in enumerate(fronts):
+                assert (rank[front] == r).all(), 'front %d differs' % r
+
+        print('%10d %14.4f %14.4f' % (n, t_list, t_numpy))
+
+
+if __name__ == '__main__':
+    benchmark()
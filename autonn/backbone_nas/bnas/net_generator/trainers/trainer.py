@@ -20,7 +20,8 @@ def train(
         max_latency,
         pop_size,
         niter,
-        device):
+        device,
+        snapshot_path=None):
     '''
     NAS controllor
     '''
@@ -34,7 +35,8 @@ def train(
                 names,
                 max_latency,
                 pop_size,
-                niter)
+                niter,
+                snapshot_path=snapshot_path)
 
     _, best_net = enas.run_evolution_search()
 
@@ -0,0 +1,129 @@
+'''
+Latency lookup table of the neck candidate ops
+'''
+import json
+import os
+import platform
+import re
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+def get_target_name(device):
+    ''' name of the device the latency is measured on '''
+    if device.type == 'cuda':
+        name = torch.cuda.get_device_name(device)
+    else:
+        name = platform.processor() or platform.machine()
+    return re.sub(r'[^0-9A-Za-z_.-]+', '_', name)
+
+
+@torch.no_grad()
+def measure_latency(op, x, warmup=3, repeat=10):
+    ''' mean latency (ms) of op(x) '''
+    training = op.training
+    op.eval()
+    for _ in range(warmup):
+        op(x)
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    t = time.time()
+    for _ in range(repeat):
+        op(x)
+    if x.is_cuda:
+        torch.cuda.synchronize(x.device)
+    op.train(training)
+    return (time.time() - t) / repeat * 1E3
+
+
+class NeckLatencyTable:
+    '''
+    Per-candidate-op latency of every layer choice of the neck,
+    measured once per target at the actual input feature-map sizes
+    and cached to disk ({table_dir}/{target}.json)
+    '''
+    def __init__(self, table_dir, target=None):
+        self.table_dir = table_dir
+        self.target = target
+        self.entries = {}   # 'name|input shape' : [latency (ms) of op k]
+        self.latency = {}   # name : tensor of candidate latencies
+
+    @property
+    def path(self):
+        return os.path.join(self.table_dir, f'{self.target}.json')
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        os.makedirs(self.table_dir, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    @torch.no_grad()
+    def input_shapes(self, model, nas_modules, imgsz, device):
+        ''' input shape of every layer choice, from one forward pass '''
+        shapes, handles = {}, []
+        for name, module in nas_modules:
+            def hook(m, inputs, name=name):
+                shapes[name] = list(inputs[0].shape)
+            handles.append(module.register_forward_pre_hook(hook))
+            if module.sampled is None:
+                module.resample(arch_grad=False)
+        training = model.training
+        model.eval()
+        try:
+            model(torch.zeros(1, 3, imgsz, imgsz, device=device))
+        finally:
+            model.train(training)
+            for h in handles:
+                h.remove()
+        return shapes
+
+    def build(self, model, nas_modules, imgsz, device):
+        ''' load the cached table, measure the missing entries '''
+        self.target = self.target or get_target_name(device)
+        self.load()
+        shapes = self.input_shapes(model, nas_modules, imgsz, device)
+        updated = False
+        for name, module in nas_modules:
+            shape = shapes[name]
+            key = f'{name}|{"x".join(str(s) for s in shape)}'
+            if len(self.entries.get(key, [])) != len(module.ops):
+                x = torch.randn(shape, device=device)
+                self.entries[key] = [measure_latency(op, x)
+                                     for op in module.ops]
+                updated = True
+            self.latency[name] = torch.tensor(self.entries[key],
+                                              device=device)
+        if updated:
+            self.save()
+        print(f'- neck latency table for {self.target}: {self.path}')
+        for name, _ in nas_modules:
+            print(f'{name:>20} : ' +
+                  ' '.join('%.3f' % v for v in self.latency[name].tolist()))
+        return self
+
+    def expected_latency(self, nas_modules):
+        ''' sum of the candidate latencies weighted by softmax(alpha) '''
+        return sum(torch.sum(F.softmax(module.alpha, dim=-1) *
+                             self.latency[name])
+                   for name, module in nas_modules)
+
+    def max_latency(self, nas_modules):
+        ''' latency of the slowest architecture '''
+        return sum(self.latency[name].max().item()
+                   for name, _ in nas_modules)
+
+    def export_latency(self, nas_modules):
+        ''' latency of the exported (argmax) architecture '''
+        return sum(self.latency[name][module.export()].item()
+                   for name, module in nas_modules)
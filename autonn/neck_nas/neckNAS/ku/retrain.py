@@ -20,6 +20,7 @@ from .syolo_utils.general \
             strip_optimizer, plot_results, labels_to_image_weights,
             plot_images, fitness)
 from .syolo_utils.torch_utils import init_seeds, ModelEMA, intersect_dicts
+from .syolo_utils.ckpt_writer import CheckpointWriter
 
 
 class Retrain:
@@ -88,6 +89,8 @@ class Retrain:
         os.makedirs(self.wdir, exist_ok=True)
         self.last = self.wdir + 'last.pt'
         self.best = self.wdir + 'best.pt'
+        # checkpoints are written on a background thread
+        self.ckpt_writer = CheckpointWriter()
         self.results_file = str(self.log_dir / 'results.txt')
         self.batch_size, self.total_batch_size, self.rank = \
             args['batch_size'], args['total_batch_size'], args['global_rank']
@@ -206,8 +209,10 @@ class Retrain:
         t0 = time.time()
         for epoch in range(self.start_epoch, self.epochs):
             self._train_one_epoch(epoch)
+        self.ckpt_writer.close()
 
         if self.rank in [-1, 0]:
+            print(self.ckpt_writer.summary())
             # Strip optimizers
             n = ('_' if len(self.args['name']) and not
                  self.args['name'].isnumeric() else '') + self.args['name']
@@ -428,12 +433,12 @@ class Retrain:
                             'optimizer': None if final_epoch
                             else self.optimizer.state_dict()}
                 # Save last, best and delete
-                torch.save(ckpt, self.last)
+                paths = [self.last]
                 if epoch >= (self.epochs-5):
-                    torch.save(ckpt,
-                               self.last.replace('.pt',
-                                                 '_{:03d}.pt'.format(epoch)))
+                    paths.append(self.last.replace('.pt',
+                                                   '_{:03d}.pt'.format(epoch)))
                 if self.best_fitness == fi:
-                    torch.save(ckpt, self.best)
+                    paths.append(self.best)
+                self.ckpt_writer.save(ckpt, *paths)
                 del ckpt
         # end epoch --------------------------------------------------------
@@ -31,6 +31,8 @@ from .syolo_utils.general \
             plot_results, plot_labels)
 from .syolo_utils.torch_utils \
     import init_seeds, ModelEMA, intersect_dicts, is_parallel
+from .syolo_utils.ckpt_writer import CheckpointWriter
+from .latency_table import NeckLatencyTable
 from tqdm import tqdm
 
 
@@ -57,9 +59,11 @@ class ArchGradientFunction(torch.autograd.Function):
 
         grad_x = torch.autograd.grad(output, detached_x, grad_output,
                                      only_inputs=True)
-        # compute gradients w.r.t. binary_gates
-        binary_grads = ctx.backward_func(detached_x.data, output.data,
-                                         grad_output.data)
+        # compute gradients w.r.t. binary_gates (not needed for weight steps)
+        binary_grads = None
+        if ctx.needs_input_grad[1]:
+            binary_grads = ctx.backward_func(detached_x.data, output.data,
+                                             grad_output.data)
 
         return grad_x[0], binary_grads, None, None
 
@@ -72,6 +76,37 @@ class ProxylessLayerChoice(nn.Module):
         self.alpha = nn.Parameter(torch.randn(len(self.ops)) * 1E-3)
         self._binary_gates = nn.Parameter(torch.randn(len(self.ops)) * 1E-3)
         self.sampled = None
+        # candidates of the binary gate gradients, all ops or two sampled paths
+        self.candidates = list(range(len(self.ops)))
+        self.old_alpha = None
+        self.streams = []
+
+    def get_streams(self, n, device):
+        # side cuda streams to run the candidate ops concurrently
+        while len(self.streams) < n:
+            self.streams.append(torch.cuda.Stream(device=device))
+        return self.streams[:n]
+
+    def candidate_grads(self, x, output, grad_output, sampled, candidates):
+        '''
+        sum(out_k * grad_output) of every candidate op k,
+        the ops which are not sampled run concurrently on side cuda streams
+        '''
+        grads = {sampled: torch.sum(output * grad_output)}
+        others = [k for k in candidates if k != sampled]
+        if x.is_cuda and len(others) > 1:
+            current = torch.cuda.current_stream(x.device)
+            for k, stream in zip(others, self.get_streams(len(others), x.device)):
+                stream.wait_stream(current)
+                with torch.cuda.stream(stream):
+                    grads[k] = torch.sum(self.ops[k](x) * grad_output)
+                grads[k].record_stream(current)
+            for stream in self.streams[:len(others)]:
+                current.wait_stream(stream)
+        else:
+            for k in others:
+                grads[k] = torch.sum(self.ops[k](x) * grad_output)
+        return grads
 
     def forward(self, *args):
         def run_function(ops, active_id):
@@ -79,17 +114,14 @@ class ProxylessLayerChoice(nn.Module):
                 return ops[active_id](_x)
             return forward
 
-        def backward_function(ops, active_id, binary_gates):
+        def backward_function(binary_gates, active_id, candidates):
             def backward(_x, _output, grad_output):
                 binary_grads = torch.zeros_like(binary_gates.data)
                 with torch.no_grad():
-                    for k in range(len(ops)):
-                        if k != active_id:
-                            out_k = ops[k](_x.data)
-                        else:
-                            out_k = _output.data
-                        grad_k = torch.sum(out_k * grad_output)
-                        binary_grads[k] = grad_k
+                    grads = self.candidate_grads(_x.data, _output.data, grad_output,
+                                                 active_id, candidates)
+                    index = torch.tensor(list(grads.keys()), device=binary_grads.device)
+                    binary_grads[index] = torch.stack(list(grads.values())).to(binary_grads)
                 return binary_grads
             return backward
 
@@ -97,27 +129,52 @@ class ProxylessLayerChoice(nn.Module):
         x = args[0]
         return ArchGradientFunction.apply(
             x, self._binary_gates, run_function(self.ops, self.sampled),
-            backward_function(self.ops, self.sampled, self._binary_gates))
-
-    def resample(self):
+            backward_function(self._binary_gates, self.sampled, self.candidates))
+
+    def resample(self, two_path=False, arch_grad=True):
+        '''
+        two_path : two paths are sampled and only their gradients are computed
+                   (path sampling of ProxylessNAS, for the architecture update)
+        arch_grad : if False the binary gate gradients are skipped (weight update)
+        '''
         probs = F.softmax(self.alpha, dim=-1)
-        sample = torch.multinomial(probs, 1)[0].item()
+        if two_path and len(self.ops) > 2:
+            candidates = torch.multinomial(probs, 2, replacement=False)
+            slice_probs = F.softmax(self.alpha[candidates], dim=-1)
+            sample = candidates[torch.multinomial(slice_probs, 1)[0]].item()
+            self.candidates = candidates.tolist()
+            self.old_alpha = self.alpha.data[candidates].clone()
+        else:
+            sample = torch.multinomial(probs, 1)[0].item()
+            self.candidates = list(range(len(self.ops)))
+            self.old_alpha = None
         self.sampled = sample
         with torch.no_grad():
             self._binary_gates.zero_()
             self._binary_gates.grad = torch.zeros_like(self._binary_gates.data)
             self._binary_gates.data[sample] = 1.0
+        self._binary_gates.requires_grad_(arch_grad)
 
     def finalize_grad(self):
+        # d(loss)/d(alpha_i) = sum_j g_j * p_j * (delta_ij - p_i) = p_i * (g_i - sum_j g_j * p_j)
         binary_grads = self._binary_gates.grad
         with torch.no_grad():
             if self.alpha.grad is None:
                 self.alpha.grad = torch.zeros_like(self.alpha.data)
-            probs = F.softmax(self.alpha, dim=-1)
-            for i in range(len(self.ops)):
-                for j in range(len(self.ops)):
-                    self.alpha.grad[i] += binary_grads[j] * probs[j] \
-                                            * (int(i == j) - probs[i])
+            index = torch.tensor(self.candidates, device=self.alpha.device)
+            probs = F.softmax(self.alpha[index], dim=-1)
+            grads = binary_grads[index]
+            self.alpha.grad[index] += probs * (grads - torch.sum(grads * probs))
+
+    def rescale_alpha(self):
+        # two paths : keep the total probability of the sampled paths after the update
+        if self.old_alpha is None:
+            return
+        with torch.no_grad():
+            index = torch.tensor(self.candidates, device=self.alpha.device)
+            new_alpha = self.alpha.data[index]
+            offset = torch.logsumexp(new_alpha, 0) - torch.logsumexp(self.old_alpha, 0)
+            self.alpha.data[index] -= offset
 
     def export(self):
         return torch.argmax(self.alpha).item()
@@ -193,6 +250,8 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
         self.device = torch.device('cuda' if torch.cuda.is_available()
                                    else 'cpu') if device is None else device
         self.num_workers = self.train_loader.num_workers
+        # architecture update with two sampled paths instead of all candidates
+        self.two_path = args.get('arch_two_path', False)
 
         # print(f'Hyperparameters {self.hyp}')
         print('Hyperparameters----------------------')
@@ -206,6 +265,8 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
         os.makedirs(self.wdir, exist_ok=True)
         self.last = self.wdir + 'last.pt'
         self.best = self.wdir + 'best.pt'
+        # checkpoints are written on a background thread
+        self.ckpt_writer = CheckpointWriter()
         self.results_file = str(self.log_dir / 'results.txt')
         self.batch_size, self.total_batch_size, self.rank = \
             args['batch_size'], args['total_batch_size'], args['global_rank']
@@ -255,6 +316,16 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
             torch.optim.Adam([m.alpha for _, m in self.nas_modules],
                              arc_learning_rate, weight_decay=0,
                              betas=(0, 0.999), eps=1e-8)
+
+        # expected latency regularizer from the latency table of the ops
+        self.latency_lambda = args.get('latency_lambda', 0.0)
+        self.latency_budget = args.get('latency_budget', 0.0)
+        self.latency_table = None
+        if self.latency_lambda > 0:
+            self.latency_table = NeckLatencyTable(
+                args.get('latency_table_dir', 'neckNAS/ku/result/latency/'),
+                args.get('latency_target') or None).build(
+                    self.model, self.nas_modules, self.image_size, self.device)
         # Resume
         pretrained = os.path.isfile(self.args['weights']) and self.args['weights'].endswith('.pt')
         self.start_epoch, self.best_fitness = 0, 0.0
@@ -453,7 +524,7 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
             if ni > self.nw:
                 # 1) train architecture parameters
                 for _, module in self.nas_modules:
-                    module.resample()
+                    module.resample(two_path=self.two_path)
                 self.ctrl_optim.zero_grad()
                 try:    # len(test_loader) < len(train_loader)
                     imgs_test, targets_test, _, _ = \
@@ -471,11 +542,15 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
                 loss.backward()
                 for _, module in self.nas_modules:
                     module.finalize_grad()
+                if self.latency_table is not None:
+                    self._latency_loss().backward()
                 self.ctrl_optim.step()
+                for _, module in self.nas_modules:
+                    module.rescale_alpha()
 
             # 2) train model parameters
             for module_name, module in self.nas_modules:
-                module.resample()
+                module.resample(arch_grad=False)
             loss, loss_items = \
                 self._loss_and_items_for_weight_update(imgs,
                                                        targets.to(self.device))
@@ -589,6 +664,15 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
                         'val/giou_loss', 'val/obj_loss', 'val/cls_loss']
                 for x, tag in zip(list(mloss[:-1]) + list(self.results), tags):
                     self.writer.add_scalar(tag, x, epoch)
+                if self.latency_table is not None:
+                    self.writer.add_scalar(
+                        'arch/expected_latency',
+                        float(self.latency_table.expected_latency(
+                            self.nas_modules)), epoch)
+                    self.writer.add_scalar(
+                        'arch/export_latency',
+                        self.latency_table.export_latency(self.nas_modules),
+                        epoch)
 
             # Update best mAP
             # fitness_i = weighted combination of [P, R, mAP, F1]
@@ -612,16 +696,27 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
                                 else self.ctrl_optim.state_dict()}
 
                 # Save last, best and delete
-                torch.save(ckpt, self.last)
+                paths = [self.last]
                 if epoch >= (self.epochs-5):
-                    torch.save(ckpt,
-                               self.last.replace('.pt',
-                                                 '_{:03d}.pt'.format(epoch)))
+                    paths.append(self.last.replace('.pt',
+                                                   '_{:03d}.pt'.format(epoch)))
                 if self.best_fitness == fi:
-                    torch.save(ckpt, self.best)
+                    paths.append(self.best)
+                self.ckpt_writer.save(ckpt, *paths)
                 del ckpt
         # end epoch ---------------------------------------------------------
 
+    def _latency_loss(self):
+        ''' expected latency (ms) of the neck ops under softmax(alpha),
+            hinge on latency_budget if given, else relative to the slowest
+            architecture '''
+        latency = self.latency_table.expected_latency(self.nas_modules)
+        if self.latency_budget > 0:
+            return self.latency_lambda * \
+                F.relu(latency / self.latency_budget - 1)
+        return self.latency_lambda * latency / \
+            self.latency_table.max_latency(self.nas_modules)
+
     def _loss_and_items_for_arch_update(self, imgs, targets):
         ''' return loss and loss_items for architecture parameter update '''
         pred = self.model(imgs)
@@ -644,8 +739,10 @@ class ProxylessDetTrainer(BaseOneShotTrainer):
         t0 = time.time()
         for epoch in range(self.start_epoch, self.epochs):
             self._train_one_epoch(epoch)
+        self.ckpt_writer.close()
 
         if self.rank in [-1, 0]:
+            print(self.ckpt_writer.summary())
             # Strip optimizers
             n = ('_' if len(self.args['name']) and not
                  self.args['name'].isnumeric() else '') + self.args['name']
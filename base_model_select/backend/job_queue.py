@@ -0,0 +1,188 @@
+import multiprocessing as mp
+import os
+import subprocess
+import threading
+import time
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from . import models
+
+
+PREFIX = '[ BMS - JobQueue ]'
+DEBUG = False
+
+POLL_INTERVAL = 1.0         # sec, idle worker polling interval
+SUPERVISE_INTERVAL = 2.0    # sec, dead worker check interval
+WAIT_TIME_WINDOW = 50       # number of recent jobs used for the average wait time
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+STOPPED = 'stopped'
+
+
+def get_gpu_ids():
+    '''
+    Ids of the gpus the server may use, found without cuda
+    (cuda must not be initialized before the workers are forked)
+    '''
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is not None:
+        return [d.strip() for d in visible.split(',') if d.strip() not in ('', '-1')]
+    try:
+        out = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [str(i) for i, _ in enumerate(l for l in out.splitlines() if l.startswith('GPU '))]
+
+
+def get_devices(gpu_ids):
+    '''
+    One worker per gpu (one job per gpu at a time), a single cpu worker otherwise
+    '''
+    return list(range(len(gpu_ids))) if gpu_ids else [-1]
+
+
+def claim_next_job(device):
+    '''
+    Atomically move the oldest queued job to running
+    '''
+    while True:
+        with transaction.atomic():
+            job = models.Job.objects.filter(status=QUEUED).order_by('id').first()
+            if job is None:
+                return None
+            claimed = models.Job.objects.filter(id=job.id, status=QUEUED).update(
+                status=RUNNING, device=device, worker_pid=os.getpid(), started_at=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def worker_loop(device, gpu_id, num_gpus, job_func):
+    '''
+    Warm worker: torch and the BMS code are imported once and reused for every job
+    The worker only sees its own gpu, num_gpus (gpus of the server) is passed to the jobs
+    '''
+    # the connections of the parent must not be shared with the forked worker
+    connections.close_all()
+    if device >= 0:
+        # the parent never initializes cuda, so the worker can still select its gpu
+        os.environ['CUDA_VISIBLE_DEVICES'] = gpu_id
+    import torch
+
+    print(f'{PREFIX} worker {os.getpid()} is ready (device: {"cuda:" + str(device) if device >= 0 else "cpu"})')
+    while True:
+        job = claim_next_job(device)
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        print(f'{PREFIX} worker {os.getpid()} runs job {job.id} (user: {job.userid}, project: {job.project_id})')
+        status = COMPLETED
+        try:
+            job_func(job.proj_info_yaml, job.userid, job.project_id, num_gpus=num_gpus)
+        except Exception as e:
+            print(f'{PREFIX} job {job.id} failed: {e}')
+            status = FAILED
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        models.Job.objects.filter(id=job.id, status=RUNNING).update(status=status, finished_at=timezone.now())
+
+
+class JobPool:
+    '''
+    Bounded pool of warm worker processes consuming the persistent Job table.
+    Jobs that were running when the server stopped are queued again on start,
+    and a worker that dies is replaced (its job is marked as failed).
+    '''
+    def __init__(self, job_func):
+        self.job_func = job_func
+        self.workers = {}   # device : process
+        self.gpu_ids = []   # device : gpu id (CUDA_VISIBLE_DEVICES of its worker)
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            requeued = models.Job.objects.filter(status=RUNNING).update(
+                status=QUEUED, device=None, worker_pid=None, started_at=None)
+            if requeued:
+                print(f'{PREFIX} {requeued} interrupted job(s) are queued again')
+            connections.close_all()
+
+            self.gpu_ids = get_gpu_ids()
+            for device in get_devices(self.gpu_ids):
+                self._spawn(device)
+            threading.Thread(target=self._supervise, daemon=True).start()
+            self.started = True
+
+    def _spawn(self, device):
+        gpu_id = self.gpu_ids[device] if device >= 0 else None
+        worker = mp.Process(target=worker_loop, args=(device, gpu_id, len(self.gpu_ids), self.job_func), daemon=True)
+        worker.start()
+        self.workers[device] = worker
+
+    def _supervise(self):
+        while True:
+            time.sleep(SUPERVISE_INTERVAL)
+            with self.lock:
+                for device, worker in list(self.workers.items()):
+                    if worker.is_alive():
+                        continue
+                    models.Job.objects.filter(status=RUNNING, worker_pid=worker.pid).update(
+                        status=FAILED, finished_at=timezone.now())
+                    print(f'{PREFIX} worker {worker.pid} exited ({worker.exitcode}), restarting')
+                    self._spawn(device)
+
+    def submit(self, userid, project_id, proj_info_yaml):
+        self.start()
+        return models.Job.objects.create(userid=userid, project_id=project_id,
+                                         proj_info_yaml=str(proj_info_yaml), status=QUEUED)
+
+    def stop(self, job_id):
+        '''
+        Queued job: skipped. Running job: its worker is terminated and replaced.
+        '''
+        self.start()
+        if models.Job.objects.filter(id=job_id, status=QUEUED).update(status=STOPPED, finished_at=timezone.now()):
+            return True
+
+        job = models.Job.objects.filter(id=job_id, status=RUNNING).first()
+        if job is None:
+            return False
+        with self.lock:
+            worker = self.workers.get(job.device)
+            if worker is None or worker.pid != job.worker_pid:
+                return False
+            models.Job.objects.filter(id=job.id).update(status=STOPPED, finished_at=timezone.now())
+            worker.terminate()
+            worker.join()
+            self._spawn(job.device)
+        return True
+
+    def get_status(self, job_id):
+        job = models.Job.objects.filter(id=job_id).first()
+        return job.status if job is not None else None
+
+    def get_stats(self):
+        now = timezone.now()
+        queued = models.Job.objects.filter(status=QUEUED)
+        oldest = queued.order_by('id').first()
+        recent = models.Job.objects.filter(started_at__isnull=False) \
+                                   .order_by('-id') \
+                                   .values_list('created_at', 'started_at')[:WAIT_TIME_WINDOW]
+        waits = [(started_at - created_at).total_seconds() for created_at, started_at in recent]
+        return {
+            'workers': len(self.workers),
+            'queue_depth': queued.count(),
+            'running': models.Job.objects.filter(status=RUNNING).count(),
+            'oldest_wait_sec': (now - oldest.created_at).total_seconds() if oldest is not None else 0.0,
+            'avg_wait_sec': sum(waits) / len(waits) if waits else 0.0,
+        }
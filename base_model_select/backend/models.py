@@ -32,3 +32,30 @@ class Info(models.Model):
 
     model_type = models.CharField(blank=True, null=True, max_length=50, default='Not Selected')
     model_size = models.CharField(blank=True, null=True, max_length=50, default='Not Selected')
+
+
+class Job(models.Model):
+    '''BMS Job (persistent queue entry)'''
+    id = models.AutoField(primary_key=True)
+
+    # user id
+    userid = models.CharField(blank=True, null=True, max_length=50, default='')
+
+    # project id
+    project_id = models.CharField(blank=True, null=True, max_length=50, default='')
+
+    # project_info.yaml path
+    proj_info_yaml = models.CharField(blank=True, null=True, max_length=256, default='')
+
+    # status ( queued, running, completed, failed, stopped )
+    status = models.CharField(blank=True, null=True, max_length=10, default='queued')
+
+    # gpu index of the worker ( -1 : cpu )
+    device = models.IntegerField(blank=True, null=True)
+
+    # pid of the worker process running the job
+    worker_pid = models.IntegerField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
@@ -17,11 +17,13 @@ from django.shortcuts import render
 from pathlib import Path
 
 from . import models
+from .job_queue import JobPool, QUEUED, RUNNING
 from batch_test.batch_size_test import run_batch_test
 
 
 PREFIX = '[ BMS ]'
 PROCESSES = {}
+JOB_POOL = None
 
 task_to_model_table = {"detection": "yolov7", "classification": "resnet"}
 model_to_size_table = {
@@ -128,17 +130,13 @@ def start(request):
     try:
         proj_info_yaml = get_user_requirements(userid, project_id)
 
-        pr = mp.Process(target=bms_process, args=(proj_info_yaml, userid, project_id), daemon=True)
-
-        pr_id = get_process_id()
-        PROCESSES[pr_id] = pr
-        PROCESSES[pr_id].start()
-        print(f'{len(PROCESSES)}-th process is starting')
+        job = get_job_pool().submit(userid, project_id, proj_info_yaml)
+        print(f'{PREFIX} job {job.id} is queued ({get_job_pool().get_stats()["queue_depth"]} waiting)')
 
         bmsinfo.proj_info_yaml=str(proj_info_yaml)
         bmsinfo.status="started"
 
-        bmsinfo.process_id = pr_id
+        bmsinfo.process_id = str(job.id)
         bmsinfo.save()
         return Response("started", status=200, content_type="text/plain")
     except Exception as e_message:
@@ -162,7 +160,8 @@ def stop_api(request):
         return Response('failed', status=200, content_type='text/plain')
 
     try:
-        PROCESSES[str(bmsinfo.process_id)].terminate()
+        if not get_job_pool().stop(int(bmsinfo.process_id)):
+            return Response("failed", status=200, content_type="text/plain")
         bmsinfo.status = "stopped"
         bmsinfo.save()
         return Response("stopped", status=200, content_type="text/plain")
@@ -189,11 +188,15 @@ def status_request(request):
         return Response("ready", status=200, content_type='text/plain')
 
     try:
-        if PROCESSES[str(bmsinfo.process_id)].is_alive():
-            print("found thread running nas")
+        job_status = get_job_pool().get_status(int(bmsinfo.process_id))
+        if job_status == RUNNING:
+            print("found worker running bms")
             bmsinfo.status = "running"
             bmsinfo.save()
             return Response("running", status=200, content_type='text/plain')
+        elif job_status == QUEUED:
+            print("bms job is waiting for a free worker")
+            return Response("started", status=200, content_type='text/plain')
         else:
             print("tracked bms you want, but not running anymore")
             if bmsinfo.status in ["started", "running"]:
@@ -208,6 +211,22 @@ def status_request(request):
         return Response(bmsinfo.status, status=200, content_type='text/plain')
 
 
+@api_view(['GET'])
+def queue_status(request):
+    '''
+    Queue depth / wait time of the BMS job queue
+    '''
+    return Response(get_job_pool().get_stats(), status=200)
+
+
+def get_job_pool():
+    global JOB_POOL
+    if JOB_POOL is None:
+        JOB_POOL = JobPool(bms_process)
+    JOB_POOL.start()
+    return JOB_POOL
+
+
 def status_report(userid, project_id, status="success"):
     try:
         url = 'http://projectmanager:8085/status_report'
@@ -233,7 +252,7 @@ def status_report(userid, project_id, status="success"):
         print(e)
 
 
-def bms_process(yaml_path, userid, project_id):
+def bms_process(yaml_path, userid, project_id, num_gpus=None):
     with open(yaml_path, 'r') as f:
         proj_info_dict = yaml.load(f, Loader=yaml.FullLoader)
 
@@ -246,6 +265,7 @@ def bms_process(yaml_path, userid, project_id):
                                 basemodel_dict['imgsz'] if proj_info_dict['task_type']=='detection' else 256,
                                 f"hyperparam_yaml/yolov7/hyp.scratch.{basemodel_dict['hyp']}.yaml" if proj_info_dict['task_type']=='detection' else None,
                                 True if proj_info_dict['target_info']=='Galaxy_S22' else False,
+                                num_gpus=num_gpus,
                                 )
 
     if batch_size == False:
@@ -22,6 +22,7 @@ urlpatterns = [
     path('start', views.start, name="StartBMS"),
     path("stop", views.stop_api, name="StopBMS"),
     path("status_request", views.status_request, name="StatusRequestBMS"),
+    path("queue_status", views.queue_status, name="QueueStatusBMS"),
     path("get_ready_for_test", views.get_ready_for_test, name="get_ready_for_test"),
     path("view_status", views.view_status, name="ViewStatus"),
     path("manual_change", views.manual_change, name="ManualChange"),
@@ -0,0 +1,107 @@
+import fcntl
+import hashlib
+import json
+import os
+import platform
+
+import torch
+
+
+PREFIX = '[ BMS - AutoBatch - Cache ]'
+DEBUG = False
+
+CACHE_VERSION = 1   # bump when the batch size estimation changes
+CACHE_PATH = os.environ.get('BMS_BATCH_CACHE', '/shared/common/.bms/batch_size_cache.json')
+
+
+def get_library_version():
+    '''
+    Versions that can change memory usage; a change invalidates every entry
+    '''
+    return {
+        'cache': CACHE_VERSION,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'cuda': torch.version.cuda,
+        'cudnn': torch.backends.cudnn.version() if torch.backends.cudnn.is_available() else None,
+    }
+
+
+def get_device_fingerprint(num_gpus=None):
+    if torch.cuda.is_available():
+        props = torch.cuda.get_device_properties(0)
+        num_gpus = torch.cuda.device_count() if num_gpus is None else num_gpus
+        return f'{props.name}:{props.total_memory}:x{num_gpus}'
+
+    mem_total = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    mem_total = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    return f'cpu:{platform.machine()}:{mem_total}'
+
+
+def file_digest(path):
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def make_cache_key(model_yaml, task, imgsz, hyp_yaml, nas, amp, num_gpus=None):
+    key = {
+        'model': file_digest(model_yaml),
+        'task': task,
+        'imgsz': imgsz,
+        'hyp': file_digest(hyp_yaml),
+        'nas': bool(nas),
+        'amp': bool(amp),
+        'device': get_device_fingerprint(num_gpus),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class BatchSizeCache:
+    '''
+    Persistent {key: batch size} table shared by every BMS process.
+    The whole table is dropped when the library versions differ.
+    '''
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != get_library_version():
+            if DEBUG: print(f'{PREFIX} library versions changed, cache is invalidated')
+            return {}
+        return data.get('entries', {})
+
+    def get(self, key):
+        try:
+            return self._load().get(key)
+        except Exception as e:
+            print(f'{PREFIX} failed to read the cache: {e}')
+            return None
+
+    def put(self, key, batch_size):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.lock_path, 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = self._load()
+                entries[key] = batch_size
+                tmp_path = f'{self.path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': get_library_version(), 'entries': entries}, f)
+                os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f'{PREFIX} failed to write the cache: {e}')
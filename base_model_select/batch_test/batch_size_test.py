@@ -13,26 +13,50 @@ from .resnet.resnet_cifar10 import ResNet as resnet_model
 from .resnet.resnet_cifar10 import BasicBlock
 
 from .binary_search import TestFuncGen, binary_search
+from .memory_model import estimate_gpu_batch_size, estimate_cpu_batch_size
+from .batch_cache import BatchSizeCache, make_cache_key
 
 
 PREFIX = '[ BMS - AutoBatch ]'
 DEBUG = False
 
+SUPERNET_YAML = str(Path(os.path.dirname(__file__))/'yolo'/'nas'/'supernet'/'yolov7_supernet.yml')
+AMP = True
 
-def run_batch_test(basemodel_yaml, task, imgsz, hyp_yaml=None, nas=None):
+
+def run_batch_test(basemodel_yaml, task, imgsz, hyp_yaml=None, nas=None, num_gpus=None):
+    '''
+    num_gpus : gpus the training will use (a BMS worker only sees its own gpu),
+               the visible gpus if None
+    '''
     print(f'{PREFIX} Start AutoBatch')
+    if num_gpus is None:
+        num_gpus = torch.cuda.device_count()
+    if task not in ('detection', 'classification'):
+        if DEBUG: print(f'{PREFIX} task is unknown ({task})')
+        return None
+
+    # same model / image size / device as a previous project -> skip probing
+    cache = BatchSizeCache()
+    cache_key = make_cache_key(SUPERNET_YAML if task=='detection' and nas else basemodel_yaml,
+                               task, imgsz, hyp_yaml, task=='detection' and nas, AMP, num_gpus)
+    batch_size = cache.get(cache_key)
+    if batch_size is not None:
+        print(f'{PREFIX} Selcted Batch Size - {batch_size} (cached)')
+        return batch_size
+
     if task=='detection':
         with open(hyp_yaml, 'r') as f:
             hyp = yaml.load(f, Loader=yaml.SafeLoader)  # load hyps
         if nas:
-            model = YOLOSuperNet(str(Path(os.path.dirname(__file__))/'yolo'/'nas'/'supernet'/'yolov7_supernet.yml'), ch=3, nc=80, anchors=hyp.get('anchors'))
+            model = YOLOSuperNet(SUPERNET_YAML, ch=3, nc=80, anchors=hyp.get('anchors'))
             model.set_max_net()
             if DEBUG: print(f'{PREFIX} YOLOSuperNet is used for AutoBatch.')
         else:
             model = yolo_model(basemodel_yaml, ch=3, nc=80, anchors=hyp.get('anchors'))
             if DEBUG: print(f'{PREFIX} YOLO is used for AutoBatch.')
 
-    elif task=='classification':
+    else:
         with open(basemodel_yaml, 'r') as f:
             basemodel_dict = yaml.load(f, Loader=yaml.SafeLoader)
         model = resnet_model(BasicBlock,
@@ -40,11 +64,7 @@ def run_batch_test(basemodel_yaml, task, imgsz, hyp_yaml=None, nas=None):
                              basemodel_dict.get('num_classes', 2))
         if DEBUG: print(f'{PREFIX} {task} model is used for AutoBatch.')
 
-    else:
-        if DEBUG: print(f'{PREFIX} task is unknown ({task})')
-        return None
-
-    batch_size = int(get_batch_size_for_gpu(model, 3 if task=='detection' else 1, imgsz, amp=True) * 0.9)
+    batch_size = int(get_batch_size_for_gpu(model, 3 if task=='detection' else 1, imgsz, amp=AMP) * 0.9)
     # It assumes that the memory sizes of all gpus in a machine are same.
     # 0.8 is multiplied by batch size to prevent cuda memory error due to a memory leak of yolov7
 
@@ -52,9 +72,12 @@ def run_batch_test(basemodel_yaml, task, imgsz, hyp_yaml=None, nas=None):
     torch.cuda.empty_cache()
     gc.collect()
 
-    batch_size = False if batch_size < 2 else batch_size * torch.cuda.device_count()
+    batch_size = False if batch_size < 2 else batch_size * max(num_gpus, 1)
     print(f'{PREFIX} Selcted Batch Size - {batch_size} (0.9 * batch size for a gpu * gpu_num)')
 
+    if batch_size:
+        cache.put(cache_key, batch_size)
+
     return batch_size
 
 
@@ -64,15 +87,41 @@ def get_batch_size_for_gpu(model, ch, imgsz, amp):
 
 
 def autobatch(model, ch, imgsz, batch_size=4):
-    if torch.cuda.is_available():
-       num_dev = torch.cuda.device_count()
-    else:
-       print(f'{PREFIX} CUDA not detected, using default CPU batch size {batch_size}')
-       return batch_size
+    if not torch.cuda.is_available():
+        print(f'{PREFIX} CUDA not detected, estimating batch size from host memory')
+        predicted = estimate_cpu_batch_size(model, ch, imgsz)
+        return predicted if predicted is not None else batch_size
 
     device = torch.device(f'cuda:0')
     model.to(device)
     model.train()
+
+    # fit memory = fixed + per_sample * batch with small probes and predict the max batch
+    predicted, probed = estimate_gpu_batch_size(model, ch, imgsz, device)
+    if predicted is None:
+        # a probe failed : fall back to the doubling + binary search
+        return doubling_search(model, ch, imgsz, device)
+    if predicted <= probed:
+        # already measured by the probes
+        return max(predicted, 0)
+
+    # verify only at the predicted point
+    test_func = TestFuncGen(model, ch, imgsz)
+    torch.cuda.empty_cache()
+    if test_func(predicted):
+        if DEBUG: print(f'{PREFIX} verified: ', predicted)
+        torch.cuda.empty_cache()
+        return predicted
+
+    # prediction was too optimistic (fragmentation, workspace of cudnn ...)
+    print(f'{PREFIX} predicted batch size {predicted} failed, searching between {probed} and {predicted}')
+    torch.cuda.empty_cache()
+    final_batch_size = binary_search(probed, predicted, test_func, want_to_get=True)
+    torch.cuda.empty_cache()
+    return final_batch_size
+
+
+def doubling_search(model, ch, imgsz, device):
     batch_size = 2
     while True:
         img = torch.zeros(batch_size, ch, imgsz, imgsz).float()
@@ -0,0 +1,152 @@
+import math
+
+import torch
+
+
+PREFIX = '[ BMS - AutoBatch - Memory Model ]'
+DEBUG = False
+
+PROBE_BATCH_SIZES = (1, 2, 4)   # small batches used to fit memory = fixed + per_sample * batch
+MEMORY_FRACTION = 0.9           # part of the available memory the training may use
+CPU_MAX_BATCH_SIZE = 64         # upper bound of the host RAM mode (cpu training is slow anyway)
+OPTIMIZER_STATES = 2            # Adam / SGD with momentum : up to 2 states per parameter
+
+
+def run_train_step(model, ch, imgsz, batch_size, device):
+    img = torch.zeros(batch_size, ch, imgsz, imgsz, device=device).float()
+    try:
+        y = model(img)
+        y = y[1] if isinstance(y, list) else y
+        loss = y.mean()
+        loss.backward() # need to free the variables of the graph
+    finally:
+        del img
+        model.zero_grad(set_to_none=True)
+
+
+def profile_gpu_memory(model, ch, imgsz, batch_size, device):
+    '''
+    Peak memory (bytes) of one forward/backward pass on the gpu
+    '''
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    run_train_step(model, ch, imgsz, batch_size, device)
+    torch.cuda.synchronize(device)
+    peak = torch.cuda.memory_stats(device)['allocated_bytes.all.peak']
+    if DEBUG: print(f'{PREFIX} batch {batch_size}: peak {peak / 2**20:.1f} MiB')
+    return peak
+
+
+def fit_linear(xs, ys):
+    '''
+    Least squares fit of y = a + b * x
+    '''
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    a = mean_y - b * mean_x
+    return a, b
+
+
+def predict_batch_size(fixed, per_sample, budget):
+    if per_sample <= 0:
+        return None
+    return int(math.floor((budget - fixed) / per_sample))
+
+
+def estimate_gpu_batch_size(model, ch, imgsz, device):
+    '''
+    Fit a linear memory-vs-batch curve from a few small probe batches and
+    predict the largest batch that fits into the free gpu memory
+
+    Returns:
+        (predicted batch size, largest probed batch size) or (None, None) if a probe fails
+    '''
+    torch.cuda.empty_cache()
+    peaks = []
+    for batch_size in PROBE_BATCH_SIZES:
+        try:
+            peaks.append(profile_gpu_memory(model, ch, imgsz, batch_size, device))
+        except RuntimeError as e:
+            print(f'{PREFIX} probe with batch size {batch_size} failed: {e}')
+            torch.cuda.empty_cache()
+            return None, None
+
+    fixed, per_sample = fit_linear(PROBE_BATCH_SIZES, peaks)
+
+    # free memory of the device + memory already held by this process (model weights, cached blocks)
+    free, total = torch.cuda.mem_get_info(device)
+    budget = (free + torch.cuda.memory_reserved(device)) * MEMORY_FRACTION
+    batch_size = predict_batch_size(fixed, per_sample, budget)
+    print(f'{PREFIX} gpu memory model: {fixed / 2**20:.1f} MiB + {per_sample / 2**20:.1f} MiB * batch, '
+          f'budget {budget / 2**20:.1f} MiB (total {total / 2**20:.1f} MiB) -> batch size {batch_size}')
+    return batch_size, max(PROBE_BATCH_SIZES)
+
+
+def activation_bytes_per_sample(model, ch, imgsz):
+    '''
+    Sum of the output sizes of all leaf modules for one sample
+    (activations kept for backward), measured with forward hooks on the cpu
+    '''
+    total = [0]
+
+    def hook(module, inputs, outputs):
+        outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+        for o in outputs:
+            if isinstance(o, torch.Tensor):
+                total[0] += o.numel() * o.element_size()
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, ch, imgsz, imgsz))
+    finally:
+        for h in handles:
+            h.remove()
+    return total[0]
+
+
+def get_host_available_memory():
+    '''
+    MemAvailable of /proc/meminfo (bytes)
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def estimate_cpu_batch_size(model, ch, imgsz):
+    '''
+    Host RAM mode: per-layer activation-size walk + parameter/gradient/optimizer
+    memory, so the batch size can be estimated on machines without gpus
+
+    Returns:
+        predicted batch size or None
+    '''
+    model.to('cpu')
+    model.train()
+
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    fixed = param_bytes * (2 + OPTIMIZER_STATES)    # weights + gradients + optimizer states
+    # activations are kept for backward and their gradients are created during backward
+    per_sample = activation_bytes_per_sample(model, ch, imgsz) * 2
+
+    available = get_host_available_memory()
+    if available is None:
+        print(f'{PREFIX} host memory is unknown')
+        return None
+
+    budget = available * MEMORY_FRACTION
+    batch_size = predict_batch_size(fixed, per_sample, budget)
+    if batch_size is not None:
+        batch_size = min(batch_size, CPU_MAX_BATCH_SIZE)
+    print(f'{PREFIX} host memory model: {fixed / 2**20:.1f} MiB + {per_sample / 2**20:.1f} MiB * batch, '
+          f'budget {budget / 2**20:.1f} MiB -> batch size {batch_size}')
+    return batch_size
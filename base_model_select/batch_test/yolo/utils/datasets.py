@@ -1,6 +1,7 @@
 # Dataset utils and dataloaders
 
 import glob
+import hashlib
 import logging
 import math
 import os
@@ -8,7 +9,7 @@ import random
 import shutil
 import time
 from itertools import repeat
-from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
 from threading import Thread
 
@@ -36,6 +37,8 @@ from .torch_utils import torch_distributed_zero_first
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo']  # acceptable image suffixes
 vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv']  # acceptable video suffixes
+NUM_THREADS = min(8, max(1, os.cpu_count() - 1))  # number of label scan processes
+CACHE_VERSION = 0.2  # dataset labels *.cache version
 logger = logging.getLogger(__name__)
 
 # Get orientation exif tag
@@ -44,9 +47,21 @@ for orientation in ExifTags.TAGS.keys():
         break
 
 
+def get_file_stat(f):
+    # Returns (size, mtime) of a file or None if it does not exist
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
 def get_hash(files):
-    # Returns a single hash value of a list of files
-    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+    # Returns a single hash value of a list of files (paths, sizes and modification times)
+    h = hashlib.md5()
+    for f in files:
+        h.update(f'{f}:{get_file_stat(f)}'.encode())
+    return h.hexdigest()
 
 
 def exif_size(img):
@@ -393,8 +408,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         print(cache_path)
         if cache_path.is_file():
             cache, exists = torch.load(cache_path), True  # load
-            #if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-            #    cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
+            if cache.get('version') != CACHE_VERSION or cache.get('hash') != get_hash(self.label_files + self.img_files):  # changed
+                cache, exists = self.cache_labels(cache_path, prefix, cache), False  # re-cache (unchanged files are reused)
         else:
             cache, exists = self.cache_labels(cache_path, prefix), False  # cache
 
@@ -408,6 +423,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Read cache
         cache.pop('hash')  # remove hash
         cache.pop('version')  # remove version
+        cache.pop('stats')  # remove file stats
         labels, shapes, self.segments = zip(*cache.values())
         self.labels = list(labels)
         self.shapes = np.array(shapes, dtype=np.float64)
@@ -470,59 +486,52 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
             pbar.close()
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', old_cache=None):
         # Cache dataset labels, check images and read shapes
+        # files whose (size, mtime) did not change since old_cache are not verified again
         x = {}  # dict
+        stats = {}  # im_file: ((image stat, label stat), (nm, nf, ne))
         nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
-            try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == 5, 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
-                    else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
-                else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-        pbar.close()
+        old_stats = old_cache.get('stats', {}) if old_cache and old_cache.get('version') == CACHE_VERSION else {}
+
+        todo = []
+        for im_file, lb_file in zip(self.img_files, self.label_files):
+            stat = (get_file_stat(im_file), get_file_stat(lb_file))
+            old = old_stats.get(im_file)
+            if old is not None and old[0] == stat and im_file in old_cache:
+                x[im_file] = old_cache[im_file]
+                stats[im_file] = old
+                nm, nf, ne = nm + old[1][0], nf + old[1][1], ne + old[1][2]
+            else:
+                todo.append((im_file, lb_file, stat))
+
+        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+        if todo:
+            with Pool(NUM_THREADS) as pool:
+                pbar = tqdm(pool.imap(verify_image_label, todo, chunksize=64), desc=desc, total=len(todo))
+                for im_file, l, shape, segments, stat, nm_f, nf_f, ne_f, nc_f, msg in pbar:
+                    nm += nm_f
+                    nf += nf_f
+                    ne += ne_f
+                    nc += nc_f
+                    if im_file:
+                        x[im_file] = [l, shape, segments]
+                        stats[im_file] = (stat, (nm_f, nf_f, ne_f))
+                    if msg:
+                        print(prefix + msg)
+                    pbar.desc = f"{desc} {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
+                pbar.close()
+        x = {f: x[f] for f in self.img_files if f in x}  # keep the order of the image files
 
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
 
         x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
+        x['results'] = nf, nm, ne, nc, len(self.img_files)
+        x['version'] = CACHE_VERSION  # cache version
+        x['stats'] = stats
         torch.save(x, path)  # save for next time
-        logging.info(f'{prefix}New cache created: {path}')
+        logging.info(f'{prefix}New cache created: {path} ({len(todo)} of {len(self.img_files)} files scanned)')
         return x
 
     def __len__(self):
@@ -665,6 +674,46 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         return torch.stack(img4, 0), torch.cat(label4, 0), path4, shapes4
 
 
+def verify_image_label(args):
+    # Verify one image-label pair, returns (im_file, labels, shape, segments, stat, nm, nf, ne, nc, msg)
+    im_file, lb_file, stat = args
+    nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupt
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if os.path.isfile(lb_file):
+            nf = 1  # label found
+            with open(lb_file, 'r') as f:
+                l = [x.split() for x in f.read().strip().splitlines()]
+                if any([len(x) > 8 for x in l]):  # is segment
+                    classes = np.array([x[0] for x in l], dtype=np.float32)
+                    segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+                    l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+                l = np.array(l, dtype=np.float32)
+            if len(l):
+                assert l.shape[1] == 5, 'labels require 5 columns each'
+                assert (l >= 0).all(), 'negative labels'
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+                assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            else:
+                ne = 1  # label empty
+                l = np.zeros((0, 5), dtype=np.float32)
+        else:
+            nm = 1  # label missing
+            l = np.zeros((0, 5), dtype=np.float32)
+        return im_file, l, shape, segments, stat, nm, nf, ne, nc, ''
+    except Exception as e:
+        nc = 1
+        return None, None, None, None, stat, nm, nf, ne, nc, f'WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+
+
 # Ancillary functions --------------------------------------------------------------------------------------------------
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
@@ -18,7 +18,6 @@ import os
 import random
 import sys
 import time
-from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
 
@@ -43,6 +42,7 @@ from models.yolo import Model
 from utils.autoanchor import check_anchors
 from utils.autobatch import check_train_batch_size
 from utils.callbacks import Callbacks
+from utils.ckpt_writer import CheckpointWriter
 from utils.dataloaders import create_dataloader
 from utils.downloads import attempt_download
 from utils.general import (LOGGER, check_amp, check_dataset, check_file, check_git_status, check_img_size,
@@ -297,6 +297,7 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
     stopper, stop = EarlyStopping(patience=opt.patience), False
     compute_loss = ComputeLoss(model)  # init loss class
     callbacks.run('on_train_start')
+    ckpt_writer = CheckpointWriter()  # checkpoints are written on a background thread
     LOGGER.info(f'Image sizes {imgsz} train, {imgsz} val\n'
                 f'Using {train_loader.num_workers * WORLD_SIZE} dataloader workers\n'
                 f"Logging results to {colorstr('bold', save_dir)}\n"
@@ -413,19 +414,22 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                 ckpt = {
                     'epoch': epoch,
                     'best_fitness': best_fitness,
-                    'model': deepcopy(de_parallel(model)).half(),
-                    'ema': deepcopy(ema.ema).half(),
+                    'model': de_parallel(model),
+                    'ema': ema.ema,
                     'updates': ema.updates,
                     'optimizer': optimizer.state_dict(),
                     'wandb_id': loggers.wandb.wandb_run.id if loggers.wandb else None,
                     'date': datetime.now().isoformat()}
 
-                # Save last, best and delete
-                torch.save(ckpt, last)
+                # Save last, best and delete (models are saved in fp16)
+                paths = [last]
                 if best_fitness == fi:
-                    torch.save(ckpt, best)
+                    paths.append(best)
                 if opt.save_period > 0 and epoch % opt.save_period == 0:
-                    torch.save(ckpt, w / f'epoch{epoch}.pt')
+                    paths.append(w / f'epoch{epoch}.pt')
+                ckpt_writer.save(ckpt, *paths, half=True)
+                if opt.save_period > 0 and (epoch + 1) % opt.save_period == 0:
+                    ckpt_writer.flush()  # the loggers upload last.pt
                 del ckpt
                 callbacks.run('on_model_save', last, epoch, final_epoch, best_fitness, fi)
 
@@ -440,7 +444,9 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
 
         # end epoch ----------------------------------------------------------------------------------------------------
     # end training -----------------------------------------------------------------------------------------------------
+    ckpt_writer.close()
     if RANK in {-1, 0}:
+        LOGGER.info(ckpt_writer.summary())
         LOGGER.info(f'\n{epoch - start_epoch + 1} epochs completed in {(time.time() - t0) / 3600:.3f} hours.')
         for f in last, best:
             if f.exists():
@@ -0,0 +1,135 @@
+# Asynchronous checkpoint writer
+
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+def to_host(t):
+    # copy of a tensor in (pinned) cpu memory, the device-to-host copy is asynchronous
+    if t.is_cuda:
+        host = torch.empty(t.shape, dtype=t.dtype, device='cpu', pin_memory=True)
+        host.copy_(t, non_blocking=True)
+        return host
+    return t.detach().clone()
+
+
+def snapshot(obj):
+    """Copy a checkpoint (dict/list of tensors, modules, ...) to cpu memory
+    Modules are copied without an intermediate copy on the device: their parameters and
+    buffers are put into the deepcopy memo as host tensors.
+    """
+    if isinstance(obj, torch.Tensor):
+        return to_host(obj.detach())
+    if isinstance(obj, nn.Module):
+        memo = {}
+        for t in itertools.chain(obj.parameters(), obj.buffers()):
+            if id(t) not in memo:
+                host = to_host(t.data)
+                memo[id(t)] = nn.Parameter(host, requires_grad=t.requires_grad) if isinstance(t, nn.Parameter) else host
+        return deepcopy(obj, memo)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointJob:
+    def __init__(self, ckpt, half):
+        self.ckpt = snapshot(ckpt)
+        self.half = half  # modules are cast to fp16 on the writer thread
+        self.event = None
+        if torch.cuda.is_available():
+            self.event = torch.cuda.Event()
+            self.event.record()
+        self.t = time.time()
+
+    def ready(self):
+        if self.event is not None:
+            self.event.synchronize()  # wait for the device-to-host copies
+            self.event = None
+        if self.half:
+            for v in (self.ckpt.values() if isinstance(self.ckpt, dict) else [self.ckpt]):
+                if isinstance(v, nn.Module):
+                    v.half()
+            self.half = False
+        return self.ckpt
+
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread
+    save() only snapshots the checkpoint to cpu memory, the file is written to a temporary file
+    and renamed (atomic). A write that is still pending for the same path is replaced by the newer one.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()  # path : CheckpointJob
+        self.busy = False
+        self.closed = False
+        self.writes, self.coalesced, self.latencies = 0, 0, []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, ckpt, *paths, half=False):
+        job = CheckpointJob(ckpt, half)
+        with self.cond:
+            for path in paths:
+                if str(path) in self.pending:
+                    self.coalesced += 1  # superseded write
+                    del self.pending[str(path)]
+                self.pending[str(path)] = job
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                path, job = self.pending.popitem(last=False)
+                self.busy = True
+            try:
+                t = time.time()
+                tmp = f'{path}.{os.getpid()}.tmp'
+                torch.save(job.ready(), tmp)
+                os.replace(tmp, path)
+                dt = time.time() - t
+                self.writes += 1
+                self.latencies.append(dt)
+                logger.info(f'Checkpoint {path} written in {dt:.2f}s ({time.time() - job.t:.2f}s after save)')
+            except Exception as e:
+                logger.warning(f'WARNING: failed to write checkpoint {path}: {e}')
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def flush(self):
+        # wait until every pending checkpoint is written
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def summary(self):
+        n = len(self.latencies)
+        mean = sum(self.latencies) / n if n else 0.
+        return f'{self.writes} checkpoints written ({self.coalesced} superseded), ' \
+               f'write time {mean:.2f}s mean, {max(self.latencies, default=0.):.2f}s max'
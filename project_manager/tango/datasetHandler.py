@@ -0,0 +1,289 @@
+"""dataset catalog module for tango
+Keeps a persistent per-dataset catalog (size, file count, thumbnail) so the
+dataset list does not have to walk and decode every dataset on each request.
+Attributes:
+
+Todo:
+"""
+
+import os
+import json
+import random
+import base64
+import threading
+
+import cv2
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+root_path = os.path.dirname(os.path.dirname(BASE_DIR))
+
+# shared/datasets/.catalog/<dataset name>.json
+# (dot folder : glob("shared/datasets/*") 결과에 포함되지 않음)
+CATALOG_DIR_NAME = '.catalog'
+CATALOG_VERSION = 1
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+THUMBNAIL_SIZE = (128, 128)
+THUMBNAIL_COUNT = 4
+
+_catalog_lock = threading.Lock()
+_catalog_memory = {}
+
+
+def get_catalog_dir(datasets_path):
+    """
+    Returns the catalog folder path of the datasets folder
+
+    Args:
+        datasets_path (string): shared/datasets path
+
+    Returns:
+        catalog folder path
+    """
+    return os.path.join(datasets_path, CATALOG_DIR_NAME)
+
+
+def load_catalog(folder_path):
+    """
+    Load the cached catalog of a dataset folder (memory first, then file)
+
+    Args:
+        folder_path (string): dataset folder path
+
+    Returns:
+        catalog dict or None
+    """
+    with _catalog_lock:
+        catalog = _catalog_memory.get(folder_path)
+    if catalog is not None:
+        return catalog
+
+    catalog_path = get_catalog_path(folder_path)
+    try:
+        with open(catalog_path, 'r') as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if catalog.get('version') != CATALOG_VERSION:
+        return None
+
+    with _catalog_lock:
+        _catalog_memory[folder_path] = catalog
+    return catalog
+
+
+def save_catalog(folder_path, catalog):
+    """
+    Save the catalog of a dataset folder (write temp file -> atomic rename)
+
+    Args:
+        folder_path (string): dataset folder path
+        catalog (dict): catalog
+    """
+    with _catalog_lock:
+        _catalog_memory[folder_path] = catalog
+
+    catalog_path = get_catalog_path(folder_path)
+    tmp_path = catalog_path + '.tmp.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(catalog, f)
+        os.replace(tmp_path, catalog_path)
+    except OSError as error:
+        print('save_catalog - error : ' + str(error))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_catalog_path(folder_path):
+    """
+    Returns the catalog file path of a dataset folder
+
+    Args:
+        folder_path (string): dataset folder path
+
+    Returns:
+        catalog file path
+    """
+    datasets_path = os.path.dirname(os.path.normpath(folder_path))
+    return os.path.join(get_catalog_dir(datasets_path), os.path.basename(os.path.normpath(folder_path)) + '.json')
+
+
+def scan_directory(dir_path, cached_dirs, scanned_dirs):
+    """
+    Single pass scan of a dataset folder tree with os.scandir.
+    A directory whose mtime did not change reuses its cached entry and only
+    its sub directories are visited again (adding / removing files updates the
+    mtime of the directory that holds them).
+
+    Args:
+        dir_path (string): root folder path
+        cached_dirs (dict): {relative dir path: entry} of the previous scan
+        scanned_dirs (dict): {relative dir path: entry} filled by this scan
+
+    Returns:
+        bool : True if any directory has been (re)scanned
+    """
+    changed = False
+    stack = ['']
+    while stack:
+        rel_path = stack.pop()
+        abs_path = os.path.join(dir_path, rel_path) if rel_path else dir_path
+        try:
+            mtime = os.stat(abs_path).st_mtime_ns
+        except OSError:
+            changed = True
+            continue
+
+        entry = cached_dirs.get(rel_path)
+        if entry is None or entry['mtime'] != mtime:
+            entry = scan_single_directory(abs_path, mtime)
+            changed = True
+
+        scanned_dirs[rel_path] = entry
+        for sub_dir in entry['dirs']:
+            stack.append(os.path.join(rel_path, sub_dir) if rel_path else sub_dir)
+
+    # 삭제된 하위 폴더가 있으면 상위 폴더 mtime이 변경되지만, 명시적으로 한 번 더 확인
+    if set(cached_dirs) != set(scanned_dirs):
+        changed = True
+    return changed
+
+
+def scan_single_directory(abs_path, mtime):
+    """
+    Scan the direct children of one directory
+
+    Args:
+        abs_path (string): directory path
+        mtime (int): directory mtime (ns)
+
+    Returns:
+        entry dict : mtime, size, count, sub dirs, sampled images
+    """
+    size = 0
+    count = 0
+    dirs = []
+    images = []
+    image_count = 0
+    try:
+        with os.scandir(abs_path) as it:
+            for item in it:
+                try:
+                    if item.is_dir(follow_symlinks=False):
+                        dirs.append(item.name)
+                    elif item.is_file():
+                        size += item.stat().st_size
+                        count += 1
+                        if item.name.lower().endswith(IMAGE_EXTENSIONS):
+                            # reservoir sampling : 폴더별 THUMBNAIL_COUNT 개의 이미지만 유지
+                            image_count += 1
+                            if len(images) < THUMBNAIL_COUNT:
+                                images.append(item.name)
+                            else:
+                                index = random.randrange(image_count)
+                                if index < THUMBNAIL_COUNT:
+                                    images[index] = item.name
+                except OSError:
+                    continue
+    except OSError as error:
+        print('scan_single_directory - error : ' + str(error))
+
+    return {
+        'mtime': mtime,
+        'size': size,
+        'count': count,
+        'dirs': dirs,
+        'images': images,
+        'image_count': image_count,
+    }
+
+
+def get_dataset_catalog(folder_path):
+    """
+    Returns size, file count and thumbnail of a dataset folder.
+    Only the directories whose mtime changed since the last call are rescanned,
+    and the thumbnail is regenerated only when the folder has changed.
+
+    Args:
+        folder_path (string): dataset folder path
+
+    Returns:
+        dict : size, file_count, thumbnail
+    """
+    catalog = load_catalog(folder_path)
+    cached_dirs = catalog['dirs'] if catalog is not None else {}
+
+    scanned_dirs = {}
+    changed = scan_directory(folder_path, cached_dirs, scanned_dirs)
+
+    if catalog is not None and not changed:
+        return catalog['info']
+
+    info = {
+        'size': sum(entry['size'] for entry in scanned_dirs.values()),
+        'file_count': sum(entry['count'] for entry in scanned_dirs.values()),
+        'thumbnail': get_folder_thumbnail(folder_path, scanned_dirs),
+    }
+    save_catalog(folder_path, {'version': CATALOG_VERSION, 'dirs': scanned_dirs, 'info': info})
+    return info
+
+
+def get_folder_thumbnail(folder_path, scanned_dirs):
+    """
+    Create thumbnails after randomly extracting 4 images from the scanned folder
+
+    Args:
+        folder_path (string): Image folder path
+        scanned_dirs (dict): {relative dir path: entry}
+
+    Returns:
+        Returns Thumbnails to base64
+    """
+    # 폴더별 이미지 수에 비례하여 샘플 선택
+    candidates = []
+    weights = []
+    for rel_path, entry in scanned_dirs.items():
+        for image in entry['images']:
+            candidates.append(os.path.join(folder_path, rel_path, image))
+            weights.append(entry['image_count'] / len(entry['images']))
+
+    if len(candidates) == 0:
+        return None
+
+    random_images = []
+    while candidates and len(random_images) < THUMBNAIL_COUNT:
+        index = random.choices(range(len(candidates)), weights=weights)[0]
+        random_images.append(candidates.pop(index))
+        weights.pop(index)
+
+    thumbnail_list = []
+    for image in random_images:
+        thumbnail = make_image_thumbnail(image)
+        if thumbnail is not None:
+            thumbnail_list.append(thumbnail)
+
+    if len(thumbnail_list) == 0:
+        return None
+
+    thumb = cv2.hconcat(thumbnail_list)
+    jpg_img = cv2.imencode('.jpg', thumb)
+    return "data:image/jpg;base64," + str(base64.b64encode(jpg_img[1]).decode('utf-8'))
+
+
+def make_image_thumbnail(path):
+    """
+    Create Thumbnails (decode at reduced resolution)
+
+    Args:
+        path (string): File path to create thumbnails
+
+    Returns:
+        Thumbnails
+    """
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_4)
+    if img is None:
+        return None
+    return cv2.resize(img, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
@@ -0,0 +1,275 @@
+"""container log module for tango
+Follows docker container logs with one long-lived streaming reader per
+container and fans the lines out to per-project ring buffers, which are read
+by status_request (polling) and status_log_stream (Server-Sent Events).
+Attributes:
+
+Todo:
+"""
+
+import time
+import threading
+import itertools
+from collections import deque
+
+import docker
+
+from .projectHandler import get_docker_container_name, update_project_log_file
+
+LOG_BUFFER_SIZE = 5000          # 프로젝트별 ring buffer 크기 (line)
+LOG_FLUSH_INTERVAL = 1.0        # log.txt 일괄 기록 주기 (sec)
+LOG_FLUSH_LINES = 500           # 주기 이전이라도 이 이상 쌓이면 log.txt에 기록
+LOG_RETRY_INTERVAL = 2.0        # 컨테이너를 찾지 못했을 때 재시도 주기 (sec)
+
+_registry_lock = threading.Lock()
+_project_logs = {}      # (user_id, project_id) : ProjectLog
+_attachments = {}       # (user_id, project_id) : docker container name
+_followers = {}         # docker container name : ContainerLogFollower
+_flusher = None
+
+
+class ProjectLog:
+    """ProjectLog class
+    Note:
+        Bounded ring buffer of log lines of a project.
+        Every line gets a sequence number so that readers (polling / SSE) can
+        resume from the last line they have seen.
+    Args:
+        user_id, project_id
+    Attributes:
+    """
+
+    def __init__(self, user_id, project_id):
+        self.user_id = user_id
+        self.project_id = project_id
+        self.lines = deque(maxlen=LOG_BUFFER_SIZE)
+        self.seq = 0            # 마지막으로 추가된 line 번호
+        self.read_seq = 0       # status_request(polling)가 마지막으로 읽은 line 번호
+        self.pending = []       # log.txt에 아직 기록되지 않은 line
+        self.last_flush = time.time()
+        self.cond = threading.Condition()
+
+    def append(self, text):
+        """
+        Append log text (split into lines) and wake up the readers
+
+        Args:
+            text (string): log text
+        """
+        new_lines = str(text).splitlines()
+        if len(new_lines) == 0:
+            return
+        with self.cond:
+            for line in new_lines:
+                self.seq += 1
+                self.lines.append((self.seq, line))
+            self.pending.extend(new_lines)
+            self.cond.notify_all()
+        if len(self.pending) >= LOG_FLUSH_LINES:
+            self.flush()
+
+    def read_since(self, seq):
+        """
+        Returns the lines after the given sequence number
+
+        Args:
+            seq (int): last sequence number seen by the reader
+
+        Returns:
+            list of (seq, line)
+        """
+        with self.cond:
+            if len(self.lines) == 0 or seq >= self.seq:
+                return []
+            first_seq = self.lines[0][0]
+            return list(itertools.islice(self.lines, max(seq - first_seq + 1, 0), None))
+
+    def read_new(self):
+        """
+        Returns the lines not yet read by status_request as one string
+
+        Returns:
+            log string
+        """
+        lines = self.read_since(self.read_seq)
+        if len(lines) == 0:
+            return ''
+        self.read_seq = lines[-1][0]
+        return '\n'.join(line for _, line in lines) + '\n'
+
+    def wait(self, seq, timeout):
+        """
+        Wait until a line after the given sequence number is appended
+
+        Args:
+            seq (int): last sequence number seen by the reader
+            timeout (float): timeout (sec)
+
+        Returns:
+            bool : True if new lines exist
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.seq > seq, timeout)
+
+    def flush(self, force=True):
+        """
+        Append pending lines to shared/common/user_id/project_id/log.txt
+
+        Args:
+            force (bool): if False, flush only when LOG_FLUSH_INTERVAL has passed
+        """
+        with self.cond:
+            if len(self.pending) == 0:
+                return
+            if not force and time.time() - self.last_flush < LOG_FLUSH_INTERVAL:
+                return
+            pending = self.pending
+            self.pending = []
+            self.last_flush = time.time()
+        try:
+            update_project_log_file(self.user_id, self.project_id, '\n'.join(pending) + '\n')
+        except OSError as error:
+            print('ProjectLog flush - error : ' + str(error))
+
+
+class ContainerLogFollower(threading.Thread):
+    """ContainerLogFollower class
+    Note:
+        Long-lived reader of the streaming docker logs API of one container.
+        New lines are fanned out to every project attached to the container.
+    Args:
+        container_name : docker container name
+    Attributes:
+    """
+
+    def __init__(self, container_name):
+        super().__init__(name='log-follower-' + container_name, daemon=True)
+        self.container_name = container_name
+        self.stop_event = threading.Event()
+        self.stream = None
+
+    def run(self):
+        client = docker.from_env()
+        since = int(time.time())
+        while not self.stop_event.is_set():
+            try:
+                container = next((item for item in client.containers.list()
+                                  if self.container_name in str(item.name)), None)
+                if container is None:
+                    self.stop_event.wait(LOG_RETRY_INTERVAL)
+                    continue
+
+                self.stream = container.logs(stream=True, follow=True, timestamps=True, since=since)
+                for chunk in self.stream:
+                    since = int(time.time())
+                    text = chunk.decode('utf-8', errors='replace')
+                    for project_log in get_attached_project_logs(self.container_name):
+                        project_log.append(text)
+                    if self.stop_event.is_set():
+                        break
+            except Exception as error:
+                print('ContainerLogFollower(' + self.container_name + ') - error : ' + str(error))
+            finally:
+                self.close_stream()
+            self.stop_event.wait(LOG_RETRY_INTERVAL)
+
+    def close_stream(self):
+        stream = self.stream
+        self.stream = None
+        if stream is not None and hasattr(stream, 'close'):
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def stop(self):
+        self.stop_event.set()
+        self.close_stream()
+
+
+def log_flush_loop():
+    """
+    Background loop that appends the pending lines of every project to log.txt
+    """
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        with _registry_lock:
+            project_logs = list(_project_logs.values())
+        for project_log in project_logs:
+            project_log.flush(force=False)
+
+
+def get_project_log(user_id, project_id):
+    """
+    Returns the log buffer of a project (created if not exists)
+
+    Args:
+        user_id : user_id
+        project_id : project_id
+
+    Returns:
+        ProjectLog
+    """
+    global _flusher
+
+    key = (str(user_id), str(project_id))
+    with _registry_lock:
+        project_log = _project_logs.get(key)
+        if project_log is None:
+            project_log = ProjectLog(*key)
+            _project_logs[key] = project_log
+        if _flusher is None:
+            _flusher = threading.Thread(target=log_flush_loop, name='log-flusher', daemon=True)
+            _flusher.start()
+    return project_log
+
+
+def attach_project_log(user_id, project_id, container):
+    """
+    Attach a project to the log follower of a container.
+    The follower is started on first use and stopped when no project is attached.
+
+    Args:
+        user_id : user_id
+        project_id : project_id
+        container : container (or deploy target info for image deploy)
+
+    Returns:
+        ProjectLog
+    """
+    project_log = get_project_log(user_id, project_id)
+    key = (str(user_id), str(project_id))
+    container_name = get_docker_container_name(container)
+
+    with _registry_lock:
+        previous = _attachments.get(key)
+        if previous == container_name:
+            return project_log
+        _attachments[key] = container_name
+
+        follower = _followers.get(container_name)
+        if follower is None or not follower.is_alive():
+            follower = ContainerLogFollower(container_name)
+            _followers[container_name] = follower
+            follower.start()
+
+        if previous is not None and previous not in _attachments.values():
+            previous_follower = _followers.pop(previous, None)
+            if previous_follower is not None:
+                previous_follower.stop()
+
+    return project_log
+
+
+def get_attached_project_logs(container_name):
+    """
+    Returns the log buffers of the projects attached to a container
+
+    Args:
+        container_name : docker container name
+
+    Returns:
+        list of ProjectLog
+    """
+    with _registry_lock:
+        return [_project_logs[key] for key, name in _attachments.items() if name == container_name]
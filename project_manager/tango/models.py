@@ -121,7 +121,8 @@ class Target(models.Model):
     target_host_ip = models.CharField(blank=True, null=True, max_length=50)             # 타겟 정보 - host_ip
     target_host_port = models.CharField(blank=True, null=True, max_length=50)           # 타겟 정보 - host_port
     target_host_service_port = models.CharField(blank=True, null=True, max_length=30)   # 타겟 정보 - host_service_port
-    target_image = models.CharField(blank=True, null=True, max_length=10485760)         # 타겟 이미지
+    target_image = models.CharField(blank=True, null=True, max_length=10485760)         # 타겟 이미지 (legacy : base64, 파일로 이전됨)
+    target_image_hash = models.CharField(blank=True, null=True, max_length=64)          # 타겟 이미지 - data/target_images 파일 (sha256)
 
     class Meta:
         """Target Meta class
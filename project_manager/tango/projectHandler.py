@@ -1,17 +1,78 @@
 import os
 import requests
 import asyncio
+import functools
+import threading
 import docker
-# import zipfile
+import zipfile
 import shutil
 import json
 import textwrap
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 root_path = os.path.dirname(os.path.dirname(BASE_DIR))
 
+HTTP_CONNECT_TIMEOUT = 3        # sec
+HTTP_READ_TIMEOUT = 10          # sec
+HTTP_RETRY_TOTAL = 3
+HTTP_RETRY_BACKOFF = 0.5        # 0.5, 1.0, 2.0 sec ...
+HTTP_POOL_SIZE = 32
+
+ZIP_CHUNK_SIZE = 1024 * 1024    # 1MB
+# 이미 압축된 형식은 다시 압축하지 않음 (store)
+ZIP_STORED_EXTENSIONS = ('.pt', '.pth', '.onnx', '.tflite', '.pb', '.zip', '.gz', '.tgz', '.7z',
+                         '.jpg', '.jpeg', '.png', '.mp4')
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
 #region API REQUEST ...................................................................................................
 
+def get_http_session():
+    """
+    Shared HTTP client for container API requests
+    (keep-alive connection pool, retries with exponential backoff)
+
+    Returns:
+        requests.Session
+    """
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            # read=0 : 요청이 이미 전달되었을 수 있는 read 오류는 재시도하지 않음 (start 중복 방지)
+            retry = Retry(total=HTTP_RETRY_TOTAL,
+                          read=0,
+                          backoff_factor=HTTP_RETRY_BACKOFF,
+                          status_forcelist=(502, 503, 504),
+                          allowed_methods=frozenset(['GET']))
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+    return _http_session
+
+async def http_get(url, headers, params, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+    """
+    GET request with the shared HTTP client without blocking the event loop
+
+    Args:
+        url : url
+        headers : headers
+        params : query params
+        timeout : (connect timeout, read timeout)
+
+    Returns:
+        response
+    """
+    loop = asyncio.get_running_loop()
+    request = functools.partial(get_http_session().get, url, headers=headers, params=params, timeout=timeout)
+    return await loop.run_in_executor(None, request)
+
 async def start_handler(continer, user_id, project_id, target_info):
     """
     Container Start Request Handler
@@ -33,11 +94,7 @@ async def start_handler(continer, user_id, project_id, target_info):
 
     print("continer_start_api : " + host + ':' + port)
 
-    start_task = asyncio.create_task(continer_start_api(host + ':' + port, user_id, project_id))
-    result = await start_task
-    # host, port = get_container_info(continer)
-    # result = continer_start_api(host + ':' + port, user_id, project_id)
-    return result
+    return await continer_start_api(host + ':' + port, user_id, project_id)
 
 async def continer_start_api(host, user_id, project_id):
     """
@@ -60,7 +117,7 @@ async def continer_start_api(host, user_id, project_id):
         'user_id' : user_id,
         'project_id' : project_id,
     }
-    response = requests.get(url, headers=headers, params=payload)
+    response = await http_get(url, headers, payload)
     print_roundtrip_text = print_roundtrip(response, "Start", host)
 
     # return response.json()
@@ -102,9 +159,7 @@ async def request_handler(continer, user_id, project_id, target_info):
 
         print("continer_start_api : " + host + ':' + port)
 
-        start_task = asyncio.create_task(continer_request_api(host + ':' + port, user_id, project_id))
-        result = await start_task
-        return result
+        return await continer_request_api(host + ':' + port, user_id, project_id)
     
     except Exception as error:
         print('request_handler - error : ' + str(error))
@@ -131,7 +186,7 @@ async def continer_request_api(host, user_id, project_id):
         'user_id' : user_id,
         'project_id' : project_id,
     }
-    response = requests.get(url, headers=headers, params=payload, timeout = 5)
+    response = await http_get(url, headers, payload, timeout=(HTTP_CONNECT_TIMEOUT, 5))
     print_roundtrip_text = print_roundtrip(response, "Status Request", host)
 
     # return response.json()
@@ -336,59 +391,122 @@ def db_container_name(container):
     elif container == 'ondevice_deploy' or container == 'kube_deploy' or container == 'cloud_deploy':
         return 'imagedeploy'
 
-def nn_model_zip(user_id, project_id):
+class ZipChunkBuffer:
     """
-    Convert path to zip file to shared/common/user_id/project_id/nn_model
+    Write-only, non-seekable file object used as the output of zipfile.ZipFile.
+    zipfile writes data descriptors instead of seeking back, and the written
+    bytes are taken out chunk by chunk with pop().
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def nn_model_zip_stream(user_id, project_id):
+    """
+    Zip shared/common/user_id/project_id/nn_model as a stream of chunks
+    (no temporary archive on disk, no chdir)
 
     Args:
         user_id : user_id
         project_id : project_id
 
     Returns:
-        zip file
+        generator of zip file chunks
     """
 
-    file_path = os.path.join(root_path, "shared/common/{0}/{1}".format(str(user_id), str(project_id)))
-    os.chdir(file_path)
-
-    print("start folder_zip shutil")
-    print("file_path  : " + str(file_path))
-    print(os.walk(os.path.join(file_path, 'nn_model')))
+    model_path = os.path.join(root_path, "shared/common/{0}/{1}".format(str(user_id), str(project_id)), 'nn_model')
+    if not os.path.isdir(model_path):
+        raise FileNotFoundError(model_path)
 
-    a = shutil.make_archive("nn_model", 'zip', os.path.join(file_path, "nn_model"))
-    print(a)
+    return zip_folder_stream(model_path)
 
-    print("end folder_zip")
+def zip_folder_stream(folder_path):
+    """
+    Zip a folder as a stream of chunks
 
+    Args:
+        folder_path : folder to zip
 
-    return os.path.join(file_path, "nn_model.zip")
+    Returns:
+        generator of zip file chunks
+    """
+
+    buffer = ZipChunkBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zip_file:
+        for path, dirs, files in os.walk(folder_path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(path, name)
+                info = zipfile.ZipInfo.from_file(file_path, os.path.relpath(file_path, folder_path))
+                if name.lower().endswith(ZIP_STORED_EXTENSIONS):
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+
+                with open(file_path, 'rb') as src, zip_file.open(info, mode='w', force_zip64=True) as dst:
+                    while True:
+                        data = src.read(ZIP_CHUNK_SIZE)
+                        if not data:
+                            break
+                        dst.write(data)
+                        chunk = buffer.pop()
+                        if chunk:
+                            yield chunk
+                chunk = buffer.pop()
+                if chunk:
+                    yield chunk
+
+    # central directory
+    chunk = buffer.pop()
+    if chunk:
+        yield chunk
 
 def nn_model_unzip(user_id, project_id, file):
     """
-    unzip file
+    unzip the uploaded file into shared/common/user_id/project_id/nn_model
+    (members are extracted directly from the upload, without saving the archive)
 
     Args:
         user_id : user_id
         project_id : project_id
-        file : zip file
+        file : zip file (uploaded file)
 
     Returns:
-        zip file
+        nn_model folder path
     """
     file_path = os.path.join(root_path, "shared/common/{0}/{1}".format(str(user_id), str(project_id)))
-    save_path = os.path.join(file_path, 'nn_model.zip')
+    extract_dir = os.path.realpath(os.path.join(file_path, 'nn_model'))
 
-    with open(save_path, 'wb') as destination_file:
-        for chunk in file.chunks():
-            destination_file.write(chunk)
+    with zipfile.ZipFile(file) as zip_file:
+        for info in zip_file.infolist():
+            target_path = os.path.realpath(os.path.join(extract_dir, info.filename))
+            # zip slip : nn_model 폴더 밖으로 풀리는 항목은 무시
+            if os.path.commonpath([extract_dir, target_path]) != extract_dir:
+                print("nn_model_unzip - skip : " + str(info.filename))
+                continue
 
-    filename = save_path
-    extrack_dir = os.path.join(file_path, 'nn_model')
-    archive_format = "zip"
+            if info.is_dir():
+                os.makedirs(target_path, exist_ok=True)
+                continue
 
-    shutil.unpack_archive(filename, extrack_dir, archive_format)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with zip_file.open(info) as src, open(target_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, ZIP_CHUNK_SIZE)
 
-    return os.path.join(file_path, "nn_model.zip")
+    return extract_dir
 
 def create_text_file_if_not_exists(file_path):
     """
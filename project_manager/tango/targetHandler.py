@@ -0,0 +1,172 @@
+"""target image module for tango
+Target images are stored as content-addressed files (data/target_images/<sha256>.<ext>)
+instead of base64 strings in the target table, and are served by target_image
+with an ETag so browsers can cache them.
+Attributes:
+
+Todo:
+"""
+
+import os
+import re
+import base64
+import hashlib
+import threading
+
+from django.forms.models import model_to_dict
+
+from .models import Target
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGET_IMAGE_DIR = os.path.join(os.path.dirname(BASE_DIR), 'data/target_images')
+TARGET_IMAGE_URL = '/api/target_image/'
+
+# raster images only : target_image serves them inline without authentication,
+# an uploaded svg could run scripts on the api origin
+IMAGE_CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'bmp': 'image/bmp',
+}
+
+_data_url_pattern = re.compile(r'^data:image/(?P<type>[\w.+-]+);base64,(?P<data>.*)$', re.DOTALL)
+_hash_pattern = re.compile(r'^[0-9a-f]{64}$')
+
+_migrate_lock = threading.Lock()
+_migrated = False
+
+
+def save_target_image(image):
+    """
+    Save a target image (data url) as a content-addressed file
+
+    Args:
+        image (string): data url ("data:image/png;base64,...") or
+                        url of an already saved image (unchanged image)
+
+    Returns:
+        sha256 of the image or None
+    """
+    if not image:
+        return None
+    image = str(image)
+
+    if image.startswith(TARGET_IMAGE_URL):
+        image_hash = image[len(TARGET_IMAGE_URL):].strip('/')
+        return image_hash if get_target_image_path(image_hash) is not None else None
+
+    match = _data_url_pattern.match(image)
+    if match is None:
+        return None
+
+    ext = match.group('type').lower().split('+')[0]
+    ext = 'jpg' if ext == 'jpeg' else ext
+    if ext not in IMAGE_CONTENT_TYPES:
+        return None
+
+    data = base64.b64decode(match.group('data'))
+    image_hash = hashlib.sha256(data).hexdigest()
+
+    if get_target_image_path(image_hash) is None:
+        os.makedirs(TARGET_IMAGE_DIR, exist_ok=True)
+        file_path = os.path.join(TARGET_IMAGE_DIR, image_hash + '.' + ext)
+        tmp_path = file_path + '.tmp.' + str(threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+
+    return image_hash
+
+
+def get_target_image_path(image_hash):
+    """
+    Returns the file path of a target image
+
+    Args:
+        image_hash (string): sha256 of the image
+
+    Returns:
+        file path or None
+    """
+    if not image_hash or _hash_pattern.match(str(image_hash)) is None:
+        return None
+
+    for ext in IMAGE_CONTENT_TYPES:
+        file_path = os.path.join(TARGET_IMAGE_DIR, image_hash + '.' + ext)
+        if os.path.isfile(file_path):
+            return file_path
+    return None
+
+
+def get_target_image_content_type(file_path):
+    """
+    Returns the content type of a target image file
+
+    Args:
+        file_path (string): file path
+
+    Returns:
+        content type
+    """
+    ext = os.path.splitext(file_path)[1][1:]
+    return IMAGE_CONTENT_TYPES.get(ext, 'application/octet-stream')
+
+
+def get_target_image_url(image_hash):
+    """
+    Returns the url of a target image
+
+    Args:
+        image_hash (string): sha256 of the image
+
+    Returns:
+        url or ''
+    """
+    return TARGET_IMAGE_URL + image_hash if image_hash else ''
+
+
+def target_to_dict(target):
+    """
+    Target model to dict (target_image is the image url, not the image data)
+
+    Args:
+        target : Target
+
+    Returns:
+        dict
+    """
+    target_dict = model_to_dict(target, exclude=['target_image', 'target_image_hash'])
+    target_dict['target_image'] = get_target_image_url(target.target_image_hash)
+    return target_dict
+
+
+def migrate_legacy_target_images():
+    """
+    Move the base64 images still stored in target.target_image to files
+    (runs once per process)
+    """
+    global _migrated
+
+    with _migrate_lock:
+        if _migrated:
+            return
+
+        legacy_targets = Target.objects.filter(target_image_hash__isnull=True) \
+                                       .exclude(target_image__isnull=True) \
+                                       .exclude(target_image='')
+        for target in legacy_targets:
+            try:
+                image_hash = save_target_image(target.target_image)
+                if image_hash is None:
+                    # not a supported data url : keep the legacy image
+                    print('migrate_legacy_target_images - skip target ' + str(target.id))
+                    continue
+                target.target_image_hash = image_hash
+                target.target_image = None
+                target.save(update_fields=['target_image', 'target_image_hash'])
+            except Exception as error:
+                print('migrate_legacy_target_images - error : ' + str(error))
+
+        _migrated = True
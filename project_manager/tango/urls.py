@@ -48,10 +48,13 @@ urlpatterns = [
     re_path(r'^target_update', viewsTarget.target_update, name='target_update'),    # 타겟 수정
     re_path(r'^target_delete', viewsTarget.target_delete, name='target_delete'),    # 타겟 삭제
     re_path(r'^target_info', viewsTarget.target_info, name='target_info'),    # 타겟 정보 가져오기
+    re_path(r'^target_image/(?P<image_hash>[0-9a-f]{64})$', viewsTarget.target_image, name='target_image'),    # 타겟 이미지
 
     re_path(r'^container_start', viewsProject.container_start, name='container_start'),       # 컨테이너 실행
     re_path(r'^status_result', viewsProject.status_result, name='status_result'),       # 컨테이너 실행 상태 확인
     re_path(r'^status_request', viewsProject.status_request, name='status_request'),       # 컨테이너 실행 상태 확인 요청
+    re_path(r'^status_log_stream', viewsProject.status_log_stream, name='status_log_stream'),       # 컨테이너 로그 스트리밍 (SSE)
+    re_path(r'^status_log_token', viewsProject.status_log_token, name='status_log_token'),       # 컨테이너 로그 스트리밍 토큰 발급
 
     re_path(r'^get_dataset_list', viewsDataset.get_dataset_list, name='get_dataset_list'),       # 컨테이너 실행 상태 확인 요청
 
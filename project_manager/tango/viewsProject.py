@@ -13,13 +13,12 @@ import math
 import socket
 import threading
 import requests
-import asyncio
 
 from datetime import datetime
-import time
 
 import django.middleware.csrf
-from django.http import HttpResponse
+from django.core import signing
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.permissions import AllowAny
 
 from rest_framework.response import Response
@@ -29,9 +28,16 @@ from oauth2_provider.contrib.rest_framework import OAuth2Authentication
 from .models import Project, AuthUser, Target, WorkflowOrder
 
 from django.views.decorators.csrf import csrf_exempt, csrf_protect
-from django.forms.models import model_to_dict
+from django.core.paginator import Paginator
 
 from .projectHandler import *
+from .logHandler import attach_project_log
+from .workflowHandler import workflow_engine
+from .targetHandler import target_to_dict, get_target_image_url, migrate_legacy_target_images
+
+LOG_STREAM_KEEPALIVE = 15   # SSE keep-alive 주기 (sec)
+LOG_STREAM_TOKEN_MAX_AGE = 60   # 로그 스트리밍 토큰 유효 시간 (sec)
+LOG_STREAM_TOKEN_SALT = 'tango.status_log_stream'
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 root_path = os.path.dirname(os.path.dirname(BASE_DIR))
@@ -63,16 +69,18 @@ def container_start(request):
         project_id = request.data['project_id']
         container_id = request.data['container_id']
 
-        project_info = Project.objects.get(id=project_id, create_user=str(user_id))
-
-        response = asyncio.run(start_handler(container_id, user_id, project_id, project_info.target.target_info))
-        to_json = json.loads(response)
+        project_info = Project.objects.select_related('target').get(id=project_id, create_user=str(user_id))
 
         project_info.container = container_id
         project_info.container_status = 'started'
-        project_info.save()
+        project_info.save(update_fields=['container', 'container_status'])
+
+        attach_project_log(user_id, project_id, get_log_source(project_info))
 
-        return HttpResponse(json.dumps({'status': 200, 'message': str(container_id) + ' 시작 요청\n', 'response' : to_json['request_info']}))
+        # 시작 요청은 workflow engine이 비동기로 처리하고, 요청 결과는 프로젝트 로그로 전달됨
+        workflow_engine.start(user_id, project_id, container_id, project_info.target.target_info)
+
+        return HttpResponse(json.dumps({'status': 200, 'message': str(container_id) + ' 시작 요청\n', 'response' : ''}))
 
     except Exception as error:
         print('container start error - ' + str(error))
@@ -97,59 +105,40 @@ def status_request(request):
 
     try:
         print("----------status_request----------")
-        response_log = ""
 
         user_id = request.data['user_id']
         project_id = request.data['project_id']
 
-        queryset = Project.objects.get(id=project_id, create_user=str(user_id))
+        queryset = Project.objects.select_related('target').get(id=project_id, create_user=str(user_id))
         container_id = queryset.container
         
-        res = asyncio.run(request_handler(container_id, user_id, project_id, queryset.target.target_info))
+        res = workflow_engine.run(request_handler(container_id, user_id, project_id, queryset.target.target_info))
         if res == None:
             return HttpResponse(json.dumps({'container': container_id, 'container_status': '', 'message': ''}))
 
         response = json.loads(res)
-        log_str = str(queryset.current_log) + str(container_id) + '- status_request response : ' + str(response['response'])
-        # log_str = str(queryset.current_log) 
-        # log_str += response['request_info']
-        response_log = log_str
+
+        # 컨테이너 로그는 log follower가 ring buffer에 쌓아두므로 docker API를 호출하지 않음
+        project_log = attach_project_log(user_id, project_id, get_log_source(queryset))
+        project_log.append(str(container_id) + '- status_request response : ' + str(response['response']))
 
         if len(response['response']) > 50:
-            queryset.save()
             return HttpResponse(json.dumps({'container': container_id, 'container_status': queryset.container_status, 'message':  get_log_container_name(container_id) + ": status_request - Error\n"}))
 
         # status_report에서 completed 였을 때를 제외하고
         # if queryset.container_status != 'completed':
         #     queryset.container_status = response['response']
 
-        ## 새로운 컨테이너에서 로그를 불러올때
-        # 컨테이너가 실행될때는 last_logs_timestamp 이후에 실행 되니 주석 처리
-        # if queryset.last_log_container != queryset.container:
-        #     queryset.last_logs_timestamp = 0
-        
-        if container_id != "imagedeploy":
-            logs = get_docker_log_handler(queryset.container, queryset.last_logs_timestamp)
-        else:
-            logs = get_docker_log_handler(queryset.target.target_info, queryset.last_logs_timestamp)
-        
-        queryset.last_logs_timestamp = time.mktime(datetime.now().timetuple()) + 1.0
-        queryset.last_log_container = queryset.container
-
-
-        response_log += '\n' + str(logs)
-        queryset.current_log = ''
-
         if queryset.container_status == 'completed':
-            response_log += get_log_container_name(container_id) + " 완료\n"
+            project_log.append(get_log_container_name(container_id) + " 완료")
             response['response'] = "completed"
-
-        if response['response'] == 'completed':
+        elif response['response'] == 'completed':
             queryset.container_status = 'completed'
+            queryset.save(update_fields=['container_status'])
 
-        update_project_log_file(user_id, project_id, response_log)
+        # log.txt는 log follower가 일괄(batch) 기록
+        response_log = project_log.read_new()
 
-        queryset.save()
         return HttpResponse(json.dumps({'container': container_id, 'container_status': response['response'], 'message': response_log,}))
 
     except Exception as error:
@@ -187,10 +176,9 @@ def status_report(request):
                 continue
             header = '-'.join([h.capitalize() for h in header[5:].lower().split('_')])
             headers += '{}: {}\n'.format(header, value)
-        queryset = Project.objects.get(id=project_id, create_user=str(user_id))
+        queryset = Project.objects.select_related('target').get(id=project_id, create_user=str(user_id))
         queryset.container = container_id
-        log_str =  str(queryset.current_log) 
-        log_str += '---------------- Status Report ----------------'
+        log_str = '---------------- Status Report ----------------'
         log_str += "\n" + get_log_container_name(container_id) + " --> Project Manager"
         log_str += "\n" + str(request)
         log_str += "\n" + "method : " + request.method
@@ -203,27 +191,19 @@ def status_report(request):
         log_str += '\n----------------------------------------'
         log_str += '\n\n'
 
-        queryset.current_log = log_str
-
-        workflow_order = WorkflowOrder.objects.filter(project_id=project_id).order_by('order')
-
-        if queryset.project_type == 'auto':
-            current_container_idx = findIndexByDicList(list(workflow_order.values()), 'workflow_name', container_id)
-            if (result == 'success' or result == 'completed') and current_container_idx != None :
-                if len(list(workflow_order.values())) - 1 > current_container_idx:
-                    next_container = list(workflow_order.values())[current_container_idx + 1]['workflow_name']
-                    if next_container:
-                        queryset.container = next_container
-                        log = str(queryset.current_log) + "\n" + get_log_container_name(container_id) + " 완료"
-                        log += "\n" + get_log_container_name(next_container) + " 시작 요청"
-                        queryset.current_log = log
-                        asyncio.run(start_handler(next_container, user_id, project_id, queryset.target.target_info))
-                        queryset.container_status = 'started'
-        else:
-            if result == 'success' or result == 'completed':
-                queryset.container_status = 'completed'
+        project_log = attach_project_log(user_id, project_id, get_log_source(queryset))
+        project_log.append(log_str)
+
+        if queryset.project_type != 'auto' and (result == 'success' or result == 'completed'):
+            queryset.container_status = 'completed'
+
+        queryset.save(update_fields=['container', 'container_status'])
+        attach_project_log(user_id, project_id, get_log_source(queryset))
+
+        # auto : 다음 workflow로의 전이(다음 컨테이너 시작 요청)는 workflow engine이 비동기로 처리
+        if queryset.project_type == 'auto' and (result == 'success' or result == 'completed'):
+            workflow_engine.report(user_id, project_id, container_id, queryset.target.target_info)
 
-        queryset.save()
         return HttpResponse(json.dumps({'status': 200}))
 
     except Exception as error:
@@ -248,25 +228,119 @@ def status_result(request):
 
     try:
         project_id = request.data['project_id']
-        queryset = Project.objects.get(id=project_id, create_user=str(request.user))
-        if last_container != queryset.container:
-            last_logs_timestamp = 0
-
-        logs = get_docker_log_handler(queryset.container, last_logs_timestamp)
-        last_logs_timestamp = time.mktime(datetime.now().timetuple())
-        last_container = queryset.container
+        queryset = Project.objects.select_related('target').get(id=project_id, create_user=str(request.user))
 
-        m = response_message + '\n' + str(logs)
-        response_message = ''
+        project_log = attach_project_log(request.user, project_id, get_log_source(queryset))
 
         return HttpResponse(json.dumps({'container': queryset.container,
                                         'container_status': queryset.container_status,
-                                        'message': m,}))
+                                        'message': project_log.read_new(),}))
 
     except Exception as e:
         print(e)
 
 
+# 컨테이너 로그 스트리밍 토큰 발급
+@api_view(['GET', 'POST'])
+@authentication_classes([OAuth2Authentication])   # 토큰 확인
+def status_log_token(request):
+    """
+    Issue a short-lived token for status_log_stream
+    (EventSource can not send the Authorization header)
+
+    Args:
+        project_id (string): project_id
+
+    Returns:
+        token
+    """
+
+    try:
+        project_id = request.data['project_id']
+        # only the owner of the project gets a token
+        Project.objects.get(id=project_id, create_user=str(request.user))
+        token = signing.dumps({'user_id': str(request.user), 'project_id': str(project_id)},
+                              salt=LOG_STREAM_TOKEN_SALT)
+
+        return HttpResponse(json.dumps({'token': token}))
+
+    except Exception as error:
+        print("status_log_token - error")
+        print(error)
+        return HttpResponse(error)
+
+
+# 컨테이너 로그 스트리밍 (Server-Sent Events)
+@api_view(['GET'])
+@authentication_classes([OAuth2Authentication])   # 토큰 확인
+@permission_classes([AllowAny])   # Authorization 헤더 또는 status_log_token 토큰으로 확인
+def status_log_stream(request):
+    """
+    Stream the project log lines as Server-Sent Events
+
+    Args:
+        project_id (string): project_id (with the Authorization header)
+        token (string): token of status_log_token (instead of the Authorization header)
+        last_seq (int): (optional) resume after this line number (or Last-Event-ID header)
+
+    Returns:
+        text/event-stream
+    """
+
+    try:
+        if request.user.is_authenticated:
+            user_id = str(request.user)
+            project_id = request.GET['project_id']
+        else:
+            try:
+                stream = signing.loads(request.GET.get('token', ''), salt=LOG_STREAM_TOKEN_SALT,
+                                       max_age=LOG_STREAM_TOKEN_MAX_AGE)
+            except signing.BadSignature:   # 만료된 토큰 포함
+                return HttpResponse(status=401)
+            user_id = stream['user_id']
+            project_id = stream['project_id']
+        last_seq = int(request.GET.get('last_seq', request.META.get('HTTP_LAST_EVENT_ID', 0)) or 0)
+
+        queryset = Project.objects.select_related('target').get(id=project_id, create_user=str(user_id))
+        project_log = attach_project_log(user_id, project_id, get_log_source(queryset))
+
+        def event_stream(seq):
+            while True:
+                if not project_log.wait(seq, LOG_STREAM_KEEPALIVE):
+                    yield ': keep-alive\n\n'
+                    continue
+                for line_seq, line in project_log.read_since(seq):
+                    yield 'id: {0}\ndata: {1}\n\n'.format(line_seq, line)
+                    seq = line_seq
+
+        response = StreamingHttpResponse(event_stream(last_seq), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    except Exception as error:
+        print("status_log_stream - error")
+        print(error)
+        return HttpResponse(error)
+
+
+def get_log_source(project_info):
+    """
+    Returns the container whose docker log belongs to the project
+    (for image deploy, the deploy target decides the container)
+
+    Args:
+        project_info : Project
+
+    Returns:
+        container
+    """
+
+    if project_info.container != "imagedeploy":
+        return project_info.container
+    return project_info.target.target_info
+
+
 # nn_model 다운로드(외부IDE연동)
 @api_view(['GET'])
 @permission_classes([AllowAny])   # 토큰 확인
@@ -286,8 +360,9 @@ def download_nn_model(request):
     try:
         user_id = request.GET['user_id']
         project_id = request.GET['project_id']
-        zip_file_path = nn_model_zip(user_id, project_id)
-        return HttpResponse(open(zip_file_path, 'rb').read())
+        response = StreamingHttpResponse(nn_model_zip_stream(user_id, project_id), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="nn_model.zip"'
+        return response
 
     except Exception as error:
         print("download_nn_model - error")
@@ -342,17 +417,37 @@ def project_list_get(request):
     """
 
     try:
-        queryset = Project.objects.filter(create_user=str(request.user))
-        data = list(queryset.values())
-
-        print("project_list_info")
-        print(data)
-       
-        for project in data: 
+        migrate_legacy_target_images()
+
+        # 로그(current_log), 타겟 이미지는 제외하고 타겟 정보는 join으로 한 번에 조회
+        project_fields = [f.attname for f in Project._meta.concrete_fields if f.name != 'current_log']
+        target_fields = [f.attname for f in Target._meta.concrete_fields if f.name != 'target_image']
+
+        queryset = Project.objects.filter(create_user=str(request.user)) \
+                                  .select_related('target') \
+                                  .order_by('id') \
+                                  .values(*project_fields, *['target__' + field for field in target_fields])
+
+        # page, page_size가 없으면 전체 목록 (페이지 정보는 header로 전달)
+        page_size = int(request.GET.get('page_size', request.data.get('page_size', 0)) or 0)
+        page_number = int(request.GET.get('page', request.data.get('page', 1)) or 1)
+        paginator = Paginator(queryset, page_size if page_size > 0 else max(queryset.count(), 1))
+        page = paginator.get_page(page_number)
+
+        data = []
+        for row in page.object_list:
+            project = {field: row[field] for field in project_fields}
             if project['target_id'] is not None:
-                project['target_info'] = model_to_dict(Target.objects.get(id=int(project['target_id'])))
-
-        return HttpResponse(json.dumps(data))
+                target_info = {field: row['target__' + field] for field in target_fields}
+                target_info['target_image'] = get_target_image_url(target_info.pop('target_image_hash'))
+                project['target_info'] = target_info
+            data.append(project)
+
+        response = HttpResponse(json.dumps(data))
+        response['X-Total-Count'] = paginator.count
+        response['X-Page'] = page.number
+        response['X-Page-Count'] = paginator.num_pages
+        return response
 
     except Exception as e:
         print(e)
@@ -545,7 +640,7 @@ def project_info(request):
 
         # TODO : 타겟이 0이 아닌 경우 SW 정보 전달
         if project['target_id'] is not None:
-            target_info = model_to_dict(Target.objects.get(id=int(project['target_id'])))
+            target_info = target_to_dict(Target.objects.defer('target_image').get(id=int(project['target_id'])))
             target_info_dic = {"target_info": target_info}
 
             result = dict(project,  **target_info_dic)
@@ -9,13 +9,16 @@ import requests
 from datetime import datetime
 
 import django.middleware.csrf
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, FileResponse, Http404
 
 from rest_framework.response import Response
+from rest_framework.permissions import AllowAny
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
 from oauth2_provider.contrib.rest_framework import OAuth2Authentication
 
 from .models import Target
+from .targetHandler import save_target_image, get_target_image_path, get_target_image_content_type, \
+                           get_target_image_url, migrate_legacy_target_images
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -49,7 +52,7 @@ def target_create(request):
                         target_host_ip=request.data['host_ip'],
                         target_host_port=request.data['host_port'],
                         target_host_service_port=request.data['host_service_port'],
-                        target_image=str(request.data['image']))
+                        target_image_hash=save_target_image(request.data['image']))
 
         target.save()
 
@@ -74,9 +77,11 @@ def target_read(request):
     """
 
     try:
+        migrate_legacy_target_images()
+
         # 모든 사용자가 타겟을 확인할 수 있도록 수정
         queryset = Target.objects.filter()
-        data = list(queryset.values())
+        data = list(queryset.values(*[f.attname for f in Target._meta.concrete_fields if f.name != 'target_image']))
 
         data_list = []
 
@@ -97,7 +102,7 @@ def target_read(request):
                            'host_ip': i['target_host_ip'],
                            'host_port': i['target_host_port'],
                            'host_service_port': i['target_host_service_port'],
-                           'image': str(i['target_image'])}
+                           'image': get_target_image_url(i['target_image_hash'])}
 
             data_list.append(target_data)
 
@@ -137,7 +142,8 @@ def target_update(request):
         queryset.target_host_ip = request.data['host_ip']
         queryset.target_host_port = request.data['host_port']
         queryset.target_host_service_port = request.data['host_service_port']
-        queryset.target_image = str(request.data['image'])
+        queryset.target_image = None
+        queryset.target_image_hash = save_target_image(request.data['image'])
 
         queryset.save()
 
@@ -186,9 +192,11 @@ def target_info(request):
         _type_: _description_
     """
 
+    migrate_legacy_target_images()
+
     queryset = Target.objects.filter(id=request.data['id'],
                                       create_user=request.user)  # Target id로 검색
-    data = list(queryset.values())
+    data = list(queryset.values(*[f.attname for f in Target._meta.concrete_fields if f.name != 'target_image']))
 
     target_data = {'id': data[0]['id'],
                            'name': data[0]['target_name'],
@@ -205,6 +213,35 @@ def target_info(request):
                            'host_ip': data[0]['target_host_ip'],
                            'host_port': data[0]['target_host_port'],
                            'host_service_port': data[0]['target_host_service_port'],
-                           'image': str(data[0]['target_image'])}
+                           'image': get_target_image_url(data[0]['target_image_hash'])}
     
-    return HttpResponse(json.dumps(target_data))
\ No newline at end of file
+    return HttpResponse(json.dumps(target_data))
+
+
+# 타겟 이미지 (content-addressed : url이 바뀌지 않으면 이미지도 바뀌지 않음)
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def target_image(request, image_hash):
+    """
+    Returns a target image file (cacheable with ETag)
+
+    Args:
+        image_hash (string): sha256 of the image
+
+    Returns:
+        image file
+    """
+
+    file_path = get_target_image_path(image_hash)
+    if file_path is None:
+        raise Http404
+
+    etag = '"' + image_hash + '"'
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(file_path, 'rb'), content_type=get_target_image_content_type(file_path))
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""workflow module for tango
+Asynchronous workflow engine : drives the WorkflowOrder chain of each project
+(bms -> visualization -> autonn -> codegen -> deploy) on a background event
+loop, so the django views only enqueue events and return immediately.
+Attributes:
+
+Todo:
+"""
+
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .models import Project, WorkflowOrder
+from .projectHandler import start_handler, get_log_container_name, HTTP_POOL_SIZE
+from .logHandler import get_project_log
+
+WORKFLOW_WORKERS = 8            # 동시에 처리하는 이벤트 수
+
+EVENT_START = 'start'           # 컨테이너 시작 요청
+EVENT_REPORT = 'report'         # 컨테이너 작업 완료 보고 -> 다음 workflow로 전이
+
+STATUS_STARTED = 'started'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'fail'
+
+
+def get_next_workflow(project_id, container_id):
+    """
+    Returns the next workflow of the container in the project WorkflowOrder
+
+    Args:
+        project_id : project_id
+        container_id : current container
+
+    Returns:
+        (bool, string) : (current container is in the workflow, next container or None)
+    """
+    workflow = list(WorkflowOrder.objects.filter(project_id=project_id)
+                                         .order_by('order')
+                                         .values_list('workflow_name', flat=True))
+    if container_id not in workflow:
+        return False, None
+
+    index = workflow.index(container_id)
+    if index + 1 < len(workflow):
+        return True, workflow[index + 1]
+    return True, None
+
+
+def update_project_status(project_id, **fields):
+    """
+    Update only the given columns of a project
+
+    Args:
+        project_id : project_id
+        fields : column values
+    """
+    Project.objects.filter(id=project_id).update(**fields)
+
+
+class WorkflowEngine:
+    """WorkflowEngine class
+    Note:
+        Event queue + state machine running on its own asyncio event loop thread.
+        Events of the same project are processed in order, events of different
+        projects concurrently. Container API requests use the shared pooled
+        HTTP client of projectHandler.
+    Args:
+        None
+    Attributes:
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.project_locks = {}
+
+    def ensure_started(self):
+        """
+        Start the event loop thread on first use
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='workflow-engine', daemon=True)
+                self.thread.start()
+        self.ready.wait()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix='workflow-io'))
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        for _ in range(WORKFLOW_WORKERS):
+            loop.create_task(self._worker())
+        self.ready.set()
+        loop.run_forever()
+
+    def submit(self, event):
+        """
+        Enqueue an event (thread safe, non-blocking)
+
+        Args:
+            event (dict): event
+        """
+        self.ensure_started()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the engine loop and wait for the result
+        (for requests whose result is needed by the view, e.g. status_request)
+
+        Args:
+            coro : coroutine
+            timeout : timeout (sec)
+
+        Returns:
+            coroutine result
+        """
+        self.ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def start(self, user_id, project_id, container, target_info):
+        """
+        Enqueue a container start request
+
+        Args:
+            user_id : user_id
+            project_id : project_id
+            container : container to start
+            target_info : target info (used for image deploy)
+        """
+        self.submit({'type': EVENT_START, 'user_id': user_id, 'project_id': project_id,
+                     'container': container, 'target_info': target_info})
+
+    def report(self, user_id, project_id, container, target_info):
+        """
+        Enqueue a task completion report of a container (auto workflow)
+
+        Args:
+            user_id : user_id
+            project_id : project_id
+            container : container which completed its task
+            target_info : target info (used for image deploy)
+        """
+        self.submit({'type': EVENT_REPORT, 'user_id': user_id, 'project_id': project_id,
+                     'container': container, 'target_info': target_info})
+
+    def queue_size(self):
+        """
+        Returns the number of waiting events
+        """
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def _worker(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                # 이벤트를 꺼낸 직후 (양보 없이) lock을 잡으므로 같은 프로젝트의 이벤트는 순서대로 처리됨
+                async with self._project_lock(event['project_id']):
+                    if event['type'] == EVENT_START:
+                        await self._start(event)
+                    elif event['type'] == EVENT_REPORT:
+                        await self._advance(event)
+            except Exception as error:
+                print('WorkflowEngine - error : ' + str(error))
+            finally:
+                self.queue.task_done()
+
+    def _project_lock(self, project_id):
+        key = str(project_id)
+        if key not in self.project_locks:
+            self.project_locks[key] = asyncio.Lock()
+        return self.project_locks[key]
+
+    async def _db(self, func, *args, **kwargs):
+        def call():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                close_old_connections()
+        return await self.loop.run_in_executor(None, call)
+
+    async def _start(self, event):
+        project_log = get_project_log(event['user_id'], event['project_id'])
+        container = event['container']
+        try:
+            response = await start_handler(container, event['user_id'], event['project_id'], event['target_info'])
+            project_log.append(json.loads(response)['request_info'])
+            status = STATUS_STARTED
+        except Exception as error:
+            project_log.append(get_log_container_name(container) + " 시작 요청 실패 : " + str(error))
+            status = STATUS_FAILED
+
+        await self._db(update_project_status, event['project_id'], container=container, container_status=status)
+
+    async def _advance(self, event):
+        project_log = get_project_log(event['user_id'], event['project_id'])
+        container = event['container']
+        found, next_container = await self._db(get_next_workflow, event['project_id'], container)
+        if not found:
+            return
+
+        log = get_log_container_name(container) + " 완료"
+        if next_container is None:
+            project_log.append(log)
+            await self._db(update_project_status, event['project_id'], container_status=STATUS_COMPLETED)
+            return
+
+        project_log.append(log + "\n" + get_log_container_name(next_container) + " 시작 요청")
+        await self._db(update_project_status, event['project_id'], container=next_container, container_status=STATUS_STARTED)
+        await self._start(dict(event, type=EVENT_START, container=next_container))
+
+
+workflow_engine = WorkflowEngine()